@@ -0,0 +1,54 @@
+"""
+Microbenchmark of the interpolation kernels in emcmass.interpol.
+
+Compares the time per call of interpol.interpolate (one map_coordinates call
+per variable) with interpol.interpolate_linear (one gather for all variables)
+for 1, 100 and 100000 points in the bundled MIST grid with all variables, and
+checks that both give the same values (relative difference for values larger
+than 1, absolute difference otherwise).
+
+usage: python benchmarks/bench_interpolate.py
+"""
+import timeit
+
+import numpy as np
+
+from emcmass import models, interpol
+
+
+def random_points(axis_values, npoints, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.vstack([rng.uniform(np.min(av), np.max(av), npoints) for av in axis_values])
+
+
+def main():
+
+    axis_values, pixelgrid, variables = models.prepare_grid(variables=['log_L', 'log_Teff', 'log_g', 'M_H'],
+                                                            return_all_variables=True, set_default=False,
+                                                            phase_lim=(100, 400))
+
+    print("grid shape: {}, {} variables".format(pixelgrid.shape[:-1], len(variables)))
+    print("")
+    print("  npoints    interpolate    interpolate_linear   speedup   max rel. difference")
+
+    for npoints in [1, 100, 100000]:
+        p = random_points(axis_values, npoints)
+
+        v1 = interpol.interpolate(p.copy(), axis_values, pixelgrid)
+        v2 = interpol.interpolate_linear(p.copy(), axis_values, pixelgrid)
+        finite = np.isfinite(v1)
+        diff = np.abs(v1[finite] - v2[finite]) / np.maximum(1, np.abs(v1[finite]))
+        diff = np.max(diff) if np.any(finite) else 0.
+
+        number = max(1, 20000 // npoints)
+        t1 = min(timeit.repeat(lambda: interpol.interpolate(p.copy(), axis_values, pixelgrid),
+                               number=number, repeat=3)) / number
+        t2 = min(timeit.repeat(lambda: interpol.interpolate_linear(p.copy(), axis_values, pixelgrid),
+                               number=number, repeat=3)) / number
+
+        print("  {:7d}   {:9.1f} us   {:12.1f} us      {:6.2f}   {:.1e}".format(npoints, t1 * 1e6, t2 * 1e6,
+                                                                         t1 / t2, diff))
+
+
+if __name__ == "__main__":
+    main()
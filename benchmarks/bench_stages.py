@@ -0,0 +1,251 @@
+"""
+Benchmark of every stage of a fit, to judge optimisations of the hot path.
+
+The stages are timed on the bundled MIST models and on a synthetic grid of a
+fixed size, so that timings can be compared between machines and model
+versions:
+
+  * import: starting a new interpreter and importing the emcmass CLI
+  * get_files: finding the model files
+  * prepare_grid: preparing the grid for several sets of limits
+  * create_pixeltypegrid: building the pixelgrid from the model rows
+  * interpolate: interpol.interpolate and interpol.interpolate_linear (used by
+    models.interpolate) at 1, 1e3 and 1e6 points
+  * lnprob: one call for a single walker and for 100 walkers at once, and
+    for 1000 walkers split over 1, 2 and 4 threads
+  * interpolate_samples: the model quantities of 1e5 samples with 1, 2 and 4
+    threads
+  * MCMC: a full (short) run of mcmc.MCMC, also with 4 threads
+
+Every benchmark is repeated a few times and the best and median time per call
+are reported. With -o the results are written to a json file together with
+the git commit and the versions of python and numpy. Such a file can be given
+with --compare to a later run, which then reports the ratio of the new and old
+best times and marks stages that got more than 20% slower.
+
+usage: python benchmarks/bench_stages.py [-o results.json] [--compare old.json] [--quick] [-k pattern]
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+
+from emcmass import models, interpol, mcmc
+
+
+variables = ['log_R', 'M_H', 'log_g', 'log_L', 'log_Teff']
+limits = [(0.1, 2.0), (-1.5, 0.5), (100, 400)]
+obs = np.array([0.07188201, -0.4, 4.7, 0.13987909, 3.75587486])
+obs_err = np.array([0.03680424, 0.08, 0.2, 0.15735145, 0.00380956])
+
+limit_sets = [('full', {}),
+              ('main sequence', dict(phase_lim=(200, 400))),
+              ('narrow', dict(mass_init_lim=(0.8, 1.2), M_H_init_lim=(-0.5, 0.0), phase_lim=(200, 300)))]
+
+
+def random_points(axis_values, npoints, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.vstack([rng.uniform(np.min(av), np.max(av), npoints) for av in axis_values])
+
+
+def synthetic_grid(nmass=60, nfeh=12, nphase=400, nvars=6):
+    """
+    Returns the parameters and data of a synthetic grid with the size of a
+    typical MIST grid, in the format used by interpol.create_pixeltypegrid.
+    Like real evolution tracks, the tracks of more massive stars end earlier.
+    """
+    mass, feh, phase = np.meshgrid(np.linspace(0.1, 3.0, nmass), np.linspace(-2.0, 0.5, nfeh),
+                                   np.arange(nphase, dtype=float), indexing='ij')
+
+    keep = phase < nphase * (1 - 0.5 * (mass - 0.1) / 2.9)
+    grid_pars = np.vstack([mass[keep], feh[keep], phase[keep]])
+
+    grid_data = np.vstack([np.sin(i + grid_pars[0]) * grid_pars[2] + grid_pars[1] for i in range(nvars)])
+
+    return grid_pars, grid_data
+
+
+def grid_rows(grid):
+    """
+    Returns the parameters and data of all models in a prepared grid, in the
+    format used by interpol.create_pixeltypegrid.
+    """
+    axis_values, pixelgrid, names = grid
+
+    index = np.nonzero(np.isfinite(pixelgrid[..., 0]))
+    grid_pars = np.vstack([av[i] for av, i in zip(axis_values, index)])
+
+    return grid_pars, pixelgrid[index].T
+
+
+def timed(func, number=1, repeat=3):
+    """
+    Returns the best and median time per call of func in seconds.
+    """
+    times = np.array(timeit.repeat(func, number=number, repeat=repeat)) / number
+    return float(np.min(times)), float(np.median(times))
+
+
+def benchmarks(quick=False):
+    """
+    Yields the name, function, number of calls and number of repeats of every
+    benchmark. Grids are prepared lazily, so that selecting benchmarks with -k
+    only prepares the grids that are needed.
+    """
+    models.parameters = ['mass_init', 'M_H_init', 'phase']
+
+    yield ('import emcmass.emcmass',
+           lambda: subprocess.check_call([sys.executable, '-c', 'import emcmass.emcmass']), 1, 3)
+
+    yield 'get_files mist', lambda: models.get_files('mist'), 10, 3
+
+    for name, lim_kwargs in limit_sets:
+        yield ('prepare_grid mist {}'.format(name),
+               lambda lim_kwargs=lim_kwargs: models.prepare_grid(variables=variables, set_default=False,
+                                                                 **lim_kwargs), 1, 3)
+
+    yield ('prepare_grid mist all variables',
+           lambda: models.prepare_grid(variables=variables, set_default=False, return_all_variables=True,
+                                       phase_lim=limits[2]), 1, 3)
+
+    grids = {}
+
+    def get_grid(name):
+        if name not in grids:
+            if name == 'mist':
+                grids[name] = mcmc.get_grid(variables, limits)
+            else:
+                axis_values, pixelgrid = interpol.create_pixeltypegrid(*synthetic_grid())
+                grids[name] = models.Grid(axis_values, pixelgrid, None)
+        return grids[name]
+
+    for name in ['mist', 'synthetic']:
+        rows = {}
+
+        def create(name=name, rows=rows):
+            if not rows:
+                rows['rows'] = synthetic_grid() if name == 'synthetic' else grid_rows(get_grid(name))
+            return interpol.create_pixeltypegrid(*rows['rows'])
+
+        yield 'create_pixeltypegrid {}'.format(name), create, 1, 3
+
+    npoints = [1, 1000] if quick else [1, 1000, 1000000]
+    for name in ['mist', 'synthetic']:
+        for n in npoints:
+            for kernel in [interpol.interpolate, interpol.interpolate_linear]:
+                points = {}
+
+                def interpolate(name=name, n=n, kernel=kernel, points=points):
+                    axis_values, pixelgrid, _ = get_grid(name)
+                    if not points:
+                        points['p'] = random_points(axis_values, n)
+                    return kernel(points['p'].copy(), axis_values, pixelgrid)
+
+                yield ('{} {} {:g} points'.format(kernel.__name__, name, n), interpolate,
+                       max(1, 10000 // n), 3)
+
+    theta = random_points(limits, 100).T
+
+    def lnprob(theta):
+        return mcmc.lnprob(theta, obs, obs_err, limits, grid=get_grid('mist'))
+
+    yield 'lnprob 1 walker', lambda: lnprob(theta[0]), 1000, 3
+    yield 'lnprob 100 walkers', lambda: lnprob(theta), 100, 3
+
+    # -- the thread pools are created once, like in mcmc.MCMC
+    theta_many = random_points(limits, 1000, seed=1).T
+    samples = random_points(limits, 100000, seed=2).T
+    for nthreads in [1, 2, 4]:
+        def lnprob_threaded(nthreads=nthreads):
+            with mcmc.thread_pool(nthreads) as executor:
+                return [mcmc.lnprob(theta_many, obs, obs_err, limits, grid=get_grid('mist'),
+                                    executor=executor, nthreads=nthreads) for i in range(10)]
+
+        def interpolate_threaded(nthreads=nthreads):
+            with mcmc.thread_pool(nthreads) as executor:
+                return mcmc.interpolate_samples(samples, grid=get_grid('mist'), executor=executor,
+                                                nthreads=nthreads)
+
+        yield 'lnprob 1000 walkers x 10, {} threads'.format(nthreads), lnprob_threaded, 1, 3
+        yield 'interpolate_samples 1e5, {} threads'.format(nthreads), interpolate_threaded, 1, 3
+
+    nsteps = 200 if quick else 1000
+
+    def fit():
+        np.random.seed(0)
+        return mcmc.MCMC(variables, limits, obs, obs_err, nwalkers=100, nsteps=nsteps, nrelax=100,
+                         verbose=False, grid=get_grid('mist'))
+
+    yield 'MCMC 100 walkers {} steps'.format(nsteps), fit, 1, 1
+
+    def fit_threaded():
+        np.random.seed(0)
+        return mcmc.MCMC(variables, limits, obs, obs_err, nwalkers=100, nsteps=nsteps, nrelax=100,
+                         verbose=False, grid=get_grid('mist'), threads=4)
+
+    yield 'MCMC 100 walkers {} steps, 4 threads'.format(nsteps), fit_threaded, 1, 1
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark all stages of an emcmass fit")
+    parser.add_argument('-o', dest='output', default=None, help="json file to write the results to")
+    parser.add_argument('--compare', dest='compare', default=None,
+                        help="json file with earlier results to compare with")
+    parser.add_argument('--quick', action='store_true', help="skip the slowest benchmarks")
+    parser.add_argument('-k', dest='pattern', default=None,
+                        help="only run the benchmarks with this text in their name")
+    args = parser.parse_args()
+
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare) as ifile:
+            previous = json.load(ifile)['results']
+
+    results = {}
+
+    print("  {:45s} {:>12s} {:>12s}{}".format('benchmark', 'best', 'median',
+                                              '      ratio' if previous else ''))
+
+    for name, func, number, repeat in benchmarks(quick=args.quick):
+        if args.pattern is not None and args.pattern not in name:
+            continue
+
+        # -- the first call prepares the grids and data the benchmark needs
+        func()
+
+        best, median = timed(func, number=number, repeat=repeat)
+        results[name] = dict(best=best, median=median, number=number, repeat=repeat)
+
+        line = "  {:45s} {:9.3f} ms {:9.3f} ms".format(name, best * 1e3, median * 1e3)
+        if name in previous:
+            ratio = best / previous[name]['best']
+            line += "   {:6.2f}{}".format(ratio, '  slower' if ratio > 1.2 else '')
+        print(line)
+        sys.stdout.flush()
+
+    if args.output is not None:
+        info = dict(date=time.strftime('%Y-%m-%d %H:%M:%S'), commit=git_commit(),
+                    python=platform.python_version(), numpy=np.__version__,
+                    machine=platform.machine(), processor=platform.processor(),
+                    cpus=os.cpu_count(), quick=args.quick)
+        with open(args.output, 'w') as ofile:
+            json.dump(dict(info=info, results=results), ofile, indent=1)
+
+
+if __name__ == "__main__":
+    main()
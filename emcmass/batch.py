@@ -0,0 +1,259 @@
+import os
+import sys
+import inspect
+import multiprocessing
+
+import numpy as np
+
+from emcmass import models, mcmc
+
+
+#{ Reading and writing tables
+
+def read_table(filename):
+    """
+    Reads a table with the observables of many stars.
+
+    Supported formats are yaml, fits and csv (any other extension is read as
+    csv). A yaml file contains a list of stars, each with a name and the
+    observables in the same format as the emcmass setup file:
+
+    .. code-block:: yaml
+
+        - name: star1
+          observables:
+            Teff: [5778, 250]
+            log_g: [4.43, 0.25]
+
+    In fits and csv tables every observable has a column with its value and
+    a column with the same name followed by '_err' with its error. An optional
+    'name' column gives the name of each star.
+
+    :param filename: path to the table
+    :type filename: str
+
+    :return: list of stars, each a dict with 'name' and 'observables' keys.
+    :rtype: list
+    """
+
+    ext = os.path.splitext(filename)[1].lower()
+
+    if ext in ['.yaml', '.yml']:
+        import yaml
+
+        with open(filename) as ifile:
+            stars = yaml.safe_load(ifile)
+
+        for i, star in enumerate(stars):
+            star.setdefault('name', str(i))
+
+        return stars
+
+    from astropy.table import Table
+
+    if ext in ['.fits', '.fit']:
+        table = Table.read(filename, format='fits')
+    else:
+        table = Table.read(filename, format='ascii.csv')
+
+    variables = [n for n in table.colnames if n + '_err' in table.colnames]
+
+    stars = []
+    for i, row in enumerate(table):
+        name = str(row['name']) if 'name' in table.colnames else str(i)
+        observables = dict((v, [float(row[v]), float(row[v + '_err'])]) for v in variables)
+        stars.append(dict(name=name, observables=observables))
+
+    return stars
+
+
+def write_row(ofile, row, header=False):
+    """
+    Writes one result row from :py:func:`fit_many` as a comma separated line to
+    an open file, optionally preceded by the header line. The file is flushed
+    so that results of long batch runs are on disk as soon as they are known.
+    """
+
+    if header:
+        ofile.write(",".join(row.keys()) + "\n")
+
+    ofile.write(",".join([str(v) for v in row.values()]) + "\n")
+    ofile.flush()
+
+#}
+
+#{ Batch fitting
+
+# -- the grid used by the worker processes of fit_many
+_grid = None
+
+
+def _init_worker(grid):
+    """
+    Initializes a worker process of the pool used by :py:func:`fit_many`.
+
+    Grid can be None when the workers are forked and inherit the grid from the
+    main process, or the grid itself. A grid loaded with
+    :py:func:`models.load_grid` is passed by its path and memory mapped again
+    in the worker.
+    """
+    global _grid
+
+    if grid is not None:
+        _grid = grid
+
+    # -- forked workers inherit the random state of the main process
+    np.random.seed()
+
+
+def _fit_star(args):
+    """
+    Fits one star in a worker process and returns its result row
+    """
+
+    star, variables, limits, percentiles, method, plots, mcmc_kws = args
+
+    row = dict(name=star['name'])
+
+    try:
+        y = np.array([star['observables'][v][0] for v in variables], dtype=float)
+        yerr = np.array([star['observables'][v][1] for v in variables], dtype=float)
+        variables, y, yerr = models.convert_observables(np.array(variables, dtype='U10'), y, yerr)
+
+        if method == 'grid':
+            results, pc = mcmc.grid_posterior(variables, limits, y, yerr, grid=_grid,
+                                              percentiles=percentiles, verbose=False, **mcmc_kws)
+            samples = None
+        else:
+            results, samples = mcmc.MCMC(variables, limits, y, yerr, grid=_grid,
+                                         verbose=False, **mcmc_kws)
+
+            pc = mcmc.calculate_percentiles(samples, percentiles)
+
+        for p in models.parameters:
+            row[p] = pc[p][0]
+            row[p + '_emin'] = pc[p][1]
+            row[p + '_emax'] = pc[p][2]
+            row[p + '_best'] = results[p]
+
+    except Exception as e:
+        # -- the results can be written to stdout, so errors go to stderr
+        print("Fit of {} failed: {}: {}".format(star['name'], type(e).__name__, e), file=sys.stderr)
+        for p in models.parameters:
+            for key in [p, p + '_emin', p + '_emax', p + '_best']:
+                row[key] = np.nan
+
+        return row
+
+    if plots:
+        try:
+            from emcmass import plotting
+
+            for p in pc:
+                results[p] = [results[p]] + list(pc[p])
+
+            plotting.make_plots(plots, variables, y, yerr, samples, results, grid=_grid,
+                                objectname=star['name'])
+
+        except Exception as e:
+            print("Plots of {} failed: {}: {}".format(star['name'], type(e).__name__, e), file=sys.stderr)
+
+    return row
+
+
+def fit_many(stars, limits=None, model='mist', processes=None, percentiles=[16, 50, 84],
+             cache=False, memmap=None, method='mcmc', plots=None, **mcmc_kws):
+    """
+    Fits many stars in parallel using a pool of worker processes.
+
+    The model grid is prepared once in the main process. Workers that are
+    forked inherit it without copying. When a memmap filename is given, the
+    workers map that file instead, which also shares one copy of the grid
+    when processes are spawned.
+
+    All stars need to have the same observables. The results are yielded one
+    row per star, in the same order as the stars, as soon as they are
+    available.
+
+    The plots of every star are made by the worker that fitted it, right after
+    the fit, with the Agg backend (see :py:func:`plotting.make_plots`). The
+    path of every plot needs to contain <objectname>, which is replaced by the
+    name of the star.
+
+    :param stars: list of stars as returned by :py:func:`read_table`
+    :type stars: list
+    :param limits: list of limits on the model parameters
+    :type limits: list of tuples
+    :param model: name of the stellar evolution models
+    :type model: str
+    :param processes: number of worker processes (default is the number of cpus)
+    :type processes: int
+    :param percentiles: percentiles used to calculate the values and errors
+    :type percentiles: list
+    :param cache: use the on-disk grid cache
+    :type cache: bool
+    :param memmap: filename to write the grid to, or True to map the cached grid
+    :type memmap: str or bool
+    :param method: 'mcmc' to fit with :py:func:`mcmc.MCMC` or 'grid' to use
+                   :py:func:`mcmc.grid_posterior`
+    :type method: str
+    :param plots: plots to make of every star, as in the emcmass setup file
+    :type plots: list of dicts
+    :param mcmc_kws: other keywords passed to :py:func:`mcmc.MCMC` or
+                     :py:func:`mcmc.grid_posterior`. Keywords of the method
+                     that is not used are ignored.
+
+    :return: generator yielding one dict per star with the name and for every
+             parameter its value, errors and best fit value
+    :rtype: generator
+    """
+
+    variables = list(stars[0]['observables'].keys())
+    for star in stars:
+        if sorted(star['observables'].keys()) != sorted(variables):
+            raise ValueError("All stars need to have the same observables, {} has {} instead of {}".format(
+                star['name'], list(star['observables'].keys()), variables))
+
+    # -- the options of both methods can be given, only forward the ones the
+    #    chosen method accepts
+    fit_kws = {}
+    for func in [mcmc.MCMC, mcmc.grid_posterior]:
+        fit_kws[func] = [n for n, p in inspect.signature(func).parameters.items()
+                         if p.kind != inspect.Parameter.VAR_KEYWORD]
+
+    unknown = [k for k in mcmc_kws if not any(k in names for names in fit_kws.values())]
+    if unknown:
+        raise TypeError("fit_many() got unexpected keyword arguments: {}".format(", ".join(unknown)))
+
+    fit = mcmc.grid_posterior if method == 'grid' else mcmc.MCMC
+    mcmc_kws = dict((k, v) for k, v in mcmc_kws.items() if k in fit_kws[fit])
+
+    grid_variables, _, _ = models.convert_observables(np.array(variables, dtype='U10'),
+                                                      np.ones(len(variables)), np.ones(len(variables)))
+
+    global _grid
+    _grid = mcmc.get_grid(grid_variables, limits, model=model, cache=cache, memmap=memmap)
+
+    # -- forked workers inherit _grid, otherwise the grid is pickled to the
+    #    workers, a memory mapped grid only by its path
+    if multiprocessing.get_start_method() == 'fork':
+        initarg = None
+    else:
+        initarg = _grid
+
+    if plots is not None:
+        for plot in plots:
+            if '<objectname>' not in plot.get('path', ''):
+                raise ValueError("The path of every plot needs to contain <objectname>, not {}".format(
+                    plot.get('path', None)))
+
+    tasks = ((star, variables, limits, percentiles, method, plots, mcmc_kws) for star in stars)
+
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(initarg,))
+    try:
+        for row in pool.imap(_fit_star, tasks):
+            yield row
+    finally:
+        pool.terminate()
+
+#}
@@ -1,13 +1,12 @@
+import os
 import sys
-import yaml
+import json
+import time
 import argparse
 
-import pylab as pl
 import numpy as np
 
-from numpy.lib.recfunctions import repack_fields
-
-from emcmass import models, mcmc, plotting
+from emcmass import models, mcmc, batch
 
 default = """
 # parameters of the evolution models to fit
@@ -26,15 +25,24 @@ observables:
   M_H: [0.0, 0.05]
 # The name of the evolution model to use (only mist is supported for now)
 model: mist
+# 'mcmc' samples the posterior, 'grid' evaluates it directly on the model grid (much faster)
+method: mcmc
+refine: 1        # subgrid steps per grid step for the grid method
 # setup for the MCMC algorithm
 nwalkers: 100    # total number of walkers
 nsteps: 2000     # steps taken by each walker (not including burn-in)
 nrelax: 500      # burn-in steps taken by each walker
 a: 10            # relative size of the steps taken
+init: uniform    # start walkers 'uniform' over the limits or close to the best 'grid' points
+converge: false  # stop when the chain has converged, nsteps is then the maximum number of steps
+threads: 1       # threads used to evaluate the likelihood and derive the model quantities
+checkpoint: none       # file to regularly save the sampler state to, to resume an interrupted run
+checkpoint_every: 100  # steps between checkpoints
+resume: false          # continue from the checkpoint if it exists
 # set the percentiles for the error determination 
 percentiles: [0.2, 50, 99.8] # 16 - 84 corresponds to 1 sigma
 # output options
-datafile: none   # filepath to write results of all walkers
+datafile: none   # .npy file to stream the samples of all walkers to
 plot1:
  type: fit
  path: <objectname>_fit.png
@@ -71,6 +79,39 @@ def main():
                         help="limit the search in evolutionary phase")
     parser.add_argument("--plot", action='store_true', dest='plot', default=False,
                         help="Will show the default plots when fitting")
+    parser.add_argument("-init", type=str, dest='init', default='uniform', choices=['uniform', 'grid'],
+                        help="initialize the walkers uniformly or close to the best matching grid points")
+    parser.add_argument("--cache", action='store_true', dest='cache', default=False,
+                        help="Store the prepared model grid on disk and reuse it in later runs")
+    parser.add_argument("-datafile", type=str, dest='datafile', default=None,
+                        help="stream all samples of the walkers to this .npy file instead of keeping them in memory")
+    parser.add_argument("-method", type=str, dest='method', default='mcmc', choices=['mcmc', 'grid'],
+                        help="sample the posterior with 'mcmc', or evaluate it directly on the model 'grid'")
+    parser.add_argument("-refine", type=int, dest='refine', default=1,
+                        help="number of subgrid steps per grid step for the 'grid' method")
+    parser.add_argument("-threads", type=int, dest='threads', default=None,
+                        help="number of threads used to evaluate the likelihood")
+    parser.add_argument("--converge", action='store_true', dest='converge', default=False,
+                        help="stop when the chain has converged based on its autocorrelation time")
+    parser.add_argument("-checkpoint", type=str, dest='checkpoint', default=None,
+                        help="regularly save the state of the sampler to this file")
+    parser.add_argument("-checkpoint_every", type=int, dest='checkpoint_every', default=100,
+                        help="number of steps between checkpoints")
+    parser.add_argument("--resume", action='store_true', dest='resume', default=False,
+                        help="continue an interrupted run from its checkpoint")
+    parser.add_argument("--stats", action='store_true', dest='stats', default=False,
+                        help="print a report of the time spent in every stage of the fit")
+    parser.add_argument("-stats_file", type=str, dest='stats_file', default=None,
+                        help="write the timing report of the fit to this json file")
+    parser.add_argument("-batch", type=str, dest='batchfile', default=None,
+                        help="fit all stars in this table (csv, fits or yaml)")
+    parser.add_argument("-o", type=str, dest='output', default=None,
+                        help="file to write the batch results to (default is stdout)")
+    parser.add_argument("-processes", type=int, dest='processes', default=None,
+                        help="number of processes used in batch mode (default is all cpus)")
+    parser.add_argument("-plotdir", type=str, dest='plotdir', default=None,
+                        help="save the distribution, fit and HR plots of every star in batch mode to "
+                             "this directory")
     args, variables = parser.parse_known_args()
 
     print("================================================================================")
@@ -95,10 +136,43 @@ def main():
         print("Written default setup file to: " + filename)
         sys.exit()
 
+    if args.batchfile is not None:
+        # Fit all stars in the given table using a pool of processes.
+        # ============================================================
+
+        stars = batch.read_table(args.batchfile)
+        limits = [args.mass_lim, args.mh_lim, args.phase_lim]
+
+        print("Fitting {} stars from {}".format(len(stars), args.batchfile))
+        print("================================================================================")
+
+        ofile = sys.stdout if args.output is None else open(args.output, 'w')
+
+        # -- the plots are made by the worker processes, without showing them
+        plots = None
+        if args.plotdir is not None:
+            if not os.path.isdir(args.plotdir):
+                os.makedirs(args.plotdir)
+            plots = [dict(type=t, path=os.path.join(args.plotdir, '<objectname>_' + t + '.png'))
+                     for t in ['distribution', 'fit', 'HR']]
+
+        rows = batch.fit_many(stars, limits=limits, model=args.model, processes=args.processes,
+                              cache=args.cache, nwalkers=args.nwalkers, nsteps=args.nsteps, a=args.a,
+                              init=args.init, converge=args.converge, method=args.method,
+                              refine=args.refine, plots=plots)
+        for i, row in enumerate(rows):
+            batch.write_row(ofile, row, header=i == 0)
+
+        if args.output is not None:
+            ofile.close()
+        sys.exit()
+
     if args.filename is not None:
         # First check if there is a setup file given and use that to run.
         # ================================================================
 
+        import yaml
+
         setupfile = open(args.filename)
         setup = yaml.safe_load(setupfile)
         setupfile.close()
@@ -114,7 +188,25 @@ def main():
 
         mcmc_kws = dict(nwalkers=setup.get('nwalkers', 100),
                         nsteps=setup.get('nsteps', 1000),
-                        a=setup.get('a', 2))
+                        a=setup.get('a', 2),
+                        vectorize=setup.get('vectorize', True),
+                        cache=setup.get('cache', args.cache),
+                        init=setup.get('init', args.init),
+                        converge=setup.get('converge', args.converge),
+                        threads=setup.get('threads', args.threads))
+
+        datafile = setup.get('datafile', args.datafile)
+        if datafile is not None and datafile.lower() != 'none':
+            mcmc_kws['chain'] = datafile
+
+        checkpoint = setup.get('checkpoint', args.checkpoint)
+        if checkpoint is not None and checkpoint.lower() != 'none':
+            mcmc_kws['checkpoint'] = checkpoint
+            mcmc_kws['checkpoint_every'] = setup.get('checkpoint_every', args.checkpoint_every)
+            mcmc_kws['resume'] = setup.get('resume', args.resume)
+
+        method = setup.get('method', args.method)
+        refine = setup.get('refine', args.refine)
 
         percentiles = setup.get('percentiles', [16, 50, 84])
 
@@ -144,7 +236,22 @@ def main():
 
         mcmc_kws = dict(nwalkers=args.nwalkers,
                         nsteps=args.nsteps,
-                        a=args.a)
+                        a=args.a,
+                        cache=args.cache,
+                        init=args.init,
+                        converge=args.converge,
+                        threads=args.threads)
+
+        if args.datafile is not None:
+            mcmc_kws['chain'] = args.datafile
+
+        if args.checkpoint is not None:
+            mcmc_kws['checkpoint'] = args.checkpoint
+            mcmc_kws['checkpoint_every'] = args.checkpoint_every
+            mcmc_kws['resume'] = args.resume
+
+        method = args.method
+        refine = args.refine
 
         percentiles = [16, 50, 84]
 
@@ -152,12 +259,7 @@ def main():
     models.parameters = parameters
 
     # -- check if variables need to be converted to log(variable)
-    for par in ['L', 'R', 'Teff', 'g']:
-        if par in variables:
-            i = np.where(variables == par)
-            variables[i] = 'log_'+par
-            yerr[i] = 0.43429 * yerr[i] / y[i]
-            y[i] = np.log10(y[i])
+    variables, y, yerr = models.convert_observables(variables, y, yerr)
 
     # -- print the setup
     print("Stellar evolution models: ", model, "\n")
@@ -172,112 +274,92 @@ def main():
         print("   {} = {} +- {}".format(v, y_, e_))
     print("")
 
-    print("MCMC setup:")
-    print("   # walkers:", mcmc_kws['nwalkers'])
-    print("   # steps:", mcmc_kws['nsteps'])
-    print("   # a:", mcmc_kws['a'])
+    # -- the grid is prepared once and used for the fit and the plots
+    start = time.perf_counter()
+    grid = mcmc.get_grid(variables, limits, model=model, cache=mcmc_kws.pop('cache'))
+    grid_time = time.perf_counter() - start
 
-    print("================================================================================")
-    results, samples = mcmc.MCMC(variables, limits, y, yerr, return_chain=True,
-                                 model=model, **mcmc_kws)
+    if method == 'grid':
+        print("Grid posterior setup:")
+        print("   refine:", refine)
+
+        print("================================================================================")
+        results, pc = mcmc.grid_posterior(variables, limits, y, yerr, grid=grid, refine=refine,
+                                          percentiles=percentiles)
+        samples = None
+
+    else:
+        print("MCMC setup:")
+        print("   # walkers:", mcmc_kws['nwalkers'])
+        print("   # steps:", mcmc_kws['nsteps'])
+        print("   # a:", mcmc_kws['a'])
+
+        print("================================================================================")
+        results, samples = mcmc.MCMC(variables, limits, y, yerr, return_chain=True,
+                                     grid=grid, **mcmc_kws)
+
+        # -- a chain streamed to disk is read in chunks, see mcmc.chunked_percentiles
+        pc = mcmc.calculate_percentiles(samples, percentiles)
 
     print("================================================================================")
     print("")
     print("Resulting parameters values and errors:")
 
-    pc = np.percentile(samples.view(np.float64).reshape(samples.shape + (-1,)), percentiles, axis=0)
-    for p, v, e1, e2 in zip(samples.dtype.names, pc[1], pc[1]-pc[0], pc[2]-pc[1]):
-        results[p] = [results[p], v, e1, e2]
+    for p in pc:
+        results[p] = [results[p]] + pc[p]
 
     print("   Par          Best    Pc      emin     emax")
     for p in parameters:
         print("   {:10s} = {:0.3f}   {:0.3f}   -{:0.3f}   +{:0.3f}".format(p, *results[p]))
 
-    out = ""
-    for par in ['mass_init', 'M_H_init']:
-        out += "{:0.3f}\t{:0.3f}\t".format(results[par][1],
-                                           np.average([results[par][2], results[par][3]]))
-    out += "{:0.0f}\t{:0.0f}\t".format(results['phase'][1], np.average([results['phase'][2], results['phase'][3]]))
-
-    # create plot of the results if the corner package exists
-    try:
-        import corner
-    except Exception:
-        sys.exit()
+    if 'tau' in results:
+        print("")
+        print("Autocorrelation time:")
+        for p, tau in zip(parameters, results['tau']):
+            print("   {:10s} = {:0.1f}".format(p, tau))
 
-    if args.filename is None and args.plot:
-        pars = []
-        for p in ['mass_init', 'M_H_init', 'phase']:
-            if p in samples.dtype.names:
-                pars.append(p)
+    if 'stats' in results:
+        stats = results.pop('stats')
 
-        data = repack_fields(samples[pars])
+        # -- the grid was prepared here, MCMC only sliced it to the limits
+        stats['time_grid'] += grid_time
+        stats['time_total'] += grid_time
 
-        fig = corner.corner(data.view(np.float64).reshape(data.shape + (-1,)),
-                            labels=[plotting.get_label(p) for p in data.dtype.names],
-                            quantiles=[0.025, 0.16, 0.5, 0.84, 0.975],
-                            levels=[0.393, 0.865, 0.95],
-                            show_titles=True, title_kwargs={"fontsize": 12})
+        if args.stats:
+            print("")
+            print("Timing report:")
+            for name in sorted(stats):
+                print("   {:25s} = {:g}".format(name, stats[name]))
 
-        pl.figure(2, figsize=(10, 6))
-        pl.subplots_adjust(wspace=0.40, left=0.07, right=0.98)
-        plotting.plot_fit(variables, y, yerr, samples, results)
+        if args.stats_file is not None:
+            with open(args.stats_file, 'w') as ofile:
+                json.dump(stats, ofile, indent=1)
 
-        pl.figure(3, figsize=(6, 10))
-        plotting.plot_HR(variables, y, yerr, results)
+    out = ""
+    for par in ['mass_init', 'M_H_init']:
+        out += "{:0.3f}\t{:0.3f}\t".format(results[par][1],
+                                           np.average([results[par][2], results[par][3]]))
+    out += "{:0.0f}\t{:0.0f}\t".format(results['phase'][1], np.average([results['phase'][2], results['phase'][3]]))
 
-        pl.show()
+    # -- nothing to plot without a setup file or the --plot option
+    if args.filename is None and not args.plot:
         sys.exit()
 
+    # -- the --plot option shows the default plots, a setup file lists the
+    #   plots to make. Only plots without a path are shown.
     if args.filename is None:
-        sys.exit()
-
-    # -- Plotting
-    for i in range(10):
-
-        pindex = 'plot'+str(i)
-        if pindex not in setup:
-            continue
-
-        if setup[pindex]['type'] == 'distribution':
-
-            pars = []
-            for p in setup[pindex].get('parameters', ['mass_init', 'M_H_init', 'phase']):
-                if p in samples.dtype.names:
-                    pars.append(p)
-
-            data = repack_fields(samples[pars])
-
-            labels = [plotting.get_label(p) for p in data.dtype.names]
-            fig = corner.corner(data.view(np.float64).reshape(data.shape + (-1,)),
-                                labels=labels,
-                                quantiles=setup[pindex].get('quantiles', [0.025, 0.16, 0.5, 0.84, 0.975]),
-                                levels=setup[pindex].get('levels', [0.393, 0.865, 0.95]),
-                                show_titles=True, title_kwargs={"fontsize": 12})
-
-            if not setup[pindex].get('path', None) is None:
-                pl.savefig(setup[pindex].get('path'))
-
-        if setup[pindex]['type'] == 'HR':
-
-            pl.figure(i, figsize=(6, 10))
-            pl.subplots_adjust(left=0.14, right=0.97, top=0.97, bottom=0.07)
-            plotting.plot_HR(variables, y, yerr, results,
-                             result=setup[pindex].get('result', 'pc'))
-
-            if not setup[pindex].get('path', None) is None:
-                pl.savefig(setup[pindex].get('path'))
-
-        if setup[pindex]['type'] == 'fit':
+        plots = [dict(type='distribution'), dict(type='fit'), dict(type='HR')]
+    else:
+        plots = [setup['plot' + str(i)] for i in range(10) if 'plot' + str(i) in setup]
 
-            pl.figure(i, figsize=(10, 6))
-            pl.subplots_adjust(wspace=0.40, left=0.07, right=0.98)
-            plotting.plot_fit(variables, y, yerr, samples, results)
+    # -- matplotlib is only imported when plots are made
+    from emcmass import plotting
 
-            if not setup[pindex].get('path', None) is None:
-                pl.savefig(setup[pindex].get('path'))
+    plotting.make_plots(plots, variables, y, yerr, samples, results, grid=grid)
 
-    pl.show()
+    if any(plot.get('path', None) is None for plot in plots):
+        import pylab as pl
+        pl.show()
 
 
 if __name__ == "__main__":
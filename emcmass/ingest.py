@@ -0,0 +1,102 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+from astropy.io import fits
+
+from emcmass import models
+
+
+def ingest(evolution_model='mist', outdir=None):
+    """
+    Converts the fits files of an evolution model to a columnar store that
+    :py:func:`models.prepare_grid` can read much faster.
+
+    Every column of every fits file is written to its own .npy file in native
+    byte order, in a sub directory per metallicity, so that the columns can be
+    memory mapped and only the needed columns are read. A manifest.json file
+    lists the column names and, for every metallicity, the name of its directory,
+    the metallicity, the number of rows, the fits file it was made from and an
+    index with the initial mass and the row range of every evolution track.
+
+    :param evolution_model: name of the evolution models to convert
+    :type evolution_model: str
+    :param outdir: directory to write the store to (default is the directory
+                   of this evolution model in models.storedir)
+    :type outdir: str
+
+    :return: the manifest
+    :rtype: dict
+    """
+
+    files, fehs = models.get_files(evolution_model)
+
+    if outdir is None:
+        outdir = os.path.join(models.storedir, evolution_model)
+
+    columns = None
+    tables = []
+
+    for filename, z in zip(files, fehs):
+
+        data = fits.getdata(filename)
+        if columns is None:
+            columns = list(data.dtype.names)
+
+        name = os.path.splitext(os.path.basename(filename))[0]
+        tabledir = os.path.join(outdir, name)
+        if not os.path.isdir(tabledir):
+            os.makedirs(tabledir)
+
+        for column in data.dtype.names:
+            values = np.asarray(data[column])
+            np.save(os.path.join(tabledir, column + '.npy'), values.astype(values.dtype.newbyteorder('=')))
+
+        # -- index of the row range of every evolution track, so that only the
+        #    tracks inside the mass limits need to be read
+        mass = np.asarray(data['mass_init'])
+        starts = np.hstack([0, np.flatnonzero(mass[1:] != mass[:-1]) + 1])
+        stops = np.hstack([starts[1:], len(mass)])
+        tracks = [[float(mass[b]), int(b), int(e)] for b, e in zip(starts, stops)]
+
+        # -- the index can only be used when the phase increases along every track
+        phase = np.asarray(data['phase'], dtype=float)
+        if np.any(np.diff(phase)[mass[1:] == mass[:-1]] < 0) or len(np.unique(mass)) != len(tracks):
+            tracks = None
+
+        tables.append(dict(name=name, M_H=float(z), nrows=len(data), tracks=tracks,
+                           source=os.path.relpath(filename, models.modeldir),
+                           mtime=os.path.getmtime(filename)))
+
+    manifest = dict(evolution_model=evolution_model, columns=columns, tables=tables)
+
+    # -- the manifest is written last, so an interrupted ingest is never used
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as ofile:
+        json.dump(manifest, ofile, indent=1)
+
+    return manifest
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Convert the fits files of the evolution models to a "
+                                                 "columnar store that is much faster to read.")
+    parser.add_argument("-model", type=str, dest='model', nargs='+', default=['mist'],
+                        help="name of the stellar evolution model grids to convert")
+    parser.add_argument("-o", type=str, dest='outdir', default=None,
+                        help="directory to write the store to. Set the EMCMASS_STORE environment variable "
+                             "to this directory to use it.")
+    args = parser.parse_args()
+
+    for model in args.model:
+        outdir = None if args.outdir is None else os.path.join(args.outdir, model)
+        manifest = ingest(model, outdir=outdir)
+
+        print("Converted {} tables with {} columns of the {} models".format(
+            len(manifest['tables']), len(manifest['columns']), model))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 import numpy as np
-from scipy import ndimage
+from collections import namedtuple
+from functools import lru_cache
 
+# Compact representation of a pixelgrid, see create_compactgrid()
+CompactGrid = namedtuple('CompactGrid', ['packed', 'offsets', 'first', 'length', 'shape'])
 
-def create_pixeltypegrid(grid_pars, grid_data):
+
+def create_pixeltypegrid(grid_pars, grid_data, dtype=np.float64):
     """
     Creates pixelgrid and arrays of axis values.
 
@@ -53,6 +57,9 @@ def create_pixeltypegrid(grid_pars, grid_data):
     :type grid_pars: array
     :param grid_data: Ndata x Ngrid array of data
     :type grid_data: array
+    :param dtype: data type of the pixelgrid (default float64). Using float32
+                  halves the memory and cache traffic of the interpolation.
+    :type dtype: numpy dtype
 
     :return: axis values and pixelgrid
     :rtype: array, array
@@ -69,7 +76,7 @@ def create_pixeltypegrid(grid_pars, grid_data):
     par_dims = [len(uv[0]) for uv in uniques]
 
     par_dims.append(data_dim)
-    pixelgrid = np.ones(par_dims)
+    pixelgrid = np.ones(par_dims, dtype=dtype)
 
     # We put np.inf as default value. If we get an inf, that means we tried to access
     # a region of the pixelgrid that is not populated by the data table
@@ -77,7 +84,7 @@ def create_pixeltypegrid(grid_pars, grid_data):
 
     # now populate the multiDgrid
     indices = [uv[1] for uv in uniques]
-    pixelgrid[indices] = grid_data.T
+    pixelgrid[tuple(indices)] = grid_data.T
 
     return axis_values, pixelgrid
 
@@ -121,32 +128,370 @@ def interpolate(p, axis_values, pixelgrid):
     :rtype: array
 
     """
-    # convert requested parameter combination into a coordinate
-    #p_ = [np.searchsorted(av_,val) for av_, val in zip(axis_values,p)]
-    # we force the values to be inside the grid, to avoid edge-effect rounding
-    # (e.g. 3.099999 is edge, while actually it is 3.1). For values below the
-    # lowest value, this is automatically done via searchsorted (it return 0)
-    # for values higher up, we need to force it
-    #print p
-    p_ = []
-    for av_, val in zip(axis_values, p):
-        indices = np.searchsorted(av_, val)
-        indices[indices == len(av_)] = len(av_)-1
-        p_.append(indices)
-
-    #-- The type of p is changes to the same type as in axis_values to catch possible rounding errors
-    #   when comparing float64 to float32.
-    for i, ax in enumerate(axis_values):
-        p[i] = np.array(p[i], dtype=ax.dtype)
+    from scipy import ndimage
 
     #-- Convert requested parameter combination into a coordinate
-    p_ = np.array([np.searchsorted(av_,val) for av_, val in zip(axis_values, p)])
-
-    lowervals_stepsize = np.array([[av_[p__-1], av_[p__]-av_[p__-1]]
-                                   for av_, p__ in zip(axis_values, p_)])
-    p_coord = (p - lowervals_stepsize[:,0])/lowervals_stepsize[:,1] + np.array(p_)-1
+    p_coord = get_coordinates(p, axis_values)
 
     # interpolate
     return np.array([ndimage.map_coordinates(pixelgrid[..., i], p_coord, order=1, prefilter=False)
                      for i in range(np.shape(pixelgrid)[-1])])
 
+
+def create_compactgrid(grid_pars, grid_data, dtype=np.float32):
+    """
+    Creates a compact version of the pixelgrid made by create_pixeltypegrid().
+
+    The last parameter (e.g. the evolutionary phase) is treated as the position
+    along a track, and every combination of the other parameters (e.g. mass and
+    Fe/H) is one track. Instead of padding all tracks with +inf to the full length
+    of the last axis, only the range between the first and last point of every
+    track is stored, packed one track after the other in a single array.
+
+    The compact grid is a CompactGrid namedtuple with:
+       * packed: Nrows x Ndata array with the data of all tracks
+       * offsets: start row in packed of every track
+       * first: index on the last axis of the first point of every track
+       * length: number of points in every track (0 if the track is missing)
+       * shape: shape of the equivalent pixelgrid
+
+    Points that are missing inside a track are set to +inf, like in the
+    pixelgrid.
+
+    :param grid_pars: Npar x Ngrid array of parameters
+    :type grid_pars: array
+    :param grid_data: Ndata x Ngrid array of data
+    :type grid_data: array
+    :param dtype: data type of the packed array (default float32)
+    :type dtype: numpy dtype
+
+    :return: axis values and compact grid
+    :rtype: array, CompactGrid
+    """
+
+    uniques = [np.unique(column, return_inverse=True) for column in grid_pars]
+
+    axis_values = [uniques_[0] for uniques_ in uniques]
+    indices = [uniques_[1] for uniques_ in uniques]
+
+    track_shape = tuple([len(av) for av in axis_values[:-1]])
+    shape = track_shape + (len(axis_values[-1]), np.shape(grid_data)[0])
+
+    # track number and position along the track of every grid point
+    track = np.ravel_multi_index(indices[:-1], track_shape)
+    pos = indices[-1]
+
+    ntracks = int(np.prod(track_shape))
+    first = np.full(ntracks, len(axis_values[-1]), dtype=int)
+    last = np.full(ntracks, -1, dtype=int)
+    np.minimum.at(first, track, pos)
+    np.maximum.at(last, track, pos)
+
+    length = np.where(last >= first, last - first + 1, 0)
+    first[length == 0] = 0
+    offsets = np.concatenate([[0], np.cumsum(length)[:-1]])
+
+    packed = np.full((np.sum(length), shape[-1]), np.inf, dtype=dtype)
+    packed[offsets[track] + pos - first[track]] = grid_data.T
+
+    compactgrid = CompactGrid(packed, offsets.reshape(track_shape), first.reshape(track_shape),
+                              length.reshape(track_shape), shape)
+
+    return axis_values, compactgrid
+
+
+def get_coordinates(p, axis_values):
+    """
+    Converts the requested parameter combinations into (fractional) pixel
+    coordinates in the grid, in the same way as interpolate() does.
+
+    :param p: Npar x Ninterpolate array containing the points
+    :type p: array
+    :param axis_values: output from create_pixeltypegrid
+    :type axis_values: array
+
+    :return: Npar x Ninterpolate array of pixel coordinates
+    :rtype: array
+    """
+    coord = np.empty(np.shape(p), dtype=float)
+
+    for i, av_ in enumerate(axis_values):
+        #-- The type of p is changes to the same type as in axis_values to catch possible rounding errors
+        #   when comparing float64 to float32.
+        val = np.asarray(p[i], dtype=av_.dtype)
+
+        p_ = np.searchsorted(av_, val)
+        lower, stepsize = av_[p_-1], av_[p_]-av_[p_-1]
+
+        coord[i] = (val.astype(float) - lower) / stepsize + p_ - 1
+
+    return coord
+
+
+def cell_corners(coord, shape):
+    """
+    Determines the 2^Npar corners of the grid cells that contain the given
+    pixel coordinates, and the multilinear weight of every corner.
+
+    The cells are chosen in the same way as ndimage.map_coordinates does for
+    order=1, so that also the handling of +inf values in neighbouring pixels with
+    zero weight is the same.
+
+    :param coord: Npar x Ninterpolate array of pixel coordinates
+    :type coord: array
+    :param shape: number of pixels along every parameter axis
+    :type shape: tuple
+
+    :return: 2^Npar x Ninterpolate array of flat (raveled) pixel indices and
+             2^Npar x Ninterpolate array of weights
+    :rtype: array, array
+    """
+    strides, corners, offsets, maxlower = _cell_layout(tuple(shape))
+
+    # lower corner of the cell and the fractional position inside the cell
+    lower = np.minimum(np.maximum(np.floor(coord).astype(int), 0), maxlower)
+    frac = coord - lower
+
+    index = np.dot(strides, lower)[None, :] + offsets
+
+    weight = np.where(corners[0], frac[0], 1 - frac[0])
+    for corner, f in zip(corners[1:], frac[1:]):
+        weight *= np.where(corner, f, 1 - f)
+
+    return index, weight
+
+
+@lru_cache(maxsize=None)
+def _cell_layout(shape):
+    """
+    Returns the strides of a grid with the given shape, the 0/1 position of
+    every cell corner along every axis, the flat offset of every corner from the
+    lower corner and the largest allowed lower corner along every axis.
+    """
+    shape = np.array(shape)
+    strides = np.append(np.cumprod(shape[::-1])[-2::-1], 1)
+
+    # axes of length 1 have no upper corner
+    corners = np.array(list(np.ndindex(*(2,) * len(shape))))
+    offsets = np.dot(corners * (shape > 1), strides)
+
+    return strides, corners.T[:, :, None], offsets[:, None], np.maximum(shape - 2, 0)[:, None]
+
+
+def interpolate_linear(p, axis_values, pixelgrid, columns=None):
+    """
+    Interpolates in a grid prepared by create_pixeltypegrid(), giving the same
+    results as interpolate().
+
+    Instead of calling ndimage.map_coordinates for every variable separately,
+    the grid cell around every point is determined once, and the values of all
+    variables at all corners of the cells are gathered in one indexing
+    operation on the contiguous last axis of the pixelgrid and weighted.
+
+    :param p: Npar x Ninterpolate array containing the points which to
+              interpolate in axis_values
+    :type p: array
+    :param axis_values: output from create_pixeltypegrid
+    :type axis_values: array
+    :param pixelgrid: output from create_pixeltypegrid
+    :type pixelgrid: array
+    :param columns: indices of the variables to interpolate, when given only
+                    these columns of the pixelgrid are read (default all)
+    :type columns: list
+
+    :return: Ndata x Ninterpolate array containing the interpolated values
+             in pixelgrid
+    :rtype: array
+    """
+    shape = np.shape(pixelgrid)
+
+    coord = get_coordinates(p, axis_values)
+
+    index, weight = cell_corners(coord, shape[:-1])
+
+    if columns is not None and pixelgrid.flags.c_contiguous:
+        columns = np.asarray(columns)
+        corner_values = np.take(np.ravel(pixelgrid), index[..., None] * shape[-1] + columns)
+    elif pixelgrid.flags.c_contiguous:
+        corner_values = np.take(np.reshape(pixelgrid, (-1, shape[-1])), index, axis=0)
+    else:
+        corner_values = pixelgrid[np.unravel_index(index, shape[:-1])]
+        if columns is not None:
+            corner_values = corner_values[..., columns]
+
+    return np.einsum('cn,cnv->vn', weight, corner_values)
+
+
+def interpolate_compact(p, axis_values, compactgrid, columns=None):
+    """
+    Interpolates in a grid prepared by create_compactgrid(). The interpolation
+    is multilinear like in interpolate(), and gives the same results, but all
+    variables are interpolated at once by gathering the data of the 2^Npar
+    corners of the grid cell around every point from the packed array.
+
+    :param p: Npar x Ninterpolate array containing the points which to
+              interpolate in axis_values
+    :type p: array
+    :param axis_values: output from create_compactgrid
+    :type axis_values: array
+    :param compactgrid: output from create_compactgrid
+    :type compactgrid: CompactGrid
+    :param columns: indices of the variables to interpolate (default all)
+    :type columns: list
+
+    :return: Ndata x Ninterpolate array containing the interpolated values
+    :rtype: array
+    """
+    packed, offsets, first, length, shape = compactgrid
+
+    coord = get_coordinates(p, axis_values)
+
+    index, weight = cell_corners(coord, shape[:-1])
+
+    track, pos = np.divmod(index, shape[-2])
+    k = pos - first.ravel()[track]
+    inside = (k >= 0) & (k < length.ravel()[track])
+
+    rows = offsets.ravel()[track] + np.where(inside, k, 0)
+    if columns is None:
+        corner_values = packed[rows]
+    else:
+        corner_values = packed[rows[..., None], np.asarray(columns)]
+    corner_values = np.where(inside[..., None], corner_values, np.inf)
+
+    values = np.einsum('cn,cnv->nv', weight, corner_values)
+
+    return values.T
+
+
+def expand_compactgrid(compactgrid, variables=None):
+    """
+    Expands a grid prepared by create_compactgrid() to the equivalent pixelgrid
+    as made by create_pixeltypegrid(), optionally only for the variables with
+    the given column indices.
+
+    :param compactgrid: output from create_compactgrid
+    :type compactgrid: CompactGrid
+    :param variables: indices of the variables to include (default all)
+    :type variables: list
+
+    :return: pixelgrid
+    :rtype: array
+    """
+    packed, offsets, first, length, shape = compactgrid
+
+    if variables is None:
+        variables = range(shape[-1])
+    variables = list(variables)
+
+    pixelgrid = np.full(shape[:-1] + (len(variables),), np.inf, dtype=packed.dtype)
+
+    for track in np.ndindex(*shape[:-2]):
+        n = length[track]
+        if n == 0:
+            continue
+        rows = packed[offsets[track]:offsets[track] + n]
+        pixelgrid[track + (slice(first[track], first[track] + n),)] = rows[:, variables]
+
+    return pixelgrid
+
+
+def slice_compactgrid(compactgrid, index):
+    """
+    Slices a grid prepared by create_compactgrid() in the same way as
+    pixelgrid[index] slices the equivalent pixelgrid, for an index with one
+    slice with step 1 for every parameter axis.
+
+    The packed array is shared with the original grid and not copied. Only
+    the offsets, first and length of the tracks within the index are taken,
+    and the points of every track are clipped to the range of the last axis.
+
+    :param compactgrid: output from create_compactgrid
+    :type compactgrid: CompactGrid
+    :param index: one slice per parameter axis
+    :type index: tuple of slices
+
+    :return: the sliced compact grid
+    :rtype: CompactGrid
+    """
+    packed, offsets, first, length, shape = compactgrid
+
+    tracks = tuple(index[:-1])
+    offsets, first, length = offsets[tracks], first[tracks], length[tracks]
+
+    start, stop, step = index[-1].indices(shape[-2])
+    low = np.maximum(first, start)
+    high = np.minimum(first + length, stop)
+
+    # tracks without points inside the range become missing tracks
+    length = np.maximum(high - low, 0)
+    offsets = offsets + np.where(length > 0, low - first, 0)
+    first = np.where(length > 0, low - start, 0)
+
+    shape = tuple([len(range(*s.indices(n))) for s, n in zip(index, shape[:-1])]) + (shape[-1],)
+
+    return CompactGrid(packed, offsets, first, length, shape)
+
+
+def valid_cells(pixelgrid):
+    """
+    Determines which grid cells can be interpolated in, for a grid prepared by
+    create_pixeltypegrid() or create_compactgrid().
+
+    A cell is valid when none of its 2^Npar corners is missing from the grid.
+    When a corner is missing (+inf), interpolate() and interpolate_linear()
+    return a non finite value anywhere in the cell, even if that corner has
+    zero weight. The result can be used with in_grid() to reject points before
+    interpolating them.
+
+    :param pixelgrid: output from create_pixeltypegrid or create_compactgrid
+    :type pixelgrid: array or CompactGrid
+
+    :return: boolean array with one element per cell. Along every axis there
+             is one cell less than there are axis values, or one cell for an
+             axis with a single value.
+    :rtype: array
+    """
+    if isinstance(pixelgrid, CompactGrid):
+        packed, offsets, first, length, shape = pixelgrid
+        pos = np.arange(shape[-2])
+        valid = (pos >= first[..., None]) & (pos < (first + length)[..., None])
+    else:
+        # missing grid points are +inf in all variables, so the first one is enough
+        valid = pixelgrid[..., 0] != np.inf
+
+    for axis in range(valid.ndim):
+        if valid.shape[axis] > 1:
+            lower = [slice(None)] * valid.ndim
+            upper = [slice(None)] * valid.ndim
+            lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+            valid = valid[tuple(lower)] & valid[tuple(upper)]
+
+    return valid
+
+
+def in_grid(p, axis_values, valid):
+    """
+    Checks if points can be interpolated, using the valid cells of the grid
+    determined by valid_cells(). The cell of every point is the same one that
+    interpolate_linear() uses, so a point is in the grid when its interpolated
+    values are finite (for grids without non finite data). Only the index of
+    the cell is needed, which is found with one searchsorted per axis.
+
+    :param p: Npar x Ninterpolate array containing the points
+    :type p: array
+    :param axis_values: output from create_pixeltypegrid
+    :type axis_values: array
+    :param valid: output from valid_cells
+    :type valid: array
+
+    :return: boolean array, True for every point that is in the grid
+    :rtype: array
+    """
+    # -- the number of inner axis values at or below a value is the index of
+    #   its cell, clipped to the first and last cell like in cell_corners(). A
+    #   point on a grid point belongs to the cell above it, like in get_coordinates()
+    lower = tuple(np.searchsorted(av_[1:-1], np.asarray(val, dtype=av_.dtype), side='right')
+                  for av_, val in zip(axis_values, p))
+
+    return valid[lower]
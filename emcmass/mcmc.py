@@ -1,15 +1,28 @@
+import os
+import time
+import struct
+import threading
+import contextlib
+import concurrent.futures
 
 import numpy as np
-from numpy.lib.recfunctions import merge_arrays
 
-import emcee
+from emcmass import models, interpol
 
-from emcmass import models
+# -- minimum number of walkers per thread when a batch of walkers is split,
+#   see threaded(). Every call of lnlike has a fixed cost of about 100 us that
+#   holds the GIL, against less than 1 us per walker in numpy routines that
+#   release it, so smaller parts would make the likelihood slower.
+thread_batchsize = 256
+
+# -- error raised when no samples were accepted after the burn-in
+no_samples_message = ("None of the walkers was accepted after the burn-in, so there are no samples. "
+                      "Check if the observations can be matched by the models within the limits.")
 
 
 #{ Define the probability funtions
 
-def lnlike(theta, y, yerr, **kwargs):
+def lnlike(theta, y, yerr, grid=None, **kwargs):
     """
     log likelihood function
 
@@ -26,32 +39,49 @@ def lnlike(theta, y, yerr, **kwargs):
 
     :math:`\chi^2 = \sum (model(theta) - y)^2 / yerr^2`
 
+    Only the observed variables, which are the first variables of the grid, are
+    interpolated. The other quantities of the models are derived from the
+    final chain by :py:func:`interpolate_samples`.
+
+    theta can also be a 2D array of shape (nwalkers, ndim), in which case the
+    synthetic values for all walkers are obtained in one interpolation call and
+    an array of log likelihoods is returned.
+
     :param theta: list of model parameters (normaly mass, fe/h and age)
     :type theta: list
     :param y: 1D array of observables
     :type y: array
     :param yerr: 1D array containing errors on every observable
     :type yerr: array
+    :param grid: the grid to interpolate in, by default models.defaults
+    :type grid: models.Grid
 
     :return: logarithm of the likelihood of the model parameters (theta) given
              the observables (y) with errors (yerr)
     :rtype: float
     """
 
-    # synthetic parameters
-    y_syn = models.interpolate(*theta)
+    columns = np.arange(y.shape[0])
+
+    if np.ndim(theta) == 2:
+        # synthetic parameters for all walkers at once
+        y_syn = models.interpolate(*np.transpose(theta), columns=columns, grid=grid).T
+
+        chi2 = np.sum((y_syn - y)**2 / yerr**2, axis=1)
 
-    blobs = y_syn
-    y_syn = y_syn[:y.shape[0]]
+        return -chi2/2.
+
+    # synthetic parameters
+    y_syn = models.interpolate(*theta, columns=columns, grid=grid)
 
     # chi squared between model and observations
     chi2 = np.sum((y_syn - y)**2 / yerr**2)
 
     # log of the probability from the chi2
-    return -chi2/2., blobs
+    return -chi2/2.
 
 
-def lnprior(theta, limits, **kwargs):
+def lnprior(theta, limits, grid=None, **kwargs):
     """
     Simple uniform (flat) prior on all three parameters if they
     are within their range
@@ -59,29 +89,55 @@ def lnprior(theta, limits, **kwargs):
     if all parameters are within the provided limits, the the returned
     log probability is 0, otherwise it is -inf.
 
+    If a grid is given, parameters within the limits where the models are not
+    defined, like phases beyond the end of the evolution tracks, also get -inf.
+    This is checked with :py:meth:`models.Grid.contains` without interpolating,
+    and gives the same result as the non finite likelihood of these parameters.
+    A grid given as a plain tuple is not checked, as converting it to a
+    :py:class:`models.Grid` on every call costs more than the check saves.
+
+    When theta is a 2D array of shape (nwalkers, ndim), an array with the log
+    prior of every walker is returned.
+
     :param theta: list of model parameters
     :type theta: list
     :param limits: limits on the model parameters
     :type limits: list of tuples
+    :param grid: the grid the models are interpolated in
+    :type grid: models.Grid
 
     :return: logarithm of the probability of the parameters (theta) given the
              model limits
     :rtype: float
     """
 
+    if not isinstance(grid, models.Grid):
+        grid = None
+
+    if np.ndim(theta) == 2:
+        limits = np.asarray(limits, dtype=float)
+        inside = np.all((theta >= limits[:, 0]) & (theta <= limits[:, 1]), axis=1)
+        if grid is not None:
+            inside &= grid.contains(*np.asarray(theta, dtype=float).T)
+        return np.where(inside, 0., -np.inf)
+
     for val, lim in zip(theta, limits):
         if val < lim[0] or val > lim[1]:
             return -np.inf
 
+    if grid is not None and not grid.contains(*theta):
+        return -np.inf
+
     return 0
 
 
-def lnprob(theta, y, yerr, limits, **kwargs):
+def lnprob(theta, y, yerr, limits, grid=None, stats=None, **kwargs):
     """
     full log probability function combining the prior and the likelihood
 
     will return -inf if any of :py:func:`lnprior` or :py:func:`lnlikelyhood` is
-    infite, otherwise it will return the sum of both functions.
+    infite, otherwise it will return the sum of both functions. Parameters
+    outside the grid are rejected by the prior, without interpolating.
 
     :param theta: list of model parameters (normaly mass, fe/h and age)
     :type theta: list
@@ -91,26 +147,774 @@ def lnprob(theta, y, yerr, limits, **kwargs):
     :type yerr: array
     :param limits: limits on the model parameters
     :type limits: list of tuples
+    :param grid: the grid to interpolate in, by default models.defaults
+    :type grid: models.Grid
+    :param stats: counters and timers to update
+    :type stats: RunStats
 
     :return: the sum of the log prior and log likelihood
     :rtype: float
     """
-    lp = lnprior(theta, limits)
+    if np.ndim(theta) == 2:
+        return lnprob_vectorized(theta, y, yerr, limits, grid=grid, stats=stats, **kwargs)
+
+    if stats is not None:
+        stats.count('lnprob_calls')
+        stats.count('walkers')
+
+    grid = models.defaults if grid is None else grid
+
+    lp = lnprior(theta, limits, grid=grid)
     if not np.isfinite(lp):
-        return -np.inf, np.zeros(len(models.defaults[2]))
+        if stats is not None:
+            stats.count('prior_rejections')
+        return -np.inf
+
+    if stats is None:
+        ll = lnlike(theta, y, yerr, grid=grid)
+    else:
+        with stats.timer('interpolation'):
+            ll = lnlike(theta, y, yerr, grid=grid)
+        stats.count('interpolation_calls')
+        stats.count('interpolated_points')
 
-    ll, blobs = lnlike(theta, y, yerr)
     if not np.isfinite(ll):
-        return -np.inf, np.zeros(len(models.defaults[2]))
+        if stats is not None:
+            stats.count('model_rejections')
+        return -np.inf
+
+    return lp + ll
+
+
+def lnprob_vectorized(theta, y, yerr, limits, grid=None, stats=None, executor=None, nthreads=1, **kwargs):
+    """
+    Vectorized version of :py:func:`lnprob` to be used with an
+    emcee.EnsembleSampler created with vectorize=True.
+
+    All walkers that pass the prior are interpolated in one call to
+    :py:func:`lnlike`. Like in :py:func:`lnprob`, walkers outside the limits
+    or outside the grid are rejected by the prior and not interpolated at all.
+
+    If a thread pool executor is given, large batches of walkers that pass the
+    prior are split in up to nthreads parts of at least thread_batchsize
+    walkers that are interpolated concurrently (see :py:func:`threaded`). All
+    threads share the same grid without copying it.
+
+    :param theta: 2D array of model parameters with shape (nwalkers, ndim)
+    :type theta: array
+    :param y: 1D array of observables
+    :type y: array
+    :param yerr: 1D array containing errors on every observable
+    :type yerr: array
+    :param limits: limits on the model parameters
+    :type limits: list of tuples
+    :param grid: the grid to interpolate in, by default models.defaults
+    :type grid: models.Grid
+    :param stats: counters and timers to update
+    :type stats: RunStats
+    :param executor: thread pool to interpolate the walkers with
+    :type executor: concurrent.futures.ThreadPoolExecutor
+    :param nthreads: number of threads of the executor
+    :type nthreads: int
+
+    :return: array with the log probability of every walker
+    :rtype: array
+    """
+    theta = np.asarray(theta, dtype=float)
+    grid = models.defaults if grid is None else grid
+
+    lp = lnprior(theta, limits, grid=grid)
+
+    inside = np.isfinite(lp)
+    ninside = np.count_nonzero(inside)
+
+    def like(t):
+        return lnlike(t, y, yerr, grid=grid)
+
+    if ninside > 0:
+        if stats is None:
+            lp[inside] += threaded(like, theta[inside], executor, nthreads, minsize=thread_batchsize)
+        else:
+            with stats.timer('interpolation'):
+                lp[inside] += threaded(like, theta[inside], executor, nthreads, minsize=thread_batchsize)
+            stats.count('interpolation_calls')
+            stats.count('interpolated_points', ninside)
+
+    # -- non finite models are rejected like in lnprob
+    finite = np.isfinite(lp)
+    lp[~finite] = -np.inf
+
+    if stats is not None:
+        stats.count('lnprob_calls')
+        stats.count('walkers', len(lp))
+        stats.count('prior_rejections', len(lp) - ninside)
+        stats.count('model_rejections', ninside - np.count_nonzero(finite))
+
+    return lp
+
+
+def threaded(func, values, executor=None, nthreads=1, minsize=1):
+    """
+    Applies a vectorized function to an array, split in up to nthreads parts
+    of at least minsize values along the first axis, that are processed
+    concurrently by the executor. The interpolation runs in numpy routines
+    that release the GIL (searchsorted, take, einsum and the ufuncs), so the
+    parts are evaluated in parallel.
+
+    :param func: function that takes and returns an array of the same length
+    :type func: callable
+    :param values: array to apply the function to
+    :type values: array
+    :param executor: thread pool, if None the function is called directly
+    :type executor: concurrent.futures.ThreadPoolExecutor
+    :param nthreads: number of threads of the executor
+    :type nthreads: int
+    :param minsize: minimum number of values per part
+    :type minsize: int
+
+    :return: the concatenated results of func
+    :rtype: array
+    """
+    if executor is None or min(nthreads, len(values) // minsize) < 2:
+        return func(values)
+
+    parts = np.array_split(values, min(nthreads, len(values) // minsize))
+
+    return np.concatenate(list(executor.map(func, parts)))
+
+
+@contextlib.contextmanager
+def thread_pool(nthreads):
+    """
+    Yields a thread pool executor with nthreads threads, or None when nthreads
+    is None or 1. The pool is shut down when the context is left, also after
+    an error.
+    """
+    if nthreads is None or nthreads < 2:
+        yield None
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(nthreads)
+    try:
+        yield executor
+    finally:
+        executor.shutdown()
+
+#}
+
+#{ Streaming chain storage
+
+class ChainWriter(object):
+    """
+    Writes the samples of a chain to a .npy file in blocks, so that the chain
+    never has to be kept in memory. Rows are appended to a temporary file that
+    starts with space for the .npy header. The header is filled in when the
+    writer is closed and the final number of samples is known, after which the
+    file is renamed. It can then be memory mapped with
+    np.load(filename, mmap_mode='r').
+
+    :param filename: path of the .npy file to write
+    :type filename: str
+    :param ncols: number of columns of every row
+    :type ncols: int
+    :param nrows: continue an unfinished file after its first nrows rows,
+                  for example when resuming from a checkpoint
+    :type nrows: int
+    """
+
+    # -- size in bytes of the .npy header at the start of the file, a multiple
+    #   of 64 that fits the header of any number of rows
+    header_size = 128
+
+    def __init__(self, filename, ncols, nrows=None):
+        self.filename = filename
+        self.ncols = ncols
+
+        if nrows is None:
+            self.nrows = 0
+            self.ofile = open(filename + '.part', 'wb')
+            self.ofile.write(self.header())
+        else:
+            # -- rows written after the checkpoint are discarded
+            self.nrows = nrows
+            self.ofile = open(filename + '.part', 'r+b')
+            self.ofile.truncate(self.header_size + nrows * ncols * np.dtype(np.float64).itemsize)
+            self.ofile.seek(0, os.SEEK_END)
+
+    def header(self):
+        """
+        Returns the .npy header (format version 1.0) for the rows written so far
+        """
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({}, {}), }}".format(
+            np.lib.format.dtype_to_descr(np.dtype(np.float64)), self.nrows, self.ncols)
+        header = header.ljust(self.header_size - 11) + '\n'
+
+        return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    def append(self, values):
+        """
+        Appends a 2D array (#rows, #columns) of samples to the file
+        """
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        self.ofile.write(values.tobytes())
+        self.nrows += len(values)
+
+    def flush(self):
+        """
+        Makes sure that all appended rows are written to disk
+        """
+        self.ofile.flush()
+        os.fsync(self.ofile.fileno())
+
+    def read(self):
+        """
+        Returns a 2D array (#rows, #columns) with all rows written so far
+        """
+        self.ofile.flush()
+        data = np.fromfile(self.filename + '.part', dtype=np.float64, offset=self.header_size)
+
+        return data[:self.nrows * self.ncols].reshape(self.nrows, self.ncols)
+
+    def close(self):
+        """
+        Writes the .npy file and returns its contents as a read-only memory map
+        """
+        self.ofile.seek(0)
+        self.ofile.write(self.header())
+        self.ofile.close()
+
+        os.replace(self.filename + '.part', self.filename)
+
+        return np.load(self.filename, mmap_mode='r')
+
+    def abort(self, keep=False):
+        """
+        Closes the unfinished file without writing the .npy file. The
+        temporary file is removed, unless keep is true, for example to resume
+        from a checkpoint.
+        """
+        self.ofile.close()
+
+        if not keep:
+            os.remove(self.filename + '.part')
+
+#}
+
+#{ Checkpoints
+
+def save_checkpoint(filename, state, iteration, iterations=-1, **kwargs):
+    """
+    Saves the state of the sampler after the given number of iterations to a
+    .npz file: the walker positions, their log probabilities and the state of
+    the random number generator, together with any other arrays given as
+    keyword arguments. The file is replaced atomically, so that an interrupted
+    save never destroys the previous checkpoint.
+
+    :param filename: path of the checkpoint file
+    :type filename: str
+    :param state: the state of the sampler as yielded by emcee.EnsembleSampler.sample
+    :type state: emcee.State
+    :param iteration: number of steps taken by every walker
+    :type iteration: int
+    :param iterations: total number of steps of the run, checked when resuming
+    :type iterations: int
+    """
+
+    name, keys, pos, has_gauss, cached_gaussian = state.random_state
+
+    with open(filename + '.tmp', 'wb') as ofile:
+        np.savez(ofile, coords=state.coords, log_prob=state.log_prob, iteration=iteration,
+                 iterations=iterations, rng_name=name, rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss,
+                 rng_cached_gaussian=cached_gaussian, **kwargs)
+
+    os.replace(filename + '.tmp', filename)
+
+
+def load_checkpoint(filename, nwalkers=None, ndim=None, iterations=None):
+    """
+    Loads a checkpoint written by :py:func:`save_checkpoint`.
+
+    When nwalkers, ndim or iterations are given, they are compared with those
+    of the run that wrote the checkpoint, as continuing a different run would
+    silently give a wrong chain.
+
+    :param filename: path of the checkpoint file
+    :type filename: str
+    :param nwalkers: expected number of walkers
+    :type nwalkers: int
+    :param ndim: expected number of parameters
+    :type ndim: int
+    :param iterations: expected total number of steps of the run
+    :type iterations: int
+
+    :raises ValueError: if the checkpoint was written by a different run
+
+    :return: the emcee.State to continue sampling from, the number of steps
+             taken and a dictionary with the other saved arrays
+    :rtype: tuple
+    """
+
+    import emcee
+
+    with np.load(filename) as data:
+        data = dict(data)
+
+    found = dict(nwalkers=data['coords'].shape[0], ndim=data['coords'].shape[1],
+                 iterations=int(data.pop('iterations')))
+    expected = dict(nwalkers=nwalkers, ndim=ndim, iterations=iterations)
+
+    different = ["{} = {} instead of {}".format(key, found[key], expected[key])
+                 for key in ['nwalkers', 'ndim', 'iterations']
+                 if expected[key] is not None and found[key] != expected[key]]
+    if different:
+        raise ValueError("The checkpoint {} was written by a different run ({}). Use the same settings "
+                         "or remove the checkpoint.".format(filename, ", ".join(different)))
+
+    random_state = (str(data.pop('rng_name')), data.pop('rng_keys'), int(data.pop('rng_pos')),
+                    int(data.pop('rng_has_gauss')), float(data.pop('rng_cached_gaussian')))
+
+    state = emcee.State(data.pop('coords'), log_prob=data.pop('log_prob'), random_state=random_state)
+    iteration = int(data.pop('iteration'))
+
+    return state, iteration, data
+
+
+def autocorr_converged(chain, tau_old=None, ntau=50, tau_tol=0.01):
+    """
+    Checks if a chain has converged using its integrated autocorrelation time
+    tau, as estimated by emcee. The chain has converged when it is longer than
+    ntau times tau for every parameter, and tau changed less than the relative
+    tolerance tau_tol since the previous estimate tau_old.
+
+    :param chain: array (#steps, #walkers, #parameters) without the burn-in
+    :type chain: array
+    :param tau_old: the previous estimate of tau
+    :type tau_old: array
+    :param ntau: minimum length of the chain in units of tau
+    :type ntau: float
+    :param tau_tol: maximum relative change of tau
+    :type tau_tol: float
+
+    :return: if the chain converged, and the autocorrelation time of every parameter
+    :rtype: tuple
+    """
+
+    import emcee
+
+    # -- tol=0 skips emcee's own check on the length of the chain
+    tau = emcee.autocorr.integrated_time(chain, tol=0)
+
+    converged = np.all(ntau * tau < len(chain))
+    if tau_old is None:
+        converged = False
+    else:
+        converged &= np.all(np.abs(tau_old - tau) / tau < tau_tol)
+
+    return bool(converged), tau
+
+
+def run_sampler(sampler, pos, iterations, checkpoint=None, checkpoint_every=100, resume=False,
+                converge=False, check_every=100, ntau=50, tau_tol=0.01, discard=0, stats=None,
+                verbose=True):
+    """
+    Runs the sampler for the given number of iterations and returns the whole
+    chain and log probabilities, like sampler.get_chain() and
+    sampler.get_log_prob().
+
+    If a checkpoint filename is given, the state of the sampler is saved every
+    checkpoint_every steps. The steps taken since the previous checkpoint are
+    appended to a chain file next to it (see :py:class:`ChainWriter`), so that
+    every checkpoint only writes the new steps. With resume=True and an
+    existing checkpoint, sampling continues from the checkpoint with the same
+    random state, instead of starting from pos. The checkpoint is removed when
+    all iterations are done.
+
+    With converge=True, the autocorrelation time of the chain after the first
+    discard steps is estimated every check_every steps, and sampling stops
+    early when the chain has converged (see :py:func:`autocorr_converged`).
+    Iterations is then the maximum number of steps.
+
+    :param sampler: the sampler to run
+    :type sampler: emcee.EnsembleSampler
+    :param pos: array (#walkers, #parameters) with the starting positions
+    :type pos: array
+    :param iterations: total number of steps each walker takes
+    :type iterations: int
+    :param checkpoint: path of the checkpoint file
+    :type checkpoint: str
+    :param checkpoint_every: number of steps between checkpoints
+    :type checkpoint_every: int
+    :param resume: continue from the checkpoint if it exists
+    :type resume: bool
+    :param converge: stop when the chain has converged
+    :type converge: bool
+    :param check_every: number of steps between convergence checks
+    :type check_every: int
+    :param ntau: minimum length of the chain in units of the autocorrelation time
+    :type ntau: float
+    :param tau_tol: maximum relative change of the autocorrelation time
+    :type tau_tol: float
+    :param discard: number of burn-in steps that are not used in the convergence check
+    :type discard: int
+    :param stats: counts the proposed and accepted moves of the walkers
+    :type stats: RunStats
+    :param verbose: show a progress bar while sampling
+    :type verbose: bool
+
+    :return: chain (#steps, #walkers, #parameters) and log probabilities (#steps, #walkers)
+    :rtype: tuple
+    """
+    start, state = 0, pos
+    chain, log_prob = None, None
+
+    # -- every row of the chain file holds one step: the positions and log
+    #   probabilities of all walkers
+    nwalkers, ndim = sampler.nwalkers, sampler.ndim
+    writer = None
+
+    if resume and checkpoint is not None and os.path.isfile(checkpoint):
+        state, start, data = load_checkpoint(checkpoint, nwalkers=nwalkers, ndim=ndim, iterations=iterations)
+        writer = ChainWriter(checkpoint + '.chain.npy', nwalkers * (ndim + 1), nrows=start)
+        steps = writer.read()
+        chain = steps[:, :nwalkers * ndim].reshape(start, nwalkers, ndim)
+        log_prob = steps[:, nwalkers * ndim:]
+    elif checkpoint is not None:
+        writer = ChainWriter(checkpoint + '.chain.npy', nwalkers * (ndim + 1))
+
+    def get_chain():
+        if chain is None:
+            return sampler.get_chain(), sampler.get_log_prob()
+        return np.concatenate([chain, sampler.get_chain()]), np.concatenate([log_prob, sampler.get_log_prob()])
+
+    stats = RunStats() if stats is None else stats
+    stats.step(getattr(state, 'coords', state))
+
+    tau = None
+    try:
+        for i, state in enumerate(sampler.sample(state, iterations=iterations-start, progress=verbose),
+                                  start+1):
+
+            stats.step(state.coords)
+
+            if converge and i % check_every == 0 and i > discard:
+                converged, tau = autocorr_converged(get_chain()[0][discard:], tau_old=tau, ntau=ntau,
+                                                    tau_tol=tau_tol)
+                if converged:
+                    if verbose:
+                        print("Chain converged after {} steps, tau = {}".format(i, tau))
+                    break
+
+            if checkpoint is not None and i % checkpoint_every == 0 and i < iterations:
+                # -- only the steps since the previous checkpoint are written
+                new_chain = sampler.get_chain()[writer.nrows - start:]
+                new_log_prob = sampler.get_log_prob()[writer.nrows - start:]
+                writer.append(np.hstack([new_chain.reshape(len(new_chain), -1), new_log_prob]))
+                writer.flush()
+                save_checkpoint(checkpoint, state, i, iterations=iterations)
+
+        chain, log_prob = get_chain()
+
+        # -- the checkpoint goes first, it can not be resumed without the chain file
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            os.remove(checkpoint)
+    finally:
+        # -- after an error the chain file is only kept if the run can be
+        #   resumed from the checkpoint
+        if writer is not None:
+            writer.abort(keep=os.path.isfile(checkpoint))
 
-    return lp + ll, blobs
+    # -- clear the samples to save memory
+    sampler.reset()
+
+    return chain, log_prob
+
+#}
+
+#{ Instrumentation
+
+class RunStats(object):
+    """
+    Counters and timers of one MCMC run, used to find out where the time of a
+    slow fit goes. They are updated by :py:func:`lnprob` and :py:func:`MCMC`,
+    and :py:meth:`report` summarizes them.
+
+    Counting and timing only adds a few microseconds per call of
+    :py:func:`lnprob`, which is small compared to the interpolation. It is
+    safe to update the counters from several threads.
+
+    The counters used are:
+
+      * lnprob_calls: number of calls of lnprob
+      * walkers: number of walker positions evaluated
+      * prior_rejections: positions rejected by :py:func:`lnprior` before
+        interpolating, because they are outside the limits or outside the grid
+      * model_rejections: positions where the interpolated model is not finite
+      * interpolation_calls, interpolated_points: number of calls of
+        :py:func:`lnlike` and the number of positions interpolated
+      * proposals, accepted: number of proposed and accepted moves of the
+        walkers, counted with :py:meth:`step`
+
+    The timers used are grid (preparing the grid), initialization (starting
+    positions of the walkers), sampling (running the sampler, including the
+    interpolation), interpolation, postprocessing (deriving the model
+    quantities of the chain and the best model) and total.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+        self.coords = None
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.timers[name] = self.timers.get(name, 0.) + duration
+
+    def step(self, coords):
+        """
+        Counts the proposals and accepted proposals of one step of the sampler
+        by comparing the new positions of the walkers with those of the
+        previous step. Call it with the starting positions before sampling.
+        """
+        coords = np.array(coords, dtype=float)
+
+        if self.coords is not None:
+            self.count('proposals', len(coords))
+            self.count('accepted', np.count_nonzero(np.any(coords != self.coords, axis=1)))
+
+        self.coords = coords
+
+    def report(self):
+        """
+        Returns a dictionary with all counters, the timers in seconds as
+        time_<name>, the rejection fractions and the acceptance fraction. All
+        values are python numbers, so the report can be written to json.
+
+        :return: the report
+        :rtype: dict
+        """
+        with self.lock:
+            report = dict(self.counters)
+            for name, duration in self.timers.items():
+                report['time_' + name] = duration
+
+        walkers = report.get('walkers', 0)
+        if walkers > 0:
+            report['prior_rejection_fraction'] = report.get('prior_rejections', 0) / float(walkers)
+            report['model_rejection_fraction'] = report.get('model_rejections', 0) / float(walkers)
+
+        if report.get('interpolated_points', 0) > 0:
+            report['time_per_point'] = report.get('time_interpolation', 0.) / report['interpolated_points']
+
+        if report.get('proposals', 0) > 0:
+            report['acceptance_fraction'] = report.get('accepted', 0) / float(report['proposals'])
+
+        return report
 
 #}
 
 #{ MCMC stuff
 
+def chi2_grid(y, yerr, grid):
+    """
+    Calculates the chi squared between the observables and every node of the
+    grid in one vectorized pass. The observables have to correspond with the
+    first variables of the grid, as in :py:func:`lnlike`.
+
+    :param y: 1D array of observables
+    :type y: array
+    :param yerr: 1D array containing errors on every observable
+    :type yerr: array
+    :param grid: (axis_values, pixelgrid, variables) as returned by
+                 :py:func:`models.prepare_grid`
+    :type grid: tuple
+
+    :return: chi squared with the shape of the grid parameters, nodes that are
+             not populated in the grid have a chi squared of inf or nan
+    :rtype: array
+    """
+    pixelgrid = grid[1]
+    if isinstance(pixelgrid, interpol.CompactGrid):
+        pixelgrid = interpol.expand_compactgrid(pixelgrid, variables=range(len(y)))
+
+    chi2 = np.zeros(pixelgrid.shape[:-1])
+    for i in range(len(y)):
+        chi2 += (pixelgrid[..., i] - y[i])**2 / yerr[i]**2
+
+    return chi2
+
+
+def initialize_walkers(nwalkers, y, yerr, grid, limits, max_tries=100):
+    """
+    Initializes the walkers close to the observations. The grid nodes are drawn
+    with a probability proportional to their likelihood, and every walker is
+    placed at random within half a grid step of its node. This avoids that most
+    of the burn-in is spend on finding the region of the grid that matches the
+    observations.
+
+    Walkers that end up in a cell of the grid where the models are not defined
+    (see :py:meth:`models.Grid.contains`) are drawn again.
+
+    :param nwalkers: number of walkers
+    :type nwalkers: int
+    :param y: 1D array of observables
+    :type y: array
+    :param yerr: 1D array containing errors on every observable
+    :type yerr: array
+    :param grid: (axis_values, pixelgrid, variables) as returned by
+                 :py:func:`models.prepare_grid`
+    :type grid: tuple
+    :param limits: limits on the model parameters
+    :type limits: list of tuples
+    :param max_tries: maximum number of times the walkers outside the grid are
+                      drawn again
+    :type max_tries: int
+
+    :raises ValueError: if none of the grid nodes has a finite chi squared, or
+                        not all walkers are inside the grid after max_tries
+
+    :return: array (#walkers, #parameters) with the starting positions
+    :rtype: array
+    """
+    if not isinstance(grid, models.Grid):
+        grid = models.Grid(*grid)
+    axis_values = grid[0]
+
+    chi2 = chi2_grid(y, yerr, grid)
+    shape = chi2.shape
+
+    chi2 = chi2.ravel()
+    valid = np.where(np.isfinite(chi2))[0]
+    if len(valid) == 0:
+        raise ValueError("None of the grid nodes within the limits has a finite chi2, the walkers "
+                         "can not be initialized on the grid. Use init='uniform' or check the limits.")
+
+    prob = np.exp(-(chi2[valid] - np.min(chi2[valid])) / 2.)
+    prob = prob / np.sum(prob)
+
+    steps = [np.gradient(av) if len(av) > 1 else np.zeros_like(av) for av in axis_values]
+
+    pos = np.zeros((nwalkers, len(axis_values)))
+    todo = np.arange(nwalkers)
+    for i in range(max_tries):
+        nodes = np.random.choice(valid, size=len(todo), p=prob)
+        nodes = np.unravel_index(nodes, shape)
+
+        for j, (av, step, ind, lim) in enumerate(zip(axis_values, steps, nodes, limits)):
+            p = av[ind] + np.random.uniform(-0.5, 0.5, len(todo)) * step[ind]
+            pos[todo, j] = np.clip(p, lim[0], lim[1])
+
+        # -- the neighbours of a node can be missing, so the walker can end
+        #    up in a cell where the models are not defined
+        todo = todo[~grid.contains(*pos[todo].T)]
+        if len(todo) == 0:
+            return pos
+
+    raise ValueError("{} of the {} walkers could not be placed inside the grid after {} tries. "
+                     "Use init='uniform' or check the limits.".format(len(todo), nwalkers, max_tries))
+
+
+def interpolate_samples(samples, chunksize=10000, out=None, grid=None, executor=None, nthreads=1):
+    """
+    Interpolates all variables of the grid for the given samples. This
+    is used to derive all model quantities for the final chain in a few
+    vectorized passes instead of at every step of the sampler.
+
+    :param samples: array (#samples, #parameters) with the model parameters
+    :type samples: array
+    :param chunksize: maximum number of samples interpolated at once, limits
+                      the memory used by the interpolation
+    :type chunksize: int
+    :param out: array (#samples, #variables) to store the result in
+    :type out: array
+    :param grid: the grid to interpolate in, by default models.defaults
+    :type grid: models.Grid
+    :param executor: thread pool to interpolate the chunks concurrently
+    :type executor: concurrent.futures.ThreadPoolExecutor
+    :param nthreads: number of threads of the executor
+    :type nthreads: int
+
+    :return: array (#samples, #variables) with the interpolated variables
+    :rtype: array
+    """
+    grid = models.defaults if grid is None else grid
+
+    blobs = np.zeros((len(samples), len(grid[2]))) if out is None else out
+
+    def interpolate_chunk(i):
+        blobs[i:i+chunksize] = models.interpolate(*samples[i:i+chunksize].T, grid=grid).T
+
+    if executor is None:
+        for i in range(0, len(samples), chunksize):
+            interpolate_chunk(i)
+    else:
+        # -- smaller chunks so that all threads get work, every thread writes
+        #   to its own rows of blobs
+        chunksize = max(1, min(chunksize, -(-len(samples) // nthreads)))
+        list(executor.map(interpolate_chunk, range(0, len(samples), chunksize)))
+
+    return blobs
+
+
+def get_grid(variables, limits, model='mist', cache=False, memmap=None, memcache=False):
+    """
+    Prepares the grid to fit the given observables within the limits on the
+    model parameters, with all other variables of the models included so that
+    they can be derived for the samples. The grid is not stored as the default
+    grid of the models module, pass it explicitly to :py:func:`MCMC`,
+    :py:func:`grid_posterior` or the interpolation functions.
+
+    :param variables: list of observable variables to be used in the likelihood function
+    :type variables: list
+    :param limits: list of limits on the model parameters, one (min, max) tuple
+                   per parameter, or None
+    :type limits: list of tuples
+    :param model: name of the stellar evolution models
+    :type model: str
+    :param cache: use the on-disk grid cache (see :py:func:`models.prepare_grid`)
+    :type cache: bool
+    :param memmap: filename to write the grid to, or True to map the cached grid
+                   (see :py:func:`models.prepare_grid`)
+    :type memmap: str or bool
+    :param memcache: use the in-memory grid cache (see :py:class:`models.GridCache`)
+    :type memcache: bool
+
+    :return: the prepared grid
+    :rtype: models.Grid
+    """
+    return models.prepare_grid(evolution_model=model, variables=variables, set_default=False,
+                               return_all_variables=True, cache=cache, memmap=memmap,
+                               memcache=memcache, **limit_kwargs(limits))
+
+
+def limit_kwargs(limits):
+    """
+    Converts a list of limits on the model parameters, or None, to the
+    keywords used by :py:func:`models.prepare_grid` and :py:func:`models.slice_grid`.
+    """
+    lim_kwargs = {}
+    if not limits is None:
+        for p, l in zip(models.parameters, limits):
+            lim_kwargs[p+'_lim'] = l
+
+    return lim_kwargs
+
+
 def MCMC(variables, limits, obs, obs_err,
-         model='mist', nwalkers=100, nsteps=1000, nrelax=100, a=2, **kwargs):
+         model='mist', nwalkers=100, nsteps=1000, nrelax=100, a=2, vectorize=True,
+         cache=False, memmap=None, memcache=False, verbose=True, init='uniform', chain=None,
+         chunksize=10000, checkpoint=None, checkpoint_every=100, resume=False, converge=False, check_every=100,
+         ntau=50, tau_tol=0.01, threads=None, **kwargs):
     """
     Main MCMC function
 
@@ -133,6 +937,66 @@ def MCMC(variables, limits, obs, obs_err,
     :type nsteps: int
     :param a: scaling factor for the step size (default = 2)
     :type a: int
+    :param vectorize: if true, the log probability of all walkers is calculated
+                      in one vectorized call per step (default = True)
+    :type vectorize: bool
+    :param cache: if true, the prepared grid is read from and stored in the
+                  on-disk grid cache (see :py:func:`models.prepare_grid`)
+    :type cache: bool
+    :param memmap: filename to write the prepared grid to, or True to use the
+                   grid cache. The pixelgrid is then used as a read-only memory
+                   map (see :py:func:`models.prepare_grid`)
+    :type memmap: str or bool
+    :param memcache: if true, the grid is taken from the in-memory grid cache,
+                     cut out of a cached grid with wider limits when possible
+                     (see :py:class:`models.GridCache`)
+    :type memcache: bool
+    :param verbose: print the adapted limits and show a progress bar while sampling
+    :type verbose: bool
+    :param init: how to initialize the walkers: 'uniform' over the limits, or
+                 'grid' close to the grid nodes that match the observations best
+                 (see :py:func:`initialize_walkers`)
+    :type init: str
+    :param chain: path of a .npy file to stream the chain to while sampling
+                  (see :py:func:`stream_chain`). The returned samples are then a
+                  read-only memory map of that file, and the memory used does not
+                  depend on the number of steps.
+    :type chain: str
+    :param chunksize: number of samples interpolated or written at once
+    :type chunksize: int
+    :param checkpoint: path of a file to save the state of the sampler and the
+                       chain so far to, so that an interrupted run can be resumed
+                       (see :py:func:`run_sampler`)
+    :type checkpoint: str
+    :param checkpoint_every: number of steps between checkpoints
+    :type checkpoint_every: int
+    :param resume: if true and the checkpoint exists, continue the run from the
+                   checkpoint instead of starting again
+    :type resume: bool
+    :param converge: if true, stop sampling when the chain has converged, nsteps
+                     is then the maximum number of steps. The chain converged
+                     when it is longer than ntau times the autocorrelation time
+                     tau, and tau changed less than tau_tol between two checks.
+                     The final tau of every parameter is returned in the
+                     results as 'tau'.
+    :type converge: bool
+    :param check_every: number of steps between convergence checks
+    :type check_every: int
+    :param ntau: minimum length of the chain in units of the autocorrelation time
+    :type ntau: float
+    :param tau_tol: maximum relative change of the autocorrelation time
+    :type tau_tol: float
+    :param grid: a prepared grid to use instead of preparing one, for example a
+                 grid without limits that is reused for many fits. It is
+                 sliced to the limits without copying (see :py:func:`models.slice_grid`)
+    :type grid: models.Grid
+    :param threads: number of threads used to derive the model quantities of
+                    the chain, and to evaluate the likelihood of batches of at
+                    least 2 * thread_batchsize walkers (emcee evaluates half
+                    of the walkers at once, so with 1024 or more walkers).
+                    The threads share one copy of the grid. Only used with
+                    vectorize=True.
+    :type threads: int
     :param percentiles: the percentiles used to calculate the final values and uncertainties
                         used as argument for np.percentile()
     :type percentiles: list
@@ -142,79 +1006,558 @@ def MCMC(variables, limits, obs, obs_err,
     :returns: array (#parameters, #walkers * #steps) -- all samples taken by each walker.
     """
 
-    # -- convert limits to keyword arguments for prepare_grid
-    lim_kwargs = {}
-    if not limits is None:
-        for p, l in zip(models.parameters, limits):
-            lim_kwargs[p+'_lim'] = l
+    # -- check the options before any work is done
+    if converge and chain is not None:
+        raise ValueError("Stopping at convergence needs the chain in memory, it can not be "
+                         "combined with streaming the chain to a file")
+    if threads is not None and threads > 1 and not vectorize:
+        raise ValueError("Threads evaluate batches of walkers, they can only be used with vectorize=True")
 
-    if 'grid' in kwargs:
-        grid = kwargs.pop('grid')
-    else:
-        grid = models.prepare_grid(evolution_model=model, variables=variables,
-                                   set_default=True, return_all_variables=True, **lim_kwargs)
+    start = time.perf_counter()
+    stats = RunStats()
 
-    # -- set this grid as the default one
-    models.defaults=grid
+    # -- the grid is passed explicitly to all functions, models.defaults is
+    #   not used or changed. A given grid is sliced to the limits, which does
+    #   not copy it.
+    grid = kwargs.pop('grid', None)
+    with stats.timer('grid'):
+        if grid is None:
+            grid = get_grid(variables, limits, model=model, cache=cache, memmap=memmap, memcache=memcache)
+        else:
+            grid = models.slice_grid(grid, models.parameters, **limit_kwargs(limits))
 
     # -- It is possible that the grid point do not directly correspond with
     #   the given limits. to avoid out of grid errors, we adapt the limits
     #   to the real grid points.
     limits = [(np.min(n),np.max(n)) for n in grid[0]]
-    print("New limits to match up with grid points:")
-    print(limits)
+    if verbose:
+        print("New limits to match up with grid points:")
+        print(limits)
 
     # -- initialize the walkers
     #   Here we initialize them at random within the allowed ranges
     #   But we take random ages in yrs instead of in log(yrs) to prevent oversampling
     #   young stars
-    pos = [np.random.uniform(lim[0], lim[1], nwalkers) for lim in limits]
-    if 'log_Age' in models.parameters:
-        i = models.parameters.index('log_Age')
-        a1, a2 = limits[i]
-        pos[i] = np.log10(np.random.uniform(10**a1, 10**a2, nwalkers))
-    pos = np.array(pos).T
+    #   With init='grid' they are started close to the best matching grid nodes.
+    with stats.timer('initialization'):
+        if init == 'grid':
+            pos = initialize_walkers(nwalkers, obs, obs_err, grid, limits)
+        else:
+            pos = [np.random.uniform(lim[0], lim[1], nwalkers) for lim in limits]
+            if 'log_Age' in models.parameters:
+                i = models.parameters.index('log_Age')
+                a1, a2 = limits[i]
+                pos[i] = np.log10(np.random.uniform(10**a1, 10**a2, nwalkers))
+            pos = np.array(pos).T
 
     # -- setup the sampler
+    import emcee
+
     ndim = len(models.parameters)
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, a=a, args=(obs, obs_err, limits))
 
-    sampler.run_mcmc(pos, nsteps+nrelax, progress=True)
+    # -- the thread pool is shut down when the run is done or fails
+    with thread_pool(threads) as executor:
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, a=a, args=(obs, obs_err, limits),
+                                        kwargs=dict(grid=grid, stats=stats, executor=executor,
+                                                    nthreads=threads), vectorize=vectorize)
 
-    samples = sampler.get_chain(discard=nrelax, thin=1, flat=True)
-    blobs = sampler.get_blobs(discard=nrelax, thin=1, flat=True)
-    probabilities = sampler.get_log_prob(discard=nrelax, thin=1, flat=True)
+        names = list(models.parameters) + list(grid[2])
 
-    # -- clear the samples to save memory
-    sampler.reset()
+        if chain is not None:
+            # -- the model quantities are derived while sampling, their time is
+            #   included in the sampling time and also reported as postprocessing
+            with stats.timer('sampling'):
+                data, best = stream_chain(sampler, pos, nsteps, nrelax, chain, chunksize=chunksize,
+                                          checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                                          resume=resume, grid=grid, stats=stats, verbose=verbose,
+                                          executor=executor, nthreads=threads)
+            data = models.to_recarray(data, names)
+
+            results = {}
+            for n, v in zip(names, best):
+                results[n] = v
+
+            stats.timers['total'] = time.perf_counter() - start
+            results['stats'] = stats.report()
+
+            return results, data
+
+        with stats.timer('sampling'):
+            samples, probabilities = run_sampler(sampler, pos, nsteps+nrelax, checkpoint=checkpoint,
+                                                 checkpoint_every=checkpoint_every, resume=resume,
+                                                 converge=converge, check_every=check_every, ntau=ntau,
+                                                 tau_tol=tau_tol, discard=nrelax, stats=stats,
+                                                 verbose=verbose)
+
+        with stats.timer('postprocessing'):
+            if converge:
+                tau = emcee.autocorr.integrated_time(samples[nrelax:], tol=0)
+
+            # -- discard the burn-in and flatten the chain
+            samples = samples[nrelax:].reshape(-1, ndim)
+            probabilities = probabilities[nrelax:].ravel()
+
+            # -- remove all steps that are not accepted (lnprob == -inf)
+            accept = np.where(np.isfinite(probabilities))
+            samples = samples[accept]
+            probabilities = probabilities[accept]
+
+            if len(samples) == 0:
+                raise ValueError(no_samples_message)
+
+            # -- derive all model quantities for the accepted samples and store them
+            #   next to the parameters in one array, which is then viewed as a recarray
+            #   without copying
+            data = np.empty((len(samples), len(names)))
+            data[:, :ndim] = samples
+            interpolate_samples(samples, out=data[:, ndim:], grid=grid, executor=executor, nthreads=threads)
+
+            data = models.to_recarray(data, names)
+
+            # -- select best model
+            best = np.where(probabilities == np.max(probabilities))
+
+            results = {}
+            for n, v in zip(data.dtype.names, data[best][0]):
+                results[n] = v
+
+        if converge:
+            results['tau'] = tau
+
+        stats.timers['total'] = time.perf_counter() - start
+        results['stats'] = stats.report()
+
+        return results, data
+
+
+def stream_chain(sampler, pos, nsteps, nrelax, filename, chunksize=10000, checkpoint=None,
+                 checkpoint_every=100, resume=False, grid=None, stats=None, verbose=True,
+                 executor=None, nthreads=1):
+    """
+    Runs the sampler without storing the chain in memory. The accepted samples
+    after the burn-in are collected in blocks of at most chunksize samples, the
+    model quantities of every block are derived with
+    :py:func:`interpolate_samples` and the block is appended to a .npy file
+    with a :py:class:`ChainWriter`. The best model is tracked while sampling,
+    so the memory used does not depend on the number of steps.
+
+    Checkpoints work as in :py:func:`run_sampler`, but instead of the chain
+    they store the number of samples written to the unfinished chain file.
+
+    :param sampler: the sampler to run
+    :type sampler: emcee.EnsembleSampler
+    :param pos: array (#walkers, #parameters) with the starting positions
+    :type pos: array
+    :param nsteps: number of steps each walker will take after the burn-in
+    :type nsteps: int
+    :param nrelax: number of burn-in steps that are not stored
+    :type nrelax: int
+    :param filename: path of the .npy file to write the chain to
+    :type filename: str
+    :param chunksize: number of samples kept in memory before they are written
+    :type chunksize: int
+    :param checkpoint: path of the checkpoint file
+    :type checkpoint: str
+    :param checkpoint_every: number of steps between checkpoints
+    :type checkpoint_every: int
+    :param resume: continue from the checkpoint if it exists
+    :type resume: bool
+    :param grid: the grid to derive the model quantities from, by default models.defaults
+    :type grid: models.Grid
+    :param stats: counts the proposed and accepted moves of the walkers, and the
+                  time spent deriving the model quantities is added to its
+                  postprocessing timer
+    :type stats: RunStats
+    :param verbose: show a progress bar while sampling
+    :type verbose: bool
+    :param executor: thread pool to derive the model quantities with
+    :type executor: concurrent.futures.ThreadPoolExecutor
+    :param nthreads: number of threads of the executor
+    :type nthreads: int
+
+    :return: the chain as a read-only memory map (#samples, #parameters + #variables),
+             and the row of the model with the highest probability
+    :rtype: tuple
+    """
+    grid = models.defaults if grid is None else grid
+
+    ndim = sampler.ndim
+    ncols = ndim + len(grid[2])
+
+    start, state = 0, pos
+    best_lnp, best_theta = -np.inf, None
+
+    if resume and checkpoint is not None and os.path.isfile(checkpoint):
+        state, start, data = load_checkpoint(checkpoint, nwalkers=sampler.nwalkers, ndim=ndim,
+                                             iterations=nsteps+nrelax)
+        writer = ChainWriter(filename, ncols, nrows=int(data['nrows']))
+        best_lnp = float(data['best_lnp'])
+        best_theta = data['best_theta'] if np.isfinite(best_lnp) else None
+    else:
+        writer = ChainWriter(filename, ncols)
+
+    stats = RunStats() if stats is None else stats
+
+    def flush(block):
+        with stats.timer('postprocessing'):
+            samples = np.vstack(block)
+            data = np.empty((len(samples), writer.ncols))
+            data[:, :ndim] = samples
+            interpolate_samples(samples, chunksize=chunksize, out=data[:, ndim:], grid=grid,
+                                executor=executor, nthreads=nthreads)
+            writer.append(data)
+
+    try:
+        block, nblock = [], 0
 
-    # -- remove all steps that are not accepted (lnprob == -inf)
-    accept = np.where(np.isfinite(probabilities))
-    samples = samples[accept]
-    blobs = blobs[accept]
-    probabilities = probabilities[accept]
+        stats.step(getattr(state, 'coords', state))
 
-    # -- convert to recarrays
-    dtypes = [(n, 'f8') for n in models.parameters]
-    samples = np.array([tuple(s) for s in samples], dtype=dtypes)
+        for i, state in enumerate(sampler.sample(state, iterations=nsteps+nrelax-start, store=False,
+                                                 progress=verbose), start+1):
 
-    dtypes = [(n, 'f8') for n in grid[2]]
-    blobs = np.array([tuple(s) for s in blobs], dtype=dtypes)
+            stats.step(state.coords)
 
-    # -- merge all results in 1 recarray and select best model
-    data = merge_arrays((samples, blobs), asrecarray=True, flatten=True)
-    best = np.where(probabilities == np.max(probabilities))
+            if i > nrelax:
+                # -- remove all steps that are not accepted (lnprob == -inf)
+                accept = np.isfinite(state.log_prob)
+                block.append(state.coords[accept])
+                nblock += np.sum(accept)
+
+                # -- keep the first model with the highest probability like np.where
+                if np.any(accept) and np.max(state.log_prob[accept]) > best_lnp:
+                    j = np.argmax(state.log_prob[accept])
+                    best_lnp, best_theta = state.log_prob[accept][j], state.coords[accept][j]
+
+            if nblock >= chunksize:
+                flush(block)
+                block, nblock = [], 0
+
+            if checkpoint is not None and i % checkpoint_every == 0 and i < nsteps+nrelax:
+                # -- all steps so far are written to the chain before the checkpoint
+                if nblock > 0:
+                    flush(block)
+                    block, nblock = [], 0
+                writer.flush()
+                save_checkpoint(checkpoint, state, i, iterations=nsteps+nrelax, nrows=writer.nrows,
+                                best_lnp=best_lnp, best_theta=np.zeros(ndim) if best_theta is None else best_theta)
+
+        if nblock > 0:
+            flush(block)
+
+        if writer.nrows == 0:
+            raise ValueError(no_samples_message)
+
+        data = writer.close()
+    finally:
+        # -- after an error the unfinished chain is only kept if the run can
+        #   be resumed from the checkpoint
+        if not writer.ofile.closed:
+            writer.abort(keep=checkpoint is not None and os.path.isfile(checkpoint))
+
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+
+    best = np.hstack([best_theta, interpolate_samples(np.atleast_2d(best_theta), grid=grid)[0]])
+
+    return data, best
+
+
+def grid_posterior(variables, limits, obs, obs_err, model='mist', refine=1,
+                   percentiles=[16, 50, 84], cache=False, memmap=None, memcache=False, verbose=True,
+                   **kwargs):
+    """
+    Fast alternative to :py:func:`MCMC` that evaluates the posterior directly
+    on the nodes of the model grid instead of sampling it.
+
+    The chi squared of all grid nodes within the limits is calculated in one
+    vectorized pass with :py:func:`chi2_grid`. Every node is weighted with its
+    likelihood times the volume of its grid cell, which corresponds with the
+    flat prior used by :py:func:`lnprior`. The percentiles are then calculated
+    from these weights with :py:func:`calculate_percentiles`.
+
+    With refine > 1, the box of grid cells that contains all nodes with a
+    non-negligible posterior is refined by placing refine - 1 extra points
+    between every two nodes, and the variables on that subgrid are obtained
+    with :py:func:`models.interpolate`. This gives smoother percentiles for
+    well constrained stars.
+
+    :param variables: list of observable variables to be used in the likelihood function
+    :type variables: list
+    :param limits: list of limits on the model parameters. Each limit is one tuple
+                   containing (min, max)
+    :type limits: list of tuples
+    :param obs: array of the observed values for the variables
+    :type obs: np.array
+    :param obs_err: array of the errors on the observations
+    :type obs_err: np.array
+    :param model: name of the stellar evolution models
+    :type model: str
+    :param refine: number of subgrid steps per grid step, 1 uses the grid nodes
+    :type refine: int
+    :param percentiles: the percentiles used to calculate the final values and uncertainties
+    :type percentiles: list
+    :param cache: if true, the prepared grid is read from and stored in the
+                  on-disk grid cache (see :py:func:`models.prepare_grid`)
+    :type cache: bool
+    :param memmap: filename to write the prepared grid to, or True to use the
+                   grid cache (see :py:func:`models.prepare_grid`)
+    :type memmap: str or bool
+    :param memcache: if true, the grid is taken from the in-memory grid cache
+                     (see :py:class:`models.GridCache`)
+    :type memcache: bool
+    :param verbose: print the adapted limits
+    :type verbose: bool
+    :param grid: a prepared grid to use instead of preparing one, it is sliced
+                 to the limits without copying (see :py:func:`models.slice_grid`)
+    :type grid: models.Grid
+
+    :return: the results with the values of the best node, like :py:func:`MCMC`,
+             and the percentiles of every parameter and variable, like
+             :py:func:`calculate_percentiles`
+    :rtype: tuple
+    """
+
+    grid = kwargs.pop('grid', None)
+    if grid is None:
+        grid = get_grid(variables, limits, model=model, cache=cache, memmap=memmap, memcache=memcache)
+    else:
+        grid = models.slice_grid(grid, models.parameters, **limit_kwargs(limits))
+
+    axis_values, pixelgrid, names = grid
+    names = list(models.parameters) + list(names)
+    ndim = len(axis_values)
+
+    if verbose:
+        print("New limits to match up with grid points:")
+        print([(np.min(n), np.max(n)) for n in axis_values])
+
+    chi2 = chi2_grid(obs, obs_err, grid)
+
+    if refine > 1:
+        # -- refine the box of cells around all nodes with a non-negligible posterior
+        valid = np.isfinite(chi2)
+        index = np.nonzero(valid & (chi2 - np.min(chi2[valid]) < 50))
+
+        axes = []
+        for av, ind in zip(axis_values, index):
+            first, last = max(np.min(ind) - 1, 0), min(np.max(ind) + 1, len(av) - 1)
+            x = np.arange(first * refine, last * refine + 1) / float(refine)
+            axes.append(np.interp(x, np.arange(len(av)), av))
+
+        points = np.array([p.ravel() for p in np.meshgrid(*axes, indexing='ij')])
+        values = models.interpolate(*points, grid=grid)
+
+        chi2 = np.sum((values[:len(obs)].T - obs)**2 / obs_err**2, axis=1)
+    else:
+        axes = axis_values
+
+        if isinstance(pixelgrid, interpol.CompactGrid):
+            pixelgrid = interpol.expand_compactgrid(pixelgrid)
+
+        points = np.array([p.ravel() for p in np.meshgrid(*axes, indexing='ij')])
+        values = pixelgrid.reshape(-1, pixelgrid.shape[-1]).T
+        chi2 = chi2.ravel()
+
+    # -- flat prior in the parameters: weight every node with the volume of its cell
+    volume = np.ones(1)
+    for av in axes:
+        step = np.gradient(av) if len(av) > 1 else np.ones(1)
+        volume = np.multiply.outer(volume, step)
+    volume = volume.ravel()
+
+    valid = np.where(np.isfinite(chi2))[0]
+    weights = np.exp(-(chi2[valid] - np.min(chi2[valid])) / 2.) * volume[valid]
+
+    data = np.empty((len(valid), len(names)))
+    data[:, :ndim] = points[:, valid].T
+    data[:, ndim:] = values[:, valid].T
+    data = models.to_recarray(data, names)
+
+    best = np.argmin(chi2[valid])
 
     results = {}
-    for n, v in zip(data.dtype.names, data[best][0]):
+    for n, v in zip(names, data[best]):
         results[n] = v
 
-    return results, data
+    pc = calculate_percentiles(data, percentiles, weights=weights)
+
+    return results, pc
+
+
+def weighted_percentiles(x, weights, percentiles):
+    """
+    Calculates the percentiles of x where every value has the given weight.
+    The values are placed at the middle of their weight in the cumulative
+    distribution, which is interpolated linearly. With equal weights this is
+    the 'hazen' method of np.percentile.
+
+    :param x: 1D array of values
+    :type x: array
+    :param weights: 1D array with the weight of every value
+    :type weights: array
+    :param percentiles: list of percentiles between 0 and 100
+    :type percentiles: list
+
+    :return: array with the value of every percentile
+    :rtype: array
+    """
+    x = np.asarray(x)
+    if np.any(np.isnan(x)):
+        return np.full(len(percentiles), np.nan)
+
+    # -- values without weight do not contribute to the distribution
+    weights = np.asarray(weights)
+    x, weights = x[weights > 0], weights[weights > 0]
+
+    order = np.argsort(x)
+    x, weights = x[order], weights[order]
+
+    cdf = (np.cumsum(weights) - 0.5 * weights) / np.sum(weights)
 
+    return np.interp(np.asarray(percentiles) / 100., cdf, x)
+
+
+def chunked_percentiles(samples, percentiles, chunksize=100000, nbins=1024):
+    """
+    Calculates the percentiles of every field of the samples exactly like
+    np.percentile with its default linear interpolation, but only reads
+    chunksize samples at a time. The memory used does not depend on the
+    number of samples, so the samples can be a chain memory mapped from disk
+    that does not fit in memory.
+
+    The values at the ranks needed for the percentiles are found in a few
+    passes over the samples, for all fields at once. Every pass makes a
+    histogram with nbins bins of the interval that contains a rank, and
+    continues with the bin that contains it. When at most chunksize values
+    are left in the interval, they are sorted in the next pass. As every pass
+    reduces the number of values by about nbins, a chain of a billion samples
+    takes about four passes. At most chunksize values per percentile and
+    field are kept in memory.
+
+    :param samples: record array with the samples, can be a memory map
+    :type samples: array
+    :param percentiles: list of percentiles between 0 and 100
+    :type percentiles: list
+    :param chunksize: number of samples read at once
+    :type chunksize: int
+    :param nbins: number of bins of the histograms
+    :type nbins: int
+
+    :return: array (#percentiles, #fields) with the percentiles
+    :rtype: array
+    """
+    n = len(samples)
+    names = samples.dtype.names
 
-def calculate_percentiles(samples, percentiles):
+    # -- ranks of the two values that every percentile is interpolated between
+    h = np.asarray(percentiles, dtype=float) / 100. * (n - 1)
+    lower = np.floor(h).astype(int)
+    upper = np.minimum(lower + 1, n - 1)
 
-    pc = np.percentile(samples.view(np.float64).reshape(samples.shape + (-1,)), percentiles, axis=0)
+    def chunks():
+        for i in range(0, n, chunksize):
+            yield samples[i:i+chunksize]
+
+    low = dict((name, np.inf) for name in names)
+    high = dict((name, -np.inf) for name in names)
+    for chunk in chunks():
+        for name in names:
+            low[name] = np.minimum(low[name], np.min(chunk[name]))
+            high[name] = np.maximum(high[name], np.max(chunk[name]))
+
+    # -- the pending half open intervals [low, high) of every field, with the
+    #   number of values below and inside it, and the ranks of which the value
+    #   is inside it. Non finite values can not be binned, those rare fields
+    #   are left to np.percentile.
+    values, pending, direct = {}, {}, {}
+    for name in names:
+        if np.isfinite(low[name]) and np.isfinite(high[name]):
+            pending[(name, low[name], np.nextafter(high[name], np.inf))] = (0, n, set(lower) | set(upper))
+        else:
+            direct[name] = np.percentile(samples[name], percentiles)
+
+    while pending:
+        # -- an interval with a single possible value needs no pass
+        for key in list(pending):
+            name, lo, hi = key
+            if np.nextafter(lo, np.inf) >= hi:
+                values.update(((name, r), lo) for r in pending.pop(key)[2])
+
+        edges = dict((key, np.linspace(key[1], key[2], nbins + 1)) for key in pending)
+        counts = dict((key, np.zeros(nbins, dtype=int)) for key in pending)
+        selected = dict((key, []) for key in pending if pending[key][1] <= chunksize)
+
+        for chunk in chunks():
+            for key in pending:
+                name, lo, hi = key
+                v = chunk[name]
+                v = v[(v >= lo) & (v < hi)]
+                if key in selected:
+                    selected[key].append(np.array(v))
+                else:
+                    counts[key] += np.bincount(np.searchsorted(edges[key], v, side='right') - 1,
+                                               minlength=nbins)
+
+        refine = {}
+        for key, (below, count, ranks) in pending.items():
+            name = key[0]
+            if key in selected:
+                v = np.sort(np.hstack(selected[key]))
+                values.update(((name, r), v[r - below]) for r in ranks)
+                continue
+
+            # -- continue with the bin of every rank, bins of the same
+            #   interval are only refined once
+            cum = below + np.cumsum(counts[key])
+            for r in ranks:
+                b = np.searchsorted(cum, r, side='right')
+                below_ = cum[b-1] if b > 0 else below
+                key_ = (name, edges[key][b], edges[key][b+1])
+                refine.setdefault(key_, (below_, counts[key][b], set()))[2].add(r)
+
+        pending = refine
+
+    # -- interpolate between the two values like np.percentile does
+    pc = np.empty((len(percentiles), len(names)))
+    t = h - lower
+    for j, name in enumerate(names):
+        if name in direct:
+            pc[:, j] = direct[name]
+            continue
+        a = np.array([values[(name, r)] for r in lower], dtype=float)
+        b = np.array([values[(name, r)] for r in upper], dtype=float)
+        pc[:, j] = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+
+    return pc
+
+
+def calculate_percentiles(samples, percentiles, weights=None, chunksize=100000):
+    """
+    Calculates the value and lower and upper error of every field of the
+    samples from the given percentiles.
+
+    Chains with more than chunksize samples are read chunksize samples at a
+    time with :py:func:`chunked_percentiles`, so that the memory used for a
+    chain that is memory mapped from disk does not depend on its length.
+
+    If weights are given, the samples are weighted with
+    :py:func:`weighted_percentiles`, for example the grid nodes of
+    :py:func:`grid_posterior`.
+
+    :return: dictionary with [value, lower error, upper error] for every field
+    :rtype: dict
+    """
+
+    if len(samples) == 0:
+        raise ValueError(no_samples_message)
+
+    if weights is not None:
+        pc = np.array([weighted_percentiles(samples[n], weights, percentiles)
+                       for n in samples.dtype.names]).T
+    elif len(samples) > chunksize:
+        pc = chunked_percentiles(samples, percentiles, chunksize=chunksize)
+    else:
+        pc = np.array([np.percentile(samples[n], percentiles) for n in samples.dtype.names]).T
 
     results = {}
     for p, v, e1, e2 in zip(samples.dtype.names, pc[1], pc[1]-pc[0], pc[2]-pc[1]):
@@ -222,4 +1565,4 @@ def calculate_percentiles(samples, percentiles):
 
     return results
 
-#}
\ No newline at end of file
+#}
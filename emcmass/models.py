@@ -4,8 +4,12 @@ import numpy as np
 import os
 import re 
 import glob
+import json
+import bisect
+import hashlib
+import threading
 
-from astropy.io import fits
+from collections import namedtuple, OrderedDict
 
 from emcmass import interpol
 
@@ -14,6 +18,14 @@ parameters = ['mass_init', 'M_H_init', 'phase']
 
 basedir = os.path.dirname(__file__)
 
+modeldir = os.path.join(basedir, '../Models')
+
+# directory of the columnar model store created with emcmass-ingest
+storedir = os.environ.get('EMCMASS_STORE', os.path.join(modeldir, 'columnar'))
+
+# directory where prepared grids are stored when prepare_grid is called with cache=True
+cachedir = os.environ.get('EMCMASS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'emcmass'))
+
 def get_files(evolution_model):
    """
    Returns list of files belonging to the requested evolution models together
@@ -24,19 +36,17 @@ def get_files(evolution_model):
     - yapsi: Yale Potsdam Stellar Isochrones
    """
    
-   modeldir = os.path.join(basedir, '../Models')
-   
    if evolution_model == 'mist':
-      filename = 'MIST_v1.2_vvcrit0.0_feh_*.fits'
+      filename = 'MIST*_vvcrit0.0_feh_*.fits'
    
    elif evolution_model == 'yapsi':
       filename = 'YaPSI_feh_*.fits'
    
    else:
       # default to MIST if models not recognized
-      filename = 'MIST_v1.2_vvcrit0.0_feh_*.fits'
+      filename = 'MIST*_vvcrit0.0_feh_*.fits'
    
-   files = glob.glob(os.path.join(basedir, '../Models', filename))
+   files = glob.glob(os.path.join(modeldir, filename))
    
    files = sorted(files)
    
@@ -48,11 +58,208 @@ def get_files(evolution_model):
    
    return files, z
 
+def get_store(evolution_model):
+   """
+   Returns the manifest of the columnar store of the requested evolution models
+   created by :py:func:`ingest.ingest`, or None if there is no store, if it
+   is older than the fits files it was made from, or if fits files were added
+   or removed since. Without any fits files the store is always used.
+   
+   The manifest is a dictionary with the names of all 'columns' and a list of
+   'tables', one for each metallicity, with their 'name', 'M_H', 'nrows' and
+   the 'tracks' index used by :py:func:`get_row_ranges`.
+   """
+   
+   filename = os.path.join(storedir, evolution_model, 'manifest.json')
+   if not os.path.isfile(filename):
+      return None
+   
+   with open(filename) as ifile:
+      manifest = json.load(ifile)
+   
+   #-- ignore the store if fits files were added or removed after it was made
+   files, z = get_files(evolution_model)
+   files = set([os.path.relpath(f, modeldir) for f in files])
+   if files and files != set([table['source'] for table in manifest['tables']]):
+      return None
+   
+   #-- ignore the store if the fits files were changed after it was made
+   for table in manifest['tables']:
+      source = os.path.join(modeldir, table['source'])
+      if os.path.isfile(source) and os.path.getmtime(source) != table['mtime']:
+         return None
+   
+   return manifest
+
+class ColumnTable(object):
+   """
+   One table of the columnar model store. Columns are accessed by name like
+   the columns of a fits table, and are memory mapped from their .npy file the
+   first time they are used, so that only the columns that are needed are read.
+   
+   If ranges is given, the table only contains those (start, stop) row ranges
+   of the store, and only those rows are read from every column.
+   """
+   
+   def __init__(self, dirname, nrows, ranges=None):
+      self.dirname = dirname
+      self.nrows = nrows
+      self.ranges = ranges
+      self.columns = {}
+   
+   def __len__(self):
+      if self.ranges is None:
+         return self.nrows
+      return int(sum([stop - start for start, stop in self.ranges]))
+   
+   def column(self, name):
+      """
+      Returns the complete memory mapped column, ignoring the row ranges
+      """
+      if name not in self.columns:
+         self.columns[name] = np.load(os.path.join(self.dirname, name + '.npy'), mmap_mode='r')
+      return self.columns[name]
+   
+   def __getitem__(self, name):
+      column = self.column(name)
+      if self.ranges is None:
+         return column
+      if len(self.ranges) == 0:
+         return column[0:0]
+      return np.concatenate([column[start:stop] for start, stop in self.ranges])
+
+def get_row_ranges(data, tracks, mass_lim=None, phase_lim=None):
+   """
+   Returns the (start, stop) row ranges of a table of the columnar store that
+   are within the given limits on the initial mass and the phase.
+   
+   Tracks is the index of the table made by :py:func:`ingest.ingest`, a list of
+   (mass_init, start, stop) for every evolution track, which are stored as
+   consecutive rows with increasing phase. Tracks outside the mass limits are
+   skipped without reading them, for the remaining tracks only the phase
+   column of that track is searched for the rows inside the phase limits.
+   """
+   
+   ranges = []
+   for mass, start, stop in tracks:
+      
+      if mass_lim is not None and (mass < mass_lim[0] or mass > mass_lim[1]):
+         continue
+      
+      if phase_lim is not None:
+         phase = data.column('phase')[start:stop]
+         start, stop = start + np.searchsorted(phase, phase_lim[0], side='left'), \
+                       start + np.searchsorted(phase, phase_lim[1], side='right')
+      
+      if stop > start:
+         ranges.append((int(start), int(stop)))
+   
+   return ranges
+
+def convert_observables(variables, y, yerr):
+   """
+   Converts observables that are given in linear units (L, R, Teff and g) to
+   the logarithmic quantities that are available in the evolution models.
+   The variables, y and yerr arrays are updated in place and returned.
+   """
+   
+   for par in ['L', 'R', 'Teff', 'g']:
+      if par in variables:
+         i = np.where(variables == par)
+         variables[i] = 'log_'+par
+         yerr[i] = 0.43429 * yerr[i] / y[i]
+         y[i] = np.log10(y[i])
+   
+   return variables, y, yerr
+
+class Grid(namedtuple('Grid', ['axis_values', 'pixelgrid', 'variables'])):
+   """
+   A prepared model grid as returned by :py:func:`prepare_grid`. The grid is a
+   (axis_values, pixelgrid, variables) tuple, so it can be unpacked and indexed
+   like one, and it can be passed explicitly to all functions that take a grid
+   keyword instead of relying on the module wide defaults.
+   
+   A grid that was loaded from disk with :py:func:`load_grid` remembers its
+   path. It is then pickled as that path and loaded again when it is
+   unpickled, so that it can be passed to other processes without copying the
+   pixelgrid.
+   """
+   
+   path = None
+   mmap_mode = None
+   _valid_cells = None
+   _inner_axes = None
+   
+   @property
+   def valid_cells(self):
+      """
+      Boolean array with the cells of the grid that can be interpolated in,
+      see :py:func:`interpol.valid_cells`. It is determined once per grid.
+      """
+      if self._valid_cells is None:
+         self._valid_cells = interpol.valid_cells(self.pixelgrid)
+      return self._valid_cells
+   
+   def contains(self, mass, feh, phase):
+      """
+      Checks if the given parameters are inside the grid, where the
+      interpolated models are defined. This is much faster than interpolating
+      and checking if the result is finite, see :py:func:`interpol.in_grid`.
+      
+      Returns a boolean for a single point, or a boolean array when the
+      parameters are arrays.
+      """
+      p = (mass, feh, phase)
+      
+      if not (np.isscalar(mass) and np.isscalar(feh) and np.isscalar(phase)):
+         p = [np.atleast_1d(v) for v in p]
+         return interpol.in_grid(p, self.axis_values, self.valid_cells)
+      
+      #-- a single point is looked up with bisect, which is much faster than
+      #   the numpy version for one value. See interpol.in_grid for the cell index.
+      if self._inner_axes is None:
+         self._inner_axes = [(None if av.dtype == np.float64 else av.dtype.type, av[1:-1].tolist())
+                             for av in self.axis_values]
+      
+      cell = tuple(bisect.bisect_right(inner, v if to_dtype is None else float(to_dtype(v)))
+                   for (to_dtype, inner), v in zip(self._inner_axes, p))
+      return self.valid_cells[cell]
+   
+   def interpolate(self, mass, feh, phase, **kwargs):
+      """
+      Interpolates the grid at the given parameters, see :py:func:`interpolate`
+      """
+      return interpolate(mass, feh, phase, grid=self, **kwargs)
+   
+   def slice(self, **kwargs):
+      """
+      Returns the part of the grid within the given limits as a view on this
+      grid, see :py:func:`slice_grid`
+      """
+      return slice_grid(self, **kwargs)
+   
+   def track(self, mass, feh, **kwargs):
+      """
+      Returns the evolution track for the given mass and metalicity, see
+      :py:func:`get_track`
+      """
+      return get_track(mass, feh, grid=self, **kwargs)
+   
+   def __reduce__(self):
+      if self.path is None:
+         return (Grid, tuple(self))
+      return (load_grid, (self.path, self.mmap_mode))
+
 def prepare_grid(evolution_model='mist',
                  variables=['log_L', 'log_Teff', 'log_g', 'M_H'],
                  parameters=['mass_init', 'M_H_init', 'phase'],
                  set_default=True, 
                  return_all_variables=False,
+                 cache=False,
+                 memmap=None,
+                 memcache=False,
+                 compact=False,
+                 dtype=None,
                  **kwargs):
    """
    Prepares the stellar evolution models by creating a pixelgrid to be used in interpolate
@@ -63,31 +270,134 @@ def prepare_grid(evolution_model='mist',
    You can also provide limits on the size of the grid in mass, feh and age by
    setting the mass_lim, feh_lim and age_lim keywords
    
+   If cache is True, the prepared grid is stored in the directory given by
+   cachedir, and reused by later calls with the same evolution model, model
+   files, parameters, variables and limits instead of reading the fits files.
+   
+   The memmap keyword returns the pixelgrid as a read-only np.memmap, so that
+   many worker processes can share one copy of a large grid. If memmap is a
+   filename, the grid is written to that file (see :py:func:`save_grid`) and
+   mapped from there. If memmap is True, the grid is mapped from the cache.
+   
+   If memcache is True, the grid is kept in the in-memory cache of prepared
+   grids, see :py:class:`GridCache`. A later call with the same settings and
+   limits that lie within those of a cached grid is then cut out of that grid
+   instead of being prepared again.
+   
+   With compact=True the pixelgrid is replaced by the compact, float32, track
+   based representation of :py:func:`interpol.create_compactgrid`, which only
+   stores the populated range of every track. This can not be combined with
+   cache or memmap.
+   
+   The dtype keyword sets the data type of the grid values, by default float64
+   for the pixelgrid and float32 for the compact grid. A float32 pixelgrid uses
+   half the memory, use :py:func:`precision_report` to check that the loss in
+   precision is acceptable for the variables you need.
+   
    """
+   global defaults
+   
+   if compact and (cache or memmap or memcache):
+      raise ValueError("A compact grid can not be cached or memory mapped")
+   
+   if memcache:
+      key = (evolution_model, tuple(parameters), tuple(variables), bool(return_all_variables),
+             np.dtype(np.float64 if dtype is None else dtype).str, isinstance(memmap, str) or bool(memmap))
+      
+      grid = grid_cache.get(key, parameters, **kwargs)
+      if grid is None:
+         grid = prepare_grid(evolution_model=evolution_model, variables=variables,
+                             parameters=parameters, set_default=False,
+                             return_all_variables=return_all_variables, cache=cache,
+                             memmap=memmap, dtype=dtype, **kwargs)
+         grid_cache.add(key, grid, **kwargs)
+      
+      if set_default:
+         defaults = grid
+      
+      return grid
    
    files, fehs = get_files(evolution_model)
    
+   if isinstance(memmap, str):
+      grid = prepare_grid(evolution_model=evolution_model, variables=variables,
+                          parameters=parameters, set_default=False,
+                          return_all_variables=return_all_variables, cache=cache, dtype=dtype,
+                          **kwargs)
+      save_grid(memmap, grid)
+      grid = load_grid(memmap, mmap_mode='r')
+      
+      if set_default:
+         defaults = grid
+      
+      return grid
+   
+   if cache or memmap:
+      mmap_mode = 'r' if memmap else None
+      
+      key = get_cache_key(evolution_model, files, parameters, variables,
+                          return_all_variables, dtype=dtype, **kwargs)
+      grid = load_cached_grid(key, mmap_mode=mmap_mode)
+      
+      if grid is None:
+         grid = prepare_grid(evolution_model=evolution_model, variables=variables,
+                             parameters=parameters, set_default=False,
+                             return_all_variables=return_all_variables, dtype=dtype, **kwargs)
+         save_cached_grid(key, grid)
+         
+         if memmap:
+            grid = load_cached_grid(key, mmap_mode=mmap_mode)
+      
+      if set_default:
+         defaults = grid
+      
+      return grid
+   
    grid_pars = []
    grid_vars = []
    
    fehlim = kwargs.pop('M_H_lim', (-np.inf, np.inf))
    
+   #-- use the columnar store if it exists, otherwise read the fits files
+   store = get_store(evolution_model)
+   if store is not None:
+      tables = [os.path.join(storedir, evolution_model, t['name']) for t in store['tables']]
+      nrows = [t['nrows'] for t in store['tables']]
+      fehs = [t['M_H'] for t in store['tables']]
+   else:
+      from astropy.io import fits
+      tables = files
+   
    #-- get list of all availabel variables but remove the parameters
    #   and make sure that the variables are the first in the list
-   all_variables = fits.getdata(files[0]).dtype.names
+   if store is not None:
+      all_variables = store['columns']
+   else:
+      all_variables = fits.getdata(files[0]).dtype.names
    remove = np.hstack([parameters, variables])
-   all_variables = np.delete(all_variables, np.where(np.in1d(all_variables, remove)))
+   all_variables = np.delete(all_variables, np.where(np.isin(all_variables, remove)))
    
    if return_all_variables:
       variables = np.hstack([variables, all_variables])
    
    
-   for filename, z in zip(files, fehs):
+   for i, (filename, z) in enumerate(zip(tables, fehs)):
       
       #-- skip the file if it is out of metalicity range
       if z < fehlim[0] or z > fehlim[1]: continue
       
-      data = fits.getdata(filename)
+      if store is not None:
+         data = ColumnTable(filename, nrows[i])
+         
+         #-- only read the rows inside the mass and phase limits using the
+         #   track index of the store
+         tracks = store['tables'][i].get('tracks', None)
+         if tracks is not None:
+            data.ranges = get_row_ranges(data, tracks, mass_lim=kwargs.get('mass_init_lim', None),
+                                         phase_lim=kwargs.get('phase_lim', None))
+            if len(data.ranges) == 0: continue
+      else:
+         data = fits.getdata(filename)
       
       keep = np.ones(len(data),bool)
       
@@ -102,38 +412,372 @@ def prepare_grid(evolution_model='mist',
          in_range = (low<=data[key]) & (data[key]<=high)
       
          keep = keep & in_range
-      data = data[keep]
       
       #-- only keep the parameters and variables that are needed to reduce memory
-      pars_ = np.vstack([data[name] for name in parameters])
-      vars_ = np.vstack([data[name] for name in variables])
+      pars_ = np.vstack([data[name][keep] for name in parameters])
+      vars_ = np.vstack([data[name][keep] for name in variables])
       
-      if sum(keep):
+      if np.any(keep):
          grid_pars.append(pars_)
          grid_vars.append(vars_)
    
    grid_pars = np.hstack(grid_pars)
    grid_vars = np.hstack(grid_vars)
    
-   axis_values, pixelgrid = interpol.create_pixeltypegrid(grid_pars, grid_vars)
+   if compact:
+      dtype = np.float32 if dtype is None else dtype
+      axis_values, pixelgrid = interpol.create_compactgrid(grid_pars, grid_vars, dtype=dtype)
+   else:
+      dtype = np.float64 if dtype is None else dtype
+      axis_values, pixelgrid = interpol.create_pixeltypegrid(grid_pars, grid_vars, dtype=dtype)
+   
+   grid = Grid(axis_values, pixelgrid, variables)
    
    if set_default:
       #-- store the prepared pixel grid to be used by interpolation functions
-      global defaults
-      defaults = (axis_values, pixelgrid, variables)
+      defaults = grid
+   
+   return grid
+
+def get_cache_key(evolution_model, files, parameters, variables, return_all_variables,
+                  dtype=None, **kwargs):
+   """
+   Returns the key under which a grid prepared with these settings is cached.
+   The key is a hash of the evolution model, the name, size and modification
+   time of all model files, the parameters, the variables, the data type and
+   all limits.
+   """
+   
+   limits = [(key, tuple(float(v) for v in kwargs[key])) for key in sorted(kwargs) if '_lim' in key]
+   
+   filestats = [(os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)) for f in files]
+   
+   setup = (evolution_model, filestats, list(parameters), list(variables),
+            bool(return_all_variables), limits)
    
-   return axis_values, pixelgrid, variables
+   if dtype is not None and np.dtype(dtype) != np.float64:
+      setup = setup + (np.dtype(dtype).str,)
+   
+   return hashlib.sha1(repr(setup).encode('utf-8')).hexdigest()
+
+def load_grid(basename, mmap_mode=None):
+   """
+   Reads a grid written by :py:func:`save_grid` and returns it as a
+   :py:class:`Grid`, or None if there is no grid stored under basename.
+   
+   With mmap_mode='r' the pixelgrid is returned as a read-only np.memmap view on
+   basename.npy. The operating system then keeps one copy of the grid in the page
+   cache that is shared between all processes that map the same file.
+   """
+   
+   if not os.path.isfile(basename + '.npz') or not os.path.isfile(basename + '.npy'):
+      return None
+   
+   with np.load(basename + '.npz') as data:
+      variables = data['variables']
+      axis_values = [data['axis_{}'.format(i)] for i in range(len(data.files) - 1)]
+   
+   pixelgrid = np.load(basename + '.npy', mmap_mode=mmap_mode)
+   
+   grid = Grid(axis_values, pixelgrid, variables)
+   grid.path, grid.mmap_mode = basename, mmap_mode
+   
+   return grid
+
+def save_grid(basename, grid):
+   """
+   Writes a prepared (axis_values, pixelgrid, variables) grid to disk. The
+   pixelgrid is written to <basename>.npy and the axis values and variables to
+   <basename>.npz. Files are written to a temporary name first so that
+   processes running in parallel never read a half written grid.
+   """
+   
+   axis_values, pixelgrid, variables = grid
+   
+   dirname = os.path.dirname(os.path.abspath(basename))
+   if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+   
+   tmpname = basename + '.{}.tmp'.format(os.getpid())
+   
+   axes = dict(('axis_{}'.format(i), av) for i, av in enumerate(axis_values))
+   with open(tmpname, 'wb') as ofile:
+      np.savez(ofile, variables=np.asarray(variables), **axes)
+   os.replace(tmpname, basename + '.npz')
+   
+   with open(tmpname, 'wb') as ofile:
+      np.save(ofile, pixelgrid)
+   os.replace(tmpname, basename + '.npy')
+
+def load_cached_grid(key, mmap_mode=None):
+   """
+   Returns the cached (axis_values, pixelgrid, variables) stored under key,
+   or None if there is no such grid in the cache.
+   """
+   return load_grid(os.path.join(cachedir, key), mmap_mode=mmap_mode)
+
+def save_cached_grid(key, grid):
+   """
+   Stores a prepared (axis_values, pixelgrid, variables) grid in the cache
+   under key.
+   """
+   save_grid(os.path.join(cachedir, key), grid)
+
+class GridCache(object):
+   """
+   In-memory cache of prepared grids for long running processes that prepare
+   grids with many different limits, used by :py:func:`prepare_grid` when it
+   is called with memcache=True.
+   
+   Grids are stored under a key with the evolution model, parameters,
+   variables and data type, together with the limits they were prepared with.
+   A grid is returned for a request with the same key when all limits on the
+   parameters lie within those of the cached grid, and all other limits are
+   the same. If the limits are tighter, the requested grid is cut out of the
+   cached grid (see :py:func:`slice_grid`), which gives the same grid as
+   preparing it from the model files.
+   
+   When the pixelgrids of the cached grids use more than maxbytes bytes, the
+   least recently used grids are removed.
+   """
+   
+   def __init__(self, maxbytes=2**30):
+      self.maxbytes = maxbytes
+      self.grids = OrderedDict()
+      self.hits, self.misses = 0, 0
+      self.lock = threading.Lock()
+   
+   def __len__(self):
+      return len(self.grids)
+   
+   @property
+   def nbytes(self):
+      return sum(grid[1].nbytes for grid in self.grids.values())
+   
+   def clear(self):
+      with self.lock:
+         self.grids.clear()
+         self.hits, self.misses = 0, 0
+   
+   def get(self, key, parameters, **kwargs):
+      """
+      Returns the grid for the given key and limits, or None if it is not in
+      the cache.
+      """
+      limits = get_limits(kwargs)
+      
+      with self.lock:
+         if (key, limits) in self.grids:
+            self.grids.move_to_end((key, limits))
+            self.hits += 1
+            return self.grids[(key, limits)]
          
+         for (key_, limits_) in reversed(self.grids):
+            if key_ == key and contains_limits(limits_, limits, parameters):
+               self.grids.move_to_end((key_, limits_))
+               self.hits += 1
+               grid = self.grids[(key_, limits_)]
+               break
+         else:
+            self.misses += 1
+            return None
+      
+      return slice_grid(grid, parameters, **kwargs)
+   
+   def add(self, key, grid, **kwargs):
+      """
+      Adds a grid prepared with the given limits to the cache, and removes the
+      least recently used grids when the cache is too large. A grid that is
+      larger than maxbytes on its own is not stored.
+      """
+      if grid[1].nbytes > self.maxbytes:
+         return
+      
+      with self.lock:
+         self.grids[(key, get_limits(kwargs))] = grid
+         while self.nbytes > self.maxbytes:
+            self.grids.popitem(last=False)
+
+def get_limits(kwargs):
+   """
+   Returns the limits in the keyword arguments of :py:func:`prepare_grid` as
+   a sorted tuple of (name, (low, high)) items.
+   """
+   return tuple((key, tuple(float(v) for v in kwargs[key])) for key in sorted(kwargs) if '_lim' in key)
+
+def contains_limits(outer, inner, parameters):
+   """
+   Checks if a grid prepared with the outer limits contains the grid for the
+   inner limits. Limits are given as returned by :py:func:`get_limits`. The
+   limits on the parameters of the grid need to be within the outer limits,
+   all other limits need to be equal.
+   """
+   outer, inner = dict(outer), dict(inner)
+   
+   for key in set(outer) | set(inner):
+      if key[:-4] in parameters:
+         low, high = outer.get(key, (-np.inf, np.inf))
+         low_, high_ = inner.get(key, (-np.inf, np.inf))
+         if low_ < low or high_ > high:
+            return False
+      elif outer.get(key, None) != inner.get(key, None):
+         return False
+   
+   return True
+
+def slice_grid(grid, parameters=None, **kwargs):
+   """
+   Cuts the part within the given limits out of a prepared grid, without
+   preparing it again from the model files. The limits are given as keywords
+   in the same way as for :py:func:`prepare_grid`, e.g. mass_init_lim=(0.8, 1.2),
+   limits on variables that are not parameters of the grid are ignored.
+   
+   The range of every axis is found with np.searchsorted, and the axis values
+   and pixelgrid of the returned grid are views on those of the original grid,
+   so slicing does not copy any data. Axis values at the edges of the range
+   that do not have any models within the limits are removed, so the result
+   is the same as preparing the grid with these limits. Only in the rare case
+   that such an axis value lies inside the range, the grid is copied to
+   remove it.
+   
+   A compact grid is sliced with :py:func:`interpol.slice_compactgrid`, which
+   shares the packed data with the original grid in the same way.
+   
+   :param grid: the grid to slice, as returned by :py:func:`prepare_grid`
+   :type grid: Grid
+   :param parameters: the parameters of the grid axes, by default the module
+                      level parameters
+   :type parameters: list
+   
+   :return: the grid within the limits
+   :rtype: Grid
+   """
+   if parameters is None:
+      parameters = globals()['parameters']
+   
+   axis_values, pixelgrid, variables = grid
+   compact = isinstance(pixelgrid, interpol.CompactGrid)
+   
+   index = []
+   for name, values in zip(parameters, axis_values):
+      low, high = kwargs.get(name + '_lim', (-np.inf, np.inf))
+      index.append(slice(np.searchsorted(values, low, side='left'),
+                         np.searchsorted(values, high, side='right')))
+   
+   #-- remove axis values without any models within the limits. Missing models
+   #   are +inf in all variables, so it is enough to check the first one.
+   if compact:
+      populated = interpol.expand_compactgrid(interpol.slice_compactgrid(pixelgrid, index),
+                                              variables=[0])[..., 0] != np.inf
+   else:
+      populated = pixelgrid[tuple(index) + (0,)] != np.inf
+   ndim = populated.ndim
+   
+   keep = [np.any(populated, axis=tuple(j for j in range(ndim) if j != i)) for i in range(ndim)]
+   
+   if not all(np.any(k) for k in keep):
+      raise ValueError("There are no models within the limits")
+   
+   for i, k in enumerate(keep):
+      first, last = np.flatnonzero(k)[[0, -1]]
+      index[i] = slice(index[i].start + first, index[i].start + last + 1)
+      keep[i] = k[first:last+1]
+   
+   axis_values = [values[ind] for values, ind in zip(axis_values, index)]
+   if compact:
+      pixelgrid = interpol.slice_compactgrid(pixelgrid, index)
+   else:
+      pixelgrid = pixelgrid[tuple(index)]
+   
+   if not all(np.all(k) for k in keep):
+      axis_values = [values[k] for values, k in zip(axis_values, keep)]
+      if compact:
+         #-- the tracks have to be packed again without the removed points
+         expanded = interpol.expand_compactgrid(pixelgrid)[np.ix_(*keep)]
+         points = np.nonzero(expanded[..., 0] != np.inf)
+         grid_pars = np.array([values[i] for values, i in zip(axis_values, points)])
+         pixelgrid = interpol.create_compactgrid(grid_pars, expanded[points].T,
+                                                 dtype=expanded.dtype)[1]
+      else:
+         pixelgrid = pixelgrid[np.ix_(*keep)]
+   
+   return Grid(axis_values, pixelgrid, variables)
+
+#-- the in-memory grid cache used by prepare_grid, its size in bytes can be set
+#   with the EMCMASS_GRID_CACHE_SIZE environment variable
+grid_cache = GridCache(maxbytes=int(os.environ.get('EMCMASS_GRID_CACHE_SIZE', 2**30)))
+
+def precision_report(dtype=np.float32, npoints=100000, grid=None, **kwargs):
+   """
+   Reports the loss in precision when the pixelgrid is stored with a lower
+   precision data type (default float32) instead of float64.
+   
+   The grid is given with the grid keyword, or prepared by passing all other
+   keywords to :py:func:`prepare_grid`. Both versions of the grid are
+   interpolated at npoints random points within the grid, and for every
+   variable the maximum absolute and relative difference is returned. Points
+   where the interpolation is not finite are ignored.
+   
+   >>> report = precision_report(variables=['log_L', 'log_Teff'], phase_lim=(100, 400))
+   >>> report['log_Teff']
+   (4.4e-07, 1.1e-07)
+   
+   :return: dictionary with for every variable (max absolute error, max relative error)
+   :rtype: dict
+   """
+   
+   if grid is None:
+      kwargs['set_default'] = False
+      grid = prepare_grid(dtype=np.float64, **kwargs)
+   axis_values, pixelgrid, variables = grid
+   
+   pixelgrid = np.asarray(pixelgrid, dtype=np.float64)
+   lowgrid = pixelgrid.astype(dtype)
+   
+   p = np.vstack([np.random.uniform(np.min(av), np.max(av), npoints) for av in axis_values])
+   
+   values = interpol.interpolate(p.copy(), axis_values, pixelgrid)
+   lowvalues = interpol.interpolate(p.copy(), axis_values, lowgrid)
+   
+   report = {}
+   for name, v1, v2 in zip(variables, values, lowvalues):
+      finite = np.isfinite(v1) & np.isfinite(v2)
+      if not np.any(finite):
+         report[name] = (np.nan, np.nan)
+         continue
+      err = np.abs(v1[finite] - v2[finite])
+      relerr = err[v1[finite] != 0] / np.abs(v1[finite][v1[finite] != 0])
+      report[name] = (np.max(err), np.max(relerr) if len(relerr) else 0.)
+   
+   return report
+
+def to_recarray(values, names):
+   """
+   Converts a 2D float array with one column per name to a record array with
+   these names as fields. When values is a C-contiguous float64 array the
+   record array is a view on the same memory, otherwise one copy is made.
+   """
+   
+   values = np.ascontiguousarray(values, dtype=np.float64)
+   dtypes = [(str(name), 'f8') for name in names]
+   
+   return values.view(dtypes).reshape(len(values)).view(np.recarray)
 
 def interpolate(mass, feh, phase, **kwargs):
    """
    Returns the requested values from the stellar evolution grids at the given 
    values for the input parameters (mass, feh, phase)
    
+   By default all variables in the grid are returned, use the columns keyword
+   with a list of column indices to only interpolate those variables.
+   
+   The grid keyword gives the grid to interpolate in. If it is not given the
+   default grid of the module is used, see :py:func:`prepare_grid`.
+   
    """
    
    global defaults
-   if 'grid' in kwargs:
+   if kwargs.get('grid', None) is not None:
       axis_values, pixelgrid, variables = kwargs['grid']
    elif not defaults is None:
       axis_values, pixelgrid, variables = defaults
@@ -150,15 +794,24 @@ def interpolate(mass, feh, phase, **kwargs):
    
    p = np.vstack([mass, feh, phase])
    
-   values = interpol.interpolate(p, axis_values, pixelgrid)
+   #-- only interpolate the requested columns
+   columns = kwargs.get('columns', None)
+   if columns is not None:
+      variables = np.asarray(variables)[columns]
+   
+   if isinstance(pixelgrid, interpol.CompactGrid):
+      values = interpol.interpolate_compact(p, axis_values, pixelgrid, columns=columns)
+   else:
+      values = interpol.interpolate_linear(p, axis_values, pixelgrid, columns=columns)
    
    if multiple:
       values = values.flatten()
    
    #-- convert values to a recarray if that is requested
    if kwargs.get('as_recarray', False):
-      dtypes = [(name, 'f8') for name in variables]
-      values = np.array([tuple(v) for v in values.T], dtype=dtypes)
+      values = to_recarray(np.reshape(values, (len(variables), -1)).T, variables)
+      if multiple:
+         values = values[0]
       
    return values
 
@@ -213,14 +866,15 @@ def get_track(mass, feh, **kwargs):
    if 'phase' in kwargs:
       phase = kwargs.pop('phase')
       
-   if 'grid' in kwargs:
+   if kwargs.get('grid', None) is not None:
       axis_values, pixelgrid, variables = kwargs['grid']
    elif not defaults is None:
       axis_values, pixelgrid, variables = defaults
-      kwargs['grid'] = (axis_values, pixelgrid, variables)
+      kwargs['grid'] = defaults
    else:
-      axis_values, pixelgrid, variables = prepare_grid(**kwargs)
-      kwargs['grid'] = (axis_values, pixelgrid, variables)
+      kwargs.pop('grid', None)
+      kwargs['grid'] = prepare_grid(**kwargs)
+      axis_values, pixelgrid, variables = kwargs['grid']
    
    phase = sorted(set(axis_values[2])) if phase is None else phase
    
@@ -1,8 +1,13 @@
  
+import sys
+
 import numpy as np
-import pylab as pl
 import matplotlib.patches as patches
 
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from numpy.lib.recfunctions import repack_fields
+
 from emcmass import models
 
 
@@ -21,20 +26,65 @@ def get_label(par):
       return par
    
    
-def plot_fit(variables, y, yerr, samples, results):
+def new_figure(figsize=None, interactive=False):
+   """
+   Returns a new figure. Unless it is interactive, the figure is drawn by the
+   Agg backend without using pyplot, so it can be made on nodes without a
+   display and in worker processes. An interactive figure is made with pyplot
+   and shown by pyplot.show().
+   """
+   if interactive:
+      import pylab as pl
+      return pl.figure(figsize=figsize)
+   
+   fig = Figure(figsize=figsize)
+   FigureCanvasAgg(fig)
+   return fig
+   
+   
+def plot_distribution(samples, parameters=['mass_init', 'M_H_init', 'phase'], fig=None, **kwargs):
+   """
+   Corner plot of the samples of the given parameters. Other keyword
+   arguments are passed to corner.corner. Returns the figure.
+   """
+   import corner
+   
+   pars = [p for p in parameters if p in samples.dtype.names]
+   data = repack_fields(samples[pars])
+   
+   if fig is None:
+      fig = new_figure(figsize=(2.0 * len(pars) + 1.5,) * 2)
+   
+   if len(fig.axes) == 0:
+      fig.subplots(len(pars), len(pars))
+   
+   kwargs.setdefault('quantiles', [0.025, 0.16, 0.5, 0.84, 0.975])
+   kwargs.setdefault('levels', [0.393, 0.865, 0.95])
+   
+   return corner.corner(data.view(np.float64).reshape(data.shape + (-1,)), fig=fig,
+                        labels=[get_label(p) for p in pars], show_titles=True,
+                        title_kwargs={"fontsize": 12}, **kwargs)
+   
+   
+def plot_fit(variables, y, yerr, samples, results, grid=None, fig=None):
+   
+   if fig is None:
+      fig = new_figure(figsize=(10, 6))
+   fig.subplots_adjust(wspace=0.40, left=0.07, right=0.98)
    
    obs = {}
    for v, y_, e_ in zip(variables, y, yerr):
       obs[v] = [y_, e_]
-      
-   pars = list(models.defaults[2])
+   
+   grid = models.defaults if grid is None else grid
+   pars = list(grid[2])
    pars.remove('age')
    
    
    
    for i, par in enumerate(pars):
    
-      ax = pl.subplot(1, len(pars), i+1)
+      ax = fig.add_subplot(1, len(pars), i+1)
       
       pc = np.percentile(samples[par], [0.2, 16, 50, 84, 99.8])
       
@@ -49,30 +99,36 @@ def plot_fit(variables, y, yerr, samples, results):
       )
          
       #-- plot best fit and 50 percentile fit
-      pl.plot([0.5,1.5], [results[par][0], results[par][0]], '--r', lw=1.5)
-      pl.plot([0.5,1.5], [results[par][1], results[par][1]], '-b', lw=1.5)
+      ax.plot([0.5,1.5], [results[par][0], results[par][0]], '--r', lw=1.5)
+      ax.plot([0.5,1.5], [results[par][1], results[par][1]], '-b', lw=1.5)
       
       #-- plot 3 sigma range as wiskers
-      pl.plot([1.0, 1.0], [pc[0], pc[1]], '-k', lw=1.5, zorder=0)
-      pl.plot([1.0, 1.0], [pc[3], pc[4]], '-k', lw=1.5, zorder=0)
+      ax.plot([1.0, 1.0], [pc[0], pc[1]], '-k', lw=1.5, zorder=0)
+      ax.plot([1.0, 1.0], [pc[3], pc[4]], '-k', lw=1.5, zorder=0)
       
       #pl.boxplot(samples[par], usermedians=usermedians)
       
       if par in obs:
-         pl.errorbar([1], obs[par][0], yerr=obs[par][1], color='r', marker='x', mew=2, lw=2)
+         ax.errorbar([1], obs[par][0], yerr=obs[par][1], color='r', marker='x', mew=2, lw=2)
       
       ax.axes.get_xaxis().set_visible(False)
       
-      pl.title(par)
+      ax.set_title(par)
    
+   return fig
    
 
-def plot_HR(variables, y, yerr, results, result='pc'):
+def plot_HR(variables, y, yerr, results, result='pc', grid=None, fig=None):
+   
+   if fig is None:
+      fig = new_figure(figsize=(6, 10))
+   fig.subplots_adjust(left=0.14, right=0.97, top=0.97, bottom=0.07, hspace=0)
    
    # use model from 'best' results or 'pc' results
    resi = 0 if result == 'best' else 1
    
-   data = models.get_track(results['mass_init'][resi], results['M_H_init'][resi], as_recarray=True)
+   data = models.get_track(results['mass_init'][resi], results['M_H_init'][resi], as_recarray=True,
+                           grid=grid)
    
    obs = {}
    for v, y_, e_ in zip(variables, y, yerr):
@@ -86,88 +142,160 @@ def plot_HR(variables, y, yerr, results, result='pc'):
       xlim = None
    xlim = None
    
-   pl.subplot(311)
-   pl.subplots_adjust(hspace=0)
+   ax = fig.add_subplot(311)
    
-   pl.plot(data['log_Teff'], data['log_g'])
+   ax.plot(data['log_Teff'], data['log_g'])
    
    if 'log_Teff' in obs and 'log_g' in obs:
-      pl.errorbar(obs['log_Teff'][0], obs['log_g'][0], 
+      ax.errorbar(obs['log_Teff'][0], obs['log_g'][0], 
                   xerr=obs['log_Teff'][1], yerr=obs['log_g'][1],
                   color='r', marker='o')
    elif 'log_Teff' in obs:
-      pl.axvline(x=obs['log_Teff'][0], color='r', ls='-')
-      pl.axvline(x=obs['log_Teff'][0]-obs['log_Teff'][1], color='r', ls='-')
-      pl.axvline(x=obs['log_Teff'][0]+obs['log_Teff'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_Teff'][0], color='r', ls='-')
+      ax.axvline(x=obs['log_Teff'][0]-obs['log_Teff'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_Teff'][0]+obs['log_Teff'][1], color='r', ls='-')
    elif 'log_g' in obs:
-      pl.axvline(x=obs['log_g'][0], color='r', ls='-')
-      pl.axvline(x=obs['log_g'][0]-obs['log_g'][1], color='r', ls='-')
-      pl.axvline(x=obs['log_g'][0]+obs['log_g'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_g'][0], color='r', ls='-')
+      ax.axvline(x=obs['log_g'][0]-obs['log_g'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_g'][0]+obs['log_g'][1], color='r', ls='-')
    
-   if not xlim is None: pl.xlim(xlim)
+   if not xlim is None: ax.set_xlim(xlim)
    
    if 'log_g' in obs:
-      pl.ylim([obs['log_g'][0]-obs['log_g'][1] - 0.5, 
+      ax.set_ylim([obs['log_g'][0]-obs['log_g'][1] - 0.5, 
                obs['log_g'][0]+obs['log_g'][1] + 0.5]) 
    
-   pl.gca().invert_xaxis()
-   pl.gca().invert_yaxis()
+   ax.invert_xaxis()
+   ax.invert_yaxis()
    
-   pl.ylabel('log(g) (dex)')
+   ax.set_ylabel('log(g) (dex)')
    
    
-   pl.subplot(312)
+   ax = fig.add_subplot(312)
    
-   pl.plot(data['log_Teff'], data['log_L'])
+   ax.plot(data['log_Teff'], data['log_L'])
    
    if 'log_Teff' in obs and 'log_L' in obs:
-      pl.errorbar(obs['log_Teff'][0], obs['log_L'][0], 
+      ax.errorbar(obs['log_Teff'][0], obs['log_L'][0], 
                   xerr=obs['log_Teff'][1], yerr=obs['log_L'][1],
                   color='r', marker='o')
    elif 'log_Teff' in obs:
-      pl.axvline(x=obs['log_Teff'][0], color='r', ls='-')
-      pl.axvline(x=obs['log_Teff'][0]-obs['log_Teff'][1], color='r', ls='-')
-      pl.axvline(x=obs['log_Teff'][0]+obs['log_Teff'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_Teff'][0], color='r', ls='-')
+      ax.axvline(x=obs['log_Teff'][0]-obs['log_Teff'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_Teff'][0]+obs['log_Teff'][1], color='r', ls='-')
    elif 'log_L' in obs:
-      pl.axvline(x=obs['log_L'][0], color='r', ls='-')
-      pl.axvline(x=obs['log_L'][0]-obs['log_L'][1], color='r', ls='-')
-      pl.axvline(x=obs['log_L'][0]+obs['log_L'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_L'][0], color='r', ls='-')
+      ax.axvline(x=obs['log_L'][0]-obs['log_L'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_L'][0]+obs['log_L'][1], color='r', ls='-')
    
-   if not xlim is None: pl.xlim(xlim)
+   if not xlim is None: ax.set_xlim(xlim)
    
    if 'log_L' in obs:
-      pl.ylim([obs['log_L'][0]-obs['log_L'][1] - 0.5, 
+      ax.set_ylim([obs['log_L'][0]-obs['log_L'][1] - 0.5, 
                obs['log_L'][0]+obs['log_L'][1] + 0.5]) 
    
-   pl.gca().invert_xaxis()
+   ax.invert_xaxis()
    
-   pl.ylabel('log(L/L$_{\odot}$)')
+   ax.set_ylabel('log(L/L$_{\odot}$)')
    
    
-   pl.subplot(313)
+   ax = fig.add_subplot(313)
    
-   pl.plot(data['log_Teff'], data['log_R'])
+   ax.plot(data['log_Teff'], data['log_R'])
    
    if 'log_Teff' in obs and 'log_R' in obs:
-      pl.errorbar(obs['log_Teff'][0], obs['log_R'][0], 
+      ax.errorbar(obs['log_Teff'][0], obs['log_R'][0], 
                   xerr=obs['log_Teff'][1], yerr=obs['log_R'][1],
                   color='r', marker='o')
    elif 'log_Teff' in obs:
-      pl.axvline(x=obs['log_Teff'][0], color='r', ls='-')
-      pl.axvline(x=obs['log_Teff'][0]-obs['log_Teff'][1], color='r', ls='-')
-      pl.axvline(x=obs['log_Teff'][0]+obs['log_Teff'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_Teff'][0], color='r', ls='-')
+      ax.axvline(x=obs['log_Teff'][0]-obs['log_Teff'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_Teff'][0]+obs['log_Teff'][1], color='r', ls='-')
    elif 'log_R' in obs:
-      pl.axvline(x=obs['log_R'][0], color='r', ls='-')
-      pl.axvline(x=obs['log_R'][0]-obs['log_R'][1], color='r', ls='-')
-      pl.axvline(x=obs['log_R'][0]+obs['log_R'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_R'][0], color='r', ls='-')
+      ax.axvline(x=obs['log_R'][0]-obs['log_R'][1], color='r', ls='-')
+      ax.axvline(x=obs['log_R'][0]+obs['log_R'][1], color='r', ls='-')
    
-   if not xlim is None: pl.xlim(xlim)
+   if not xlim is None: ax.set_xlim(xlim)
    
    if 'log_R' in obs:
-      pl.ylim([obs['log_R'][0]-obs['log_R'][1] - 0.5, 
+      ax.set_ylim([obs['log_R'][0]-obs['log_R'][1] - 0.5, 
                obs['log_R'][0]+obs['log_R'][1] + 0.5])
    
-   pl.gca().invert_xaxis()
+   ax.invert_xaxis()
+   
+   ax.set_xlabel('log(Teff/K)')
+   ax.set_ylabel('log(R/R$_{\odot}$)')
+   
+   return fig
+   
+   
+def make_plots(plots, variables, y, yerr, samples, results, grid=None, objectname=None):
+   """
+   Makes the plots described in the setup file of a fit. Every plot is a dict
+   with its 'type' ('distribution', 'fit' or 'HR'), the 'path' to save it to,
+   and the other options of that type of plot. <objectname> in the path is
+   replaced by the name of the object.
+   
+   Plots with a path are drawn with the Agg backend and saved without using
+   pyplot, so they can be made on nodes without a display and in the worker
+   processes of a batch run. Plots without a path are made with pyplot, to
+   be shown with pyplot.show(). Plots that need samples are skipped when
+   samples is None, and distribution plots when corner is not installed.
+   
+   :param plots: list of plots to make
+   :type plots: list of dicts
+   :param results: results of the fit, for every parameter the best value
+                   followed by the percentiles and errors
+   :type results: dict
+   :param objectname: name of the object
+   :type objectname: str
+   
+   :return: the figures
+   :rtype: list
+   """
+   
+   figures = []
+   
+   for plot in plots:
+      
+      path = plot.get('path', None)
+      if path is not None and objectname is not None:
+         path = path.replace('<objectname>', objectname)
+      
+      interactive = path is None
+      
+      if plot['type'] == 'distribution':
+         
+         if samples is None: continue
+         try:
+            import corner
+         except ImportError:
+            print("corner is not installed, skipping the distribution plot", file=sys.stderr)
+            continue
+         
+         fig = plot_distribution(samples, parameters=plot.get('parameters', ['mass_init', 'M_H_init', 'phase']),
+                                 fig=new_figure(interactive=True) if interactive else None,
+                                 quantiles=plot.get('quantiles', [0.025, 0.16, 0.5, 0.84, 0.975]),
+                                 levels=plot.get('levels', [0.393, 0.865, 0.95]))
+      
+      elif plot['type'] == 'HR':
+         
+         fig = plot_HR(variables, y, yerr, results, result=plot.get('result', 'pc'), grid=grid,
+                       fig=new_figure(figsize=(6, 10), interactive=interactive))
+      
+      elif plot['type'] == 'fit':
+         
+         if samples is None: continue
+         fig = plot_fit(variables, y, yerr, samples, results, grid=grid,
+                        fig=new_figure(figsize=(10, 6), interactive=interactive))
+      
+      else:
+         continue
+      
+      if path is not None:
+         fig.savefig(path)
+      
+      figures.append(fig)
    
-   pl.xlabel('log(Teff/K)')
-   pl.ylabel('log(R/R$_{\odot}$)')
\ No newline at end of file
+   return figures
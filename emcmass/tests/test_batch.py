@@ -0,0 +1,121 @@
+import numpy as np
+
+import  io
+import  os
+import  shutil
+import  contextlib
+import  tempfile
+import  unittest
+
+from emcmass import models, batch
+
+class TestReadTable(unittest.TestCase):
+   
+   def setUp(self):
+      self.dirname = tempfile.mkdtemp()
+      
+   def tearDown(self):
+      shutil.rmtree(self.dirname)
+   
+   def test_csv(self):
+      filename = os.path.join(self.dirname, 'stars.csv')
+      with open(filename, 'w') as ofile:
+         ofile.write("name,Teff,Teff_err,M_H,M_H_err\n")
+         ofile.write("sun,5778,100,0.0,0.05\n")
+         ofile.write("bd,5700,50,-0.4,0.08\n")
+      
+      stars = batch.read_table(filename)
+      
+      self.assertEqual(len(stars), 2)
+      self.assertEqual(stars[1]['name'], 'bd')
+      self.assertEqual(stars[1]['observables'], {'Teff': [5700, 50], 'M_H': [-0.4, 0.08]})
+   
+   def test_yaml(self):
+      filename = os.path.join(self.dirname, 'stars.yaml')
+      with open(filename, 'w') as ofile:
+         ofile.write("- name: sun\n  observables:\n    Teff: [5778, 100]\n")
+         ofile.write("- observables:\n    Teff: [5700, 50]\n")
+      
+      stars = batch.read_table(filename)
+      
+      self.assertEqual(len(stars), 2)
+      self.assertEqual(stars[0]['name'], 'sun')
+      self.assertEqual(stars[1]['name'], '1')
+      self.assertEqual(stars[1]['observables'], {'Teff': [5700, 50]})
+
+class TestFitMany(unittest.TestCase):
+   
+   def setUp(self):
+      models.parameters = ['mass_init', 'M_H_init', 'phase']
+      self.stars = [dict(name='sun', observables={'Teff': [5778, 100], 'log_g': [4.43, 0.1],
+                                                  'M_H': [0.0, 0.05]}),
+                    dict(name='hot', observables={'Teff': [6500, 100], 'log_g': [4.2, 0.2],
+                                                  'M_H': [0.1, 0.1]})]
+      
+   def test_fit_many(self):
+      rows = list(batch.fit_many(self.stars, limits=[(0.5, 2.0), (-1.0, 0.5), (100, 400)],
+                                 processes=2, nwalkers=20, nsteps=50, nrelax=20))
+      
+      self.assertEqual([r['name'] for r in rows], ['sun', 'hot'])
+      
+      for row in rows:
+         for p in models.parameters:
+            self.assertTrue(np.isfinite(row[p]))
+      
+      self.assertLess(abs(rows[0]['mass_init'] - 1.0), 0.3)
+      
+   def test_fit_many_grid(self):
+      rows = list(batch.fit_many(self.stars, limits=[(0.5, 2.0), (-1.0, 0.5), (100, 400)],
+                                 processes=2, method='grid', refine=2))
+      
+      self.assertEqual([r['name'] for r in rows], ['sun', 'hot'])
+      self.assertLess(abs(rows[0]['mass_init'] - 1.0), 0.3)
+      
+   def test_fit_many_keywords(self):
+      #-- the CLI passes the options of both methods
+      rows = list(batch.fit_many(self.stars[:1], limits=[(0.5, 2.0), (-1.0, 0.5), (100, 400)],
+                                 processes=1, method='grid', refine=1, nwalkers=20, nsteps=50,
+                                 init='uniform', converge=False))
+      self.assertTrue(np.isfinite(rows[0]['mass_init']))
+      
+      with self.assertRaises(TypeError):
+         list(batch.fit_many(self.stars, method='grid', nwalker=20))
+      
+   def test_plots(self):
+      dirname = tempfile.mkdtemp()
+      try:
+         plots = [dict(type='fit', path=os.path.join(dirname, '<objectname>_fit.png')),
+                  dict(type='HR', path=os.path.join(dirname, '<objectname>_HR.png'))]
+         
+         rows = list(batch.fit_many(self.stars, limits=[(0.5, 2.0), (-1.0, 0.5), (100, 400)],
+                                    processes=2, nwalkers=20, nsteps=50, nrelax=20, plots=plots))
+         
+         self.assertEqual(sorted(os.listdir(dirname)), ['hot_HR.png', 'hot_fit.png',
+                                                        'sun_HR.png', 'sun_fit.png'])
+         
+         with self.assertRaises(ValueError):
+            list(batch.fit_many(self.stars, plots=[dict(type='fit', path='fit.png')]))
+      finally:
+         shutil.rmtree(dirname)
+      
+   def test_failed_fit(self):
+      star = dict(name='bad', observables={'Teff': [5778, 100]})
+      args = (star, ['Teff', 'log_g'], [(0.5, 2.0), (-1.0, 0.5), (100, 400)], [16, 50, 84], 'mcmc', None, {})
+      
+      #-- the results can be written to stdout, so the error has to go to stderr
+      stdout, stderr = io.StringIO(), io.StringIO()
+      with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+         row = batch._fit_star(args)
+      
+      self.assertTrue(np.isnan(row['mass_init']))
+      self.assertEqual(stdout.getvalue(), '')
+      self.assertIn("Fit of bad failed: KeyError", stderr.getvalue())
+      
+   def test_different_observables(self):
+      self.stars[1]['observables'].pop('M_H')
+      
+      with self.assertRaises(ValueError):
+         list(batch.fit_many(self.stars))
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,152 @@
+import numpy as np
+
+import  unittest
+
+from emcmass import interpol
+
+def synthetic_grid(seed=1):
+   """
+   Grid with 3 parameters where the tracks (last parameter) have different
+   lengths, like the EEP tracks of the evolution models, and one missing track.
+   """
+   rng = np.random.RandomState(seed)
+   
+   pars, data = [], []
+   for m in [0.5, 1.0, 1.5, 2.5]:
+      for z in [-1.0, -0.5, 0.0]:
+         if m == 1.5 and z == -0.5: continue
+         for phase in range(int(12 - 3 * m)):
+            pars.append([m, z, phase])
+            data.append([m + phase / 10. + z, 4.5 - m * phase / 20., rng.uniform()])
+   
+   return np.array(pars).T, np.array(data).T
+
+class TestInterpolateLinear(unittest.TestCase):
+   
+   def setUp(self):
+      self.grid_pars, self.grid_data = synthetic_grid()
+      self.axis_values, self.pixelgrid = interpol.create_pixeltypegrid(self.grid_pars, self.grid_data)
+      
+      rng = np.random.RandomState(3)
+      self.p = np.vstack([rng.uniform(0.5, 2.5, 500), rng.uniform(-1.0, 0.0, 500),
+                          rng.uniform(0, 9, 500)])
+      self.p[:, :50] = self.grid_pars[:, :50]
+   
+   def test_interpolate(self):
+      values1 = interpol.interpolate(self.p.copy(), self.axis_values, self.pixelgrid)
+      values2 = interpol.interpolate_linear(self.p.copy(), self.axis_values, self.pixelgrid)
+      
+      self.assertEqual(values1.shape, values2.shape)
+      self.assertTrue(np.array_equal(np.isnan(values1), np.isnan(values2)))
+      self.assertTrue(np.array_equal(np.isinf(values1), np.isinf(values2)))
+      
+      finite = np.isfinite(values1)
+      self.assertTrue(np.allclose(values1[finite], values2[finite], rtol=1e-12, atol=1e-12))
+   
+   def test_grid_points(self):
+      values = interpol.interpolate_linear(self.grid_pars.copy(), self.axis_values, self.pixelgrid)
+      
+      # like map_coordinates, points next to missing grid points are not finite
+      finite = np.isfinite(values)
+      self.assertTrue(np.any(finite))
+      self.assertTrue(np.allclose(values[finite], self.grid_data[finite], rtol=1e-12, atol=1e-12))
+   
+   def test_columns(self):
+      values1 = interpol.interpolate_linear(self.p.copy(), self.axis_values, self.pixelgrid)
+      values2 = interpol.interpolate_linear(self.p.copy(), self.axis_values, self.pixelgrid,
+                                            columns=[0, 2])
+      
+      self.assertTrue(np.array_equal(values1[[0, 2]], values2, equal_nan=True))
+      
+      axis_values, compactgrid = interpol.create_compactgrid(self.grid_pars, self.grid_data)
+      values1 = interpol.interpolate_compact(self.p.copy(), axis_values, compactgrid)
+      values2 = interpol.interpolate_compact(self.p.copy(), axis_values, compactgrid, columns=[1])
+      
+      self.assertTrue(np.array_equal(values1[[1]], values2, equal_nan=True))
+   
+   def test_non_contiguous(self):
+      pixelgrid = np.asfortranarray(self.pixelgrid)
+      
+      values1 = interpol.interpolate_linear(self.p.copy(), self.axis_values, self.pixelgrid)
+      values2 = interpol.interpolate_linear(self.p.copy(), self.axis_values, pixelgrid)
+      
+      self.assertTrue(np.array_equal(values1, values2, equal_nan=True))
+
+class TestCompactGrid(unittest.TestCase):
+   
+   def setUp(self):
+      self.grid_pars, self.grid_data = synthetic_grid()
+      self.axis_values, self.pixelgrid = interpol.create_pixeltypegrid(self.grid_pars, self.grid_data)
+      
+      rng = np.random.RandomState(2)
+      self.p = np.vstack([rng.uniform(0.5, 2.5, 500), rng.uniform(-1.0, 0.0, 500),
+                          rng.uniform(0, 9, 500)])
+      self.p[:, :50] = self.grid_pars[:, :50]
+   
+   def test_expand(self):
+      axis_values, compactgrid = interpol.create_compactgrid(self.grid_pars, self.grid_data,
+                                                             dtype=np.float64)
+      
+      self.assertTrue(np.array_equal(interpol.expand_compactgrid(compactgrid), self.pixelgrid))
+      self.assertLess(compactgrid.packed.size, self.pixelgrid.size)
+   
+   def test_interpolate(self):
+      axis_values, compactgrid = interpol.create_compactgrid(self.grid_pars, self.grid_data,
+                                                             dtype=np.float64)
+      
+      values1 = interpol.interpolate(self.p.copy(), self.axis_values, self.pixelgrid)
+      values2 = interpol.interpolate_compact(self.p.copy(), axis_values, compactgrid)
+      
+      self.assertTrue(np.array_equal(np.isfinite(values1), np.isfinite(values2)))
+      
+      finite = np.isfinite(values1)
+      self.assertTrue(np.allclose(values1[finite], values2[finite], rtol=1e-12, atol=1e-12))
+   
+   def test_slice(self):
+      axis_values, compactgrid = interpol.create_compactgrid(self.grid_pars, self.grid_data,
+                                                             dtype=np.float64)
+      
+      for index in [(slice(1, 3), slice(0, 3), slice(2, 7)), (slice(0, 4), slice(1, 2), slice(5, 10)),
+                    (slice(2, 4), slice(0, 3), slice(0, 1))]:
+         sliced = interpol.slice_compactgrid(compactgrid, index)
+         
+         self.assertTrue(sliced.packed is compactgrid.packed)
+         self.assertTrue(np.array_equal(interpol.expand_compactgrid(sliced), self.pixelgrid[index]))
+   
+   def test_interpolate_float32(self):
+      axis_values, compactgrid = interpol.create_compactgrid(self.grid_pars, self.grid_data)
+      
+      values1 = interpol.interpolate(self.p.copy(), self.axis_values, self.pixelgrid)
+      values2 = interpol.interpolate_compact(self.p.copy(), axis_values, compactgrid)
+      
+      finite = np.isfinite(values1)
+      self.assertTrue(np.allclose(values1[finite], values2[finite], rtol=1e-6))
+
+class TestInGrid(unittest.TestCase):
+   
+   def setUp(self):
+      self.grid_pars, self.grid_data = synthetic_grid()
+      self.axis_values, self.pixelgrid = interpol.create_pixeltypegrid(self.grid_pars, self.grid_data)
+      
+      rng = np.random.RandomState(4)
+      self.p = np.vstack([rng.uniform(0.5, 2.5, 2000), rng.uniform(-1.0, 0.0, 2000),
+                          rng.uniform(0, 9, 2000)])
+      self.p[:, :50] = self.grid_pars[:, :50]
+   
+   def test_in_grid(self):
+      valid = interpol.valid_cells(self.pixelgrid)
+      inside = interpol.in_grid(self.p, self.axis_values, valid)
+      
+      values = interpol.interpolate_linear(self.p.copy(), self.axis_values, self.pixelgrid)
+      
+      self.assertTrue(np.array_equal(inside, np.all(np.isfinite(values), axis=0)))
+      self.assertTrue(np.any(inside) and not np.all(inside))
+   
+   def test_compact(self):
+      axis_values, compactgrid = interpol.create_compactgrid(self.grid_pars, self.grid_data)
+      
+      self.assertTrue(np.array_equal(interpol.valid_cells(compactgrid),
+                                     interpol.valid_cells(self.pixelgrid)))
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,440 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import  unittest
+
+from emcmass import models, mcmc
+
+class TestVectorizedLnprob(unittest.TestCase):
+   
+   def setUp(self):
+      models.parameters = ['mass_init', 'M_H_init', 'phase']
+      self.variables = ['log_R', 'M_H', 'log_g', 'log_L', 'log_Teff']
+      self.limits = [(0.1, 2.0), (-1.5, 0.5), (100, 400)]
+      self.y = np.array([0.07188201, -0.4, 4.7, 0.13987909, 3.75587486])
+      self.yerr = np.array([0.03680424, 0.08, 0.2, 0.15735145, 0.00380956])
+      
+      lim_kwargs = {}
+      for p, l in zip(models.parameters, self.limits):
+         lim_kwargs[p+'_lim'] = l
+      
+      models.prepare_grid(variables=self.variables, set_default=True,
+                          return_all_variables=True, **lim_kwargs)
+      
+      self.theta = np.array([[0.82, -0.25, 273.4],
+                             [1.23, -0.125, 150.0],
+                             [0.05, 0.0, 200.0],
+                             [1.5, 0.25, 399.0]])
+   
+   def test_lnprior(self):
+      lp = mcmc.lnprior(self.theta, self.limits)
+      
+      for theta, lp_ in zip(self.theta, lp):
+         self.assertEqual(lp_, mcmc.lnprior(theta, self.limits))
+   
+   def test_lnprior_grid(self):
+      rng = np.random.RandomState(1)
+      theta = np.vstack([rng.uniform(0.1, 2.0, 300), rng.uniform(-1.5, 0.5, 300),
+                         rng.uniform(250, 400, 300)]).T
+      
+      lp = mcmc.lnprior(theta, self.limits, grid=models.defaults)
+      lnlike = mcmc.lnlike(theta, self.y, self.yerr)
+      
+      self.assertTrue(np.array_equal(np.isfinite(lp), np.isfinite(lnlike)))
+      self.assertTrue(np.any(np.isfinite(lp)) and not np.all(np.isfinite(lp)))
+      
+      for theta_, lp_ in zip(theta, lp):
+         self.assertEqual(lp_, mcmc.lnprior(theta_, self.limits, grid=models.defaults))
+   
+   def test_lnprior_tuple_grid(self):
+      rng = np.random.RandomState(1)
+      theta = np.vstack([rng.uniform(0.1, 2.0, 300), rng.uniform(-1.5, 0.5, 300),
+                         rng.uniform(250, 400, 300)]).T
+      grid = tuple(models.defaults)
+      
+      #-- a plain tuple is not converted to a Grid, only the limits are checked
+      self.assertTrue(np.array_equal(mcmc.lnprior(theta, self.limits, grid=grid),
+                                     mcmc.lnprior(theta, self.limits)))
+      
+      #-- the likelihood still rejects the walkers outside the grid
+      lp = mcmc.lnprob(theta, self.y, self.yerr, self.limits, grid=grid)
+      lp_ = mcmc.lnprob(theta, self.y, self.yerr, self.limits, grid=models.defaults)
+      self.assertTrue(np.array_equal(np.isfinite(lp), np.isfinite(lp_)))
+      
+      for theta_, lp_ in zip(theta[:20], lp[:20]):
+         self.assertEqual(np.isfinite(lp_), np.isfinite(mcmc.lnprob(theta_, self.y, self.yerr,
+                                                                    self.limits, grid=grid)))
+   
+   def test_lnprob(self):
+      lp = mcmc.lnprob(self.theta, self.y, self.yerr, self.limits)
+      
+      self.assertEqual(len(lp), len(self.theta))
+      
+      for theta, lp_ in zip(self.theta, lp):
+         self.assertEqual(lp_, mcmc.lnprob(theta, self.y, self.yerr, self.limits))
+   
+   def test_threaded(self):
+      #-- split the 4 walkers over the threads
+      thread_batchsize = mcmc.thread_batchsize
+      mcmc.thread_batchsize = 1
+      try:
+         with mcmc.thread_pool(3) as executor:
+            lp = mcmc.lnprob_vectorized(self.theta, self.y, self.yerr, self.limits)
+            lp_ = mcmc.lnprob_vectorized(self.theta, self.y, self.yerr, self.limits, executor=executor,
+                                         nthreads=3)
+      finally:
+         mcmc.thread_batchsize = thread_batchsize
+      
+      with mcmc.thread_pool(3) as executor:
+         samples = self.theta[[0, 1, 3, 0, 1]]
+         blobs = mcmc.interpolate_samples(samples)
+         blobs_ = mcmc.interpolate_samples(samples, executor=executor, nthreads=3)
+      
+      self.assertTrue(executor._shutdown)
+      self.assertTrue(np.array_equal(lp, lp_))
+      self.assertTrue(np.array_equal(blobs, blobs_, equal_nan=True))
+      
+      kwargs = dict(nwalkers=20, nsteps=50, nrelax=10, verbose=False)
+      np.random.seed(1)
+      results, samples = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, **kwargs)
+      np.random.seed(1)
+      results_, samples_ = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, threads=2, **kwargs)
+      self.assertTrue(np.array_equal(samples.view(np.float64), samples_.view(np.float64), equal_nan=True))
+      
+      with self.assertRaises(ValueError):
+         mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, threads=2, vectorize=False, **kwargs)
+   
+   def test_stats(self):
+      stats = mcmc.RunStats()
+      lp = mcmc.lnprob(self.theta, self.y, self.yerr, self.limits, stats=stats)
+      for theta in self.theta:
+         mcmc.lnprob(theta, self.y, self.yerr, self.limits, stats=stats)
+      
+      report = stats.report()
+      self.assertEqual(report['lnprob_calls'], 1 + len(self.theta))
+      self.assertEqual(report['walkers'], 2 * len(self.theta))
+      self.assertEqual(report['prior_rejections'], 2)
+      self.assertEqual(report['interpolated_points'], 2 * (len(self.theta) - 1))
+      self.assertEqual(report['prior_rejections'] + report['model_rejections'],
+                       2 * np.sum(~np.isfinite(lp)))
+      self.assertGreater(report['time_interpolation'], 0)
+      
+      np.random.seed(1)
+      results, samples = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, nwalkers=20,
+                                   nsteps=50, nrelax=10, verbose=False)
+      
+      report = results['stats']
+      self.assertEqual(report['proposals'], 20 * 60)
+      self.assertEqual(report['walkers'], 20 * 61)
+      self.assertTrue(0 < report['acceptance_fraction'] < 1)
+      self.assertGreaterEqual(report['time_total'], report['time_sampling'] + report['time_postprocessing'])
+   
+   def test_stats_grid(self):
+      rng = np.random.RandomState(1)
+      theta = np.vstack([rng.uniform(0.1, 2.0, 300), rng.uniform(-1.5, 0.5, 300),
+                         rng.uniform(250, 400, 300)]).T
+      
+      #-- walkers outside the grid are rejected without interpolating them
+      stats = mcmc.RunStats()
+      lp = mcmc.lnprob(theta, self.y, self.yerr, self.limits, stats=stats)
+      
+      report = stats.report()
+      self.assertTrue(np.any(np.isfinite(lp)) and not np.all(np.isfinite(lp)))
+      self.assertEqual(report['interpolated_points'], np.sum(np.isfinite(lp)))
+      self.assertEqual(report.get('model_rejections', 0), 0)
+      
+      for theta_, lp_ in zip(theta, lp):
+         self.assertEqual(np.isfinite(lp_), np.isfinite(mcmc.lnprob(theta_, self.y, self.yerr, self.limits)))
+   
+   def test_interpolate_samples(self):
+      samples = self.theta[[0, 1, 3]]
+      
+      blobs = mcmc.interpolate_samples(samples, chunksize=2)
+      
+      self.assertEqual(blobs.shape, (3, len(models.defaults[2])))
+      for theta, b in zip(samples, blobs):
+         self.assertTrue(np.allclose(b, models.interpolate(*theta)))
+
+class TestInitializeWalkers(unittest.TestCase):
+   
+   def setUp(self):
+      models.parameters = ['mass_init', 'M_H_init', 'phase']
+      self.variables = ['log_R', 'M_H', 'log_g', 'log_L', 'log_Teff']
+      self.y = np.array([0.07188201, -0.4, 4.7, 0.13987909, 3.75587486])
+      self.yerr = np.array([0.03680424, 0.08, 0.2, 0.15735145, 0.00380956])
+      
+      self.grid = models.prepare_grid(variables=self.variables, set_default=True,
+                                      return_all_variables=True, mass_init_lim=(0.1, 2.0),
+                                      phase_lim=(100, 400))
+      self.limits = [(np.min(n), np.max(n)) for n in self.grid[0]]
+   
+   def test_chi2_grid(self):
+      chi2 = mcmc.chi2_grid(self.y, self.yerr, self.grid)
+      
+      self.assertEqual(chi2.shape, self.grid[1].shape[:-1])
+      
+      i = np.unravel_index(np.nanargmin(np.where(np.isfinite(chi2), chi2, np.nan)), chi2.shape)
+      theta = [av[j] for av, j in zip(self.grid[0], i)]
+      lp = mcmc.lnprob(theta, self.y, self.yerr, self.limits)
+      self.assertAlmostEqual(-2 * lp, chi2[i])
+   
+   def test_initialize_walkers(self):
+      pos = mcmc.initialize_walkers(50, self.y, self.yerr, self.grid, self.limits)
+      
+      self.assertEqual(pos.shape, (50, 3))
+      
+      lp = mcmc.lnprior(pos, self.limits)
+      self.assertTrue(np.all(np.isfinite(lp)))
+      
+      # walkers should start close to the expected solution
+      self.assertLess(np.abs(np.median(pos[:, 0]) - 0.82), 0.1)
+   
+   def test_initialize_walkers_grid_edge(self):
+      #-- a star at the end of the tracks, where many neighbouring nodes are missing
+      grid = models.Grid(*self.grid)
+      y = np.array([0.5, -0.4, 3.5, 1.2, 3.7])
+      
+      pos = mcmc.initialize_walkers(2000, y, self.yerr, grid, self.limits)
+      
+      self.assertTrue(np.all(grid.contains(*pos.T)))
+      self.assertTrue(np.all(np.isfinite(mcmc.lnprior(pos, self.limits, grid=grid))))
+   
+   def test_initialize_walkers_no_match(self):
+      yerr = np.array([np.nan] * len(self.y))
+      
+      with self.assertRaises(ValueError):
+         mcmc.initialize_walkers(50, self.y, yerr, self.grid, self.limits)
+
+
+class TestStreamingChain(unittest.TestCase):
+   
+   def setUp(self):
+      models.parameters = ['mass_init', 'M_H_init', 'phase']
+      self.variables = np.array(['log_Teff', 'log_g', 'M_H'])
+      self.limits = [(0.7, 1.4), (-0.5, 0.5), (150, 300)]
+      self.y = np.array([3.76, 4.43, 0.0])
+      self.yerr = np.array([0.02, 0.2, 0.05])
+      self.tempdir = tempfile.mkdtemp()
+   
+   def tearDown(self):
+      shutil.rmtree(self.tempdir)
+   
+   def test_chain_writer(self):
+      filename = os.path.join(self.tempdir, 'chain.npy')
+      x = np.random.normal(size=(300, 4))
+      
+      writer = mcmc.ChainWriter(filename, 4)
+      writer.append(x[:100])
+      writer.flush()
+      
+      #-- continue after the first 50 rows, like resuming from a checkpoint
+      writer.ofile.close()
+      writer = mcmc.ChainWriter(filename, 4, nrows=50)
+      writer.append(x[50:])
+      data = writer.close()
+      
+      self.assertTrue(np.array_equal(data, x))
+      self.assertFalse(os.path.isfile(filename + '.part'))
+      
+      writer = mcmc.ChainWriter(filename + '2', 4)
+      writer.abort()
+      self.assertFalse(os.path.isfile(filename + '2.part'))
+   
+   def test_no_samples(self):
+      samples = models.to_recarray(np.zeros((0, 3)), models.parameters)
+      
+      with self.assertRaises(ValueError):
+         mcmc.calculate_percentiles(samples, [16, 50, 84])
+      
+      #-- observations that no model matches within the limits
+      lnlike = mcmc.lnlike
+      mcmc.lnlike = lambda *args, **kws: np.full(len(np.atleast_2d(args[0])), -np.inf)
+      try:
+         for chain in [None, os.path.join(self.tempdir, 'chain.npy')]:
+            with self.assertRaises(ValueError):
+               mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, nwalkers=20, nsteps=10,
+                         nrelax=10, verbose=False, chain=chain)
+      finally:
+         mcmc.lnlike = lnlike
+      
+      self.assertEqual(os.listdir(self.tempdir), [])
+   
+   def test_stream_chain(self):
+      filename = os.path.join(self.tempdir, 'chain.npy')
+      
+      np.random.seed(3)
+      results1, samples1 = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr,
+                                     nwalkers=20, nsteps=100, verbose=False)
+      np.random.seed(3)
+      results2, samples2 = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr,
+                                     nwalkers=20, nsteps=100, verbose=False, chain=filename,
+                                     chunksize=300)
+      
+      self.assertTrue(os.path.isfile(filename))
+      self.assertFalse(os.path.isfile(filename + '.part'))
+      self.assertEqual(samples1.dtype.names, samples2.dtype.names)
+      self.assertTrue(np.array_equal(samples1.view(np.float64), samples2.view(np.float64), equal_nan=True))
+      self.assertTrue(np.array_equal(np.load(filename), samples1.view(np.float64).reshape(len(samples1), -1),
+                                     equal_nan=True))
+      
+      for p in models.parameters:
+         self.assertEqual(results1[p], results2[p])
+      
+      pc1 = mcmc.calculate_percentiles(samples1, [16, 50, 84])
+      pc2 = mcmc.calculate_percentiles(samples2, [16, 50, 84])
+      for p in models.parameters:
+         self.assertTrue(np.allclose(pc1[p], pc2[p]))
+      
+      #-- the streamed chain is read in chunks, which gives the same percentiles
+      pc3 = mcmc.calculate_percentiles(samples2, [16, 50, 84], chunksize=100)
+      for p in samples2.dtype.names:
+         self.assertEqual(pc2[p], pc3[p])
+   
+   def test_chunked_percentiles(self):
+      rng = np.random.RandomState(2)
+      n = 10001
+      data = np.column_stack([rng.normal(size=n), np.zeros(n), rng.randint(0, 5, n).astype(float),
+                              np.round(rng.lognormal(size=n), 2)])
+      samples = models.to_recarray(data, ['a', 'b', 'c', 'd'])
+      
+      for percentiles in [[16, 50, 84], [0, 2.5, 33.3, 97.5, 100]]:
+         pc = mcmc.chunked_percentiles(samples, percentiles, chunksize=100, nbins=16)
+         
+         for j, name in enumerate(samples.dtype.names):
+            self.assertTrue(np.array_equal(pc[:, j], np.percentile(samples[name], percentiles)))
+   
+   def test_resume(self):
+      checkpoint = os.path.join(self.tempdir, 'checkpoint.npz')
+      kwargs = dict(nwalkers=20, nsteps=60, nrelax=20, verbose=False)
+      
+      np.random.seed(3)
+      results1, samples1 = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, **kwargs)
+      
+      #-- interrupt the run after 50 steps
+      lnlike, ncalls = mcmc.lnlike, [0]
+      def interrupted(*args, **kws):
+         ncalls[0] += 1
+         if ncalls[0] > 2 * 50:
+            raise KeyboardInterrupt
+         return lnlike(*args, **kws)
+      
+      mcmc.lnlike = interrupted
+      np.random.seed(3)
+      try:
+         mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, checkpoint=checkpoint,
+                   checkpoint_every=20, **kwargs)
+      except KeyboardInterrupt:
+         pass
+      finally:
+         mcmc.lnlike = lnlike
+      
+      state, iteration, data = mcmc.load_checkpoint(checkpoint)
+      self.assertEqual(iteration, 40)
+      
+      #-- every checkpoint only appends the new steps to the chain file
+      chain = np.fromfile(checkpoint + '.chain.npy.part', offset=mcmc.ChainWriter.header_size)
+      self.assertEqual(chain.size, 40 * 20 * 4)
+      
+      #-- a checkpoint of a different run can not be resumed
+      for key, value in [('nwalkers', 30), ('nsteps', 80)]:
+         kwargs_ = dict(kwargs, **{key: value})
+         with self.assertRaises(ValueError):
+            mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, checkpoint=checkpoint,
+                      checkpoint_every=20, resume=True, **kwargs_)
+      
+      results2, samples2 = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, checkpoint=checkpoint,
+                                     checkpoint_every=20, resume=True, **kwargs)
+      
+      self.assertFalse(os.path.isfile(checkpoint))
+      self.assertFalse(os.path.isfile(checkpoint + '.chain.npy.part'))
+      self.assertTrue(np.array_equal(samples1.view(np.float64), samples2.view(np.float64), equal_nan=True))
+      for p in models.parameters:
+         self.assertEqual(results1[p], results2[p])
+   
+   def test_converge(self):
+      np.random.seed(3)
+      results, samples = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, nwalkers=20,
+                                   nsteps=5000, nrelax=50, verbose=False, converge=True,
+                                   check_every=50, ntau=20, tau_tol=0.05)
+      
+      self.assertTrue('tau' in results)
+      self.assertEqual(len(results['tau']), 3)
+      self.assertTrue(len(samples) < 20 * 5000)
+      self.assertTrue(np.all(20 * results['tau'] < len(samples) / 20))
+      
+      with self.assertRaises(ValueError):
+         mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, nwalkers=20, nsteps=100, verbose=False,
+                   converge=True, chain=os.path.join(self.tempdir, 'chain.npy'))
+
+
+class TestGridPosterior(unittest.TestCase):
+   
+   def setUp(self):
+      models.parameters = ['mass_init', 'M_H_init', 'phase']
+      self.variables = np.array(['log_Teff', 'log_g', 'M_H'])
+      self.limits = [(0.7, 1.4), (-0.5, 0.5), (150, 300)]
+      self.y = np.array([3.76, 4.43, 0.0])
+      self.yerr = np.array([0.02, 0.2, 0.05])
+   
+   def test_weighted_percentiles(self):
+      x = np.random.normal(size=1001)
+      
+      pc = mcmc.weighted_percentiles(x, np.ones_like(x), [16, 50, 84])
+      self.assertTrue(np.allclose(pc, np.percentile(x, [16, 50, 84], method='hazen')))
+      
+      pc = mcmc.weighted_percentiles([1., 2., 3.], [0., 1., 0.], [16, 50, 84])
+      self.assertTrue(np.allclose(pc, [2., 2., 2.]))
+   
+   def test_grid_posterior(self):
+      grid = mcmc.get_grid(self.variables, self.limits)
+      
+      results, pc = mcmc.grid_posterior(self.variables, self.limits, self.y, self.yerr, refine=2,
+                                        verbose=False, grid=grid)
+      
+      np.random.seed(1)
+      results_, samples = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, nwalkers=50,
+                                    nsteps=1000, verbose=False, grid=grid)
+      pc_ = mcmc.calculate_percentiles(samples, [16, 50, 84])
+      
+      self.assertEqual(sorted(pc.keys()), sorted(pc_.keys()))
+      for p in models.parameters:
+         self.assertTrue(p in results)
+         self.assertEqual(len(pc[p]), 3)
+      
+      self.assertLess(abs(pc['mass_init'][0] - pc_['mass_init'][0]), 0.02)
+      self.assertLess(abs(pc['mass_init'][1] - pc_['mass_init'][1]), 0.02)
+      self.assertLess(abs(pc['phase'][0] - pc_['phase'][0]), 10)
+      
+      # -- a grid without limits is sliced to the limits and gives the same result
+      full_grid = mcmc.get_grid(self.variables, None)
+      results_, pc_ = mcmc.grid_posterior(self.variables, self.limits, self.y, self.yerr, refine=2,
+                                          verbose=False, grid=full_grid)
+      for p in pc:
+         self.assertTrue(np.allclose(pc[p], pc_[p]))
+   
+   def test_compact_grid(self):
+      grid = mcmc.get_grid(self.variables, self.limits)
+      compact_grid = models.prepare_grid(variables=list(self.variables), set_default=False,
+                                         return_all_variables=True, compact=True, dtype=np.float64)
+      
+      results, pc = mcmc.grid_posterior(self.variables, self.limits, self.y, self.yerr, refine=2,
+                                        verbose=False, grid=grid)
+      results_, pc_ = mcmc.grid_posterior(self.variables, self.limits, self.y, self.yerr, refine=2,
+                                          verbose=False, grid=compact_grid)
+      for p in pc:
+         self.assertTrue(np.allclose(pc[p], pc_[p]))
+      
+      np.random.seed(1)
+      results, samples = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, nwalkers=20,
+                                   nsteps=100, nrelax=20, verbose=False, grid=grid)
+      np.random.seed(1)
+      results_, samples_ = mcmc.MCMC(self.variables, self.limits, self.y, self.yerr, nwalkers=20,
+                                     nsteps=100, nrelax=20, verbose=False, grid=compact_grid)
+      for p in models.parameters:
+         self.assertTrue(np.allclose(samples[p], samples_[p]))
+
+if __name__ == '__main__':
+   unittest.main()
@@ -1,8 +1,15 @@
 import numpy as np
 
+import  os
+import  json
+import  pickle
+import  shutil
+import  tempfile
 import  unittest
 
 from emcmass.emcmass import models
+from emcmass import ingest
+from emcmass import interpol
 
 class TestGetFiles(unittest.TestCase):
    
@@ -62,6 +69,344 @@ class TestPrepareGrid(unittest.TestCase):
          self.assertTrue(np.all(g1 == g2))
       
 
+class TestGridCache(unittest.TestCase):
+   
+   def setUp(self):
+      models.defaults = None # clear the default grid
+      self.cachedir = models.cachedir
+      models.cachedir = tempfile.mkdtemp()
+      self.variables = ['log_L', 'log_Teff', 'log_g', 'M_H']
+      self.lim_kwargs = dict(mass_init_lim=(0.5, 1.25), phase_lim=(100, 300))
+      
+   def tearDown(self):
+      shutil.rmtree(models.cachedir)
+      models.cachedir = self.cachedir
+   
+   def test_cached_grid(self):
+      
+      grid1 = models.prepare_grid(variables=self.variables, cache=True, **self.lim_kwargs)
+      grid2 = models.prepare_grid(variables=self.variables, cache=True, **self.lim_kwargs)
+      grid3 = models.prepare_grid(variables=self.variables, cache=False, **self.lim_kwargs)
+      
+      for grid in [grid1, grid2]:
+         self.assertTrue(np.array_equal(grid[1], grid3[1]))
+         self.assertEqual(list(grid[2]), list(grid3[2]))
+         for g1, g2 in zip(grid[0], grid3[0]):
+            self.assertTrue(np.array_equal(g1, g2))
+      
+   def test_cache_key(self):
+      files, z = models.get_files('mist')
+      
+      key1 = models.get_cache_key('mist', files, models.parameters, self.variables, False,
+                                  **self.lim_kwargs)
+      key2 = models.get_cache_key('mist', files, models.parameters, self.variables, False,
+                                  mass_init_lim=(0.5, 1.3), phase_lim=(100, 300))
+      key3 = models.get_cache_key('mist', files, models.parameters, self.variables[:2], False,
+                                  **self.lim_kwargs)
+      
+      self.assertNotEqual(key1, key2)
+      self.assertNotEqual(key1, key3)
+      self.assertEqual(key1, models.get_cache_key('mist', files, models.parameters,
+                                                  self.variables, False, **self.lim_kwargs))
+   
+   def test_memmap_grid(self):
+      
+      filename = os.path.join(models.cachedir, 'grid')
+      grid1 = models.prepare_grid(variables=self.variables, memmap=filename, **self.lim_kwargs)
+      grid2 = models.prepare_grid(variables=self.variables, **self.lim_kwargs)
+      
+      self.assertTrue(isinstance(grid1[1], np.memmap))
+      self.assertFalse(grid1[1].flags.writeable)
+      self.assertTrue(np.array_equal(grid1[1], grid2[1]))
+      
+      values1 = models.interpolate([0.8, 1.1], [-0.2, 0.1], [150.0, 250.5], grid=grid1)
+      values2 = models.interpolate([0.8, 1.1], [-0.2, 0.1], [150.0, 250.5], grid=grid2)
+      self.assertTrue(np.array_equal(values1, values2))
+      
+      grid3 = models.load_grid(filename, mmap_mode='r')
+      self.assertTrue(np.array_equal(grid3[1], grid2[1]))
+      
+
+class TestGrid(unittest.TestCase):
+   
+   def setUp(self):
+      models.defaults = None # clear the default grid
+      self.tempdir = tempfile.mkdtemp()
+      self.variables = ['log_L', 'log_Teff', 'log_g', 'M_H']
+      self.lim_kwargs = dict(mass_init_lim=(0.5, 1.25), phase_lim=(100, 300))
+      
+   def tearDown(self):
+      shutil.rmtree(self.tempdir)
+   
+   def test_grid(self):
+      grid = models.prepare_grid(variables=self.variables, set_default=False, **self.lim_kwargs)
+      
+      self.assertTrue(models.defaults is None)
+      self.assertTrue(isinstance(grid, models.Grid))
+      
+      axis_values, pixelgrid, variables = grid
+      self.assertTrue(grid[1] is pixelgrid)
+      self.assertTrue(grid.pixelgrid is pixelgrid)
+      self.assertEqual(list(grid.variables), self.variables)
+      
+      values = grid.interpolate([0.8, 1.1], [-0.2, 0.1], [150.0, 250.5])
+      self.assertTrue(np.array_equal(values, models.interpolate([0.8, 1.1], [-0.2, 0.1], [150.0, 250.5],
+                                                                grid=grid)))
+      
+      track = grid.track(1.0, 0.0)
+      self.assertEqual(track.shape, (len(self.variables), len(set(axis_values[2]))))
+      self.assertTrue(models.defaults is None)
+   
+   def test_contains(self):
+      grid = models.prepare_grid(variables=self.variables, set_default=False,
+                                 mass_init_lim=(0.5, 1.25), phase_lim=(200, 400))
+      
+      # -- the tracks of low mass stars end before phase 400
+      p = ([0.8, 1.1, 0.6, 0.6], [-0.2, 0.1, 0.0, 0.0], [250.0, 350.5, 299.0, 350.0])
+      
+      inside = grid.contains(*p)
+      self.assertTrue(np.array_equal(inside, [True, True, True, False]))
+      self.assertTrue(np.array_equal(inside, np.all(np.isfinite(grid.interpolate(*p)), axis=0)))
+      
+      for inside_, p_ in zip(inside, zip(*p)):
+         self.assertEqual(grid.contains(*p_), inside_)
+   
+   def test_slice(self):
+      grid1 = models.prepare_grid(variables=self.variables, set_default=False)
+      
+      for lim_kwargs in [self.lim_kwargs,
+                         dict(mass_init_lim=(0.71, 1.33), M_H_init_lim=(-0.6, 0.3), phase_lim=(202.5, 355)),
+                         dict(M_H_init_lim=(0.0, 0.0))]:
+         grid2 = grid1.slice(**lim_kwargs)
+         grid3 = models.prepare_grid(variables=self.variables, set_default=False, **lim_kwargs)
+         
+         # -- the sliced grid is a view on the full grid
+         self.assertTrue(np.shares_memory(grid2[1], grid1[1]))
+         self.assertTrue(np.array_equal(grid2[1], grid3[1]))
+         for g2, g3 in zip(grid2[0], grid3[0]):
+            self.assertTrue(np.array_equal(g2, g3))
+      
+      with self.assertRaises(ValueError):
+         grid1.slice(mass_init_lim=(100, 200))
+   
+   def test_slice_compact(self):
+      grid1 = models.prepare_grid(variables=self.variables, set_default=False, compact=True)
+      
+      for lim_kwargs in [self.lim_kwargs,
+                         dict(mass_init_lim=(0.71, 1.33), M_H_init_lim=(-0.6, 0.3), phase_lim=(202.5, 355)),
+                         dict(M_H_init_lim=(0.0, 0.0))]:
+         grid2 = grid1.slice(**lim_kwargs)
+         grid3 = models.prepare_grid(variables=self.variables, set_default=False, compact=True,
+                                     **lim_kwargs)
+         
+         # -- the packed data is shared with the full grid
+         self.assertTrue(grid2[1].packed is grid1[1].packed)
+         self.assertTrue(np.array_equal(interpol.expand_compactgrid(grid2[1]),
+                                        interpol.expand_compactgrid(grid3[1])))
+         for g2, g3 in zip(grid2[0], grid3[0]):
+            self.assertTrue(np.array_equal(g2, g3))
+      
+      #-- a mass inside the limits without models at this metallicity has to be removed
+      pars = np.array([[m, z, p] for m in [0.5, 1.0, 1.5] for z in [-0.5, 0.0] for p in range(4)
+                       if not (m == 1.0 and z == -0.5)]).T
+      data = np.vstack([pars[0] + pars[2], pars[1] - pars[2]])
+      grid1 = models.Grid(*(interpol.create_pixeltypegrid(pars, data) + (['a', 'b'],)))
+      grid2 = models.Grid(*(interpol.create_compactgrid(pars, data, dtype=np.float64) + (['a', 'b'],)))
+      
+      sliced1 = grid1.slice(M_H_init_lim=(-0.5, -0.5))
+      sliced2 = grid2.slice(M_H_init_lim=(-0.5, -0.5))
+      
+      self.assertEqual(list(sliced2[0][0]), [0.5, 1.5])
+      self.assertTrue(np.array_equal(interpol.expand_compactgrid(sliced2[1]), sliced1[1]))
+   
+   def test_pickle(self):
+      grid1 = models.prepare_grid(variables=self.variables, **self.lim_kwargs)
+      
+      grid2 = pickle.loads(pickle.dumps(grid1))
+      self.assertTrue(np.array_equal(grid1[1], grid2[1]))
+      
+      # -- a memory mapped grid is pickled by its path
+      filename = os.path.join(self.tempdir, 'grid')
+      grid3 = models.prepare_grid(variables=self.variables, memmap=filename, **self.lim_kwargs)
+      data = pickle.dumps(grid3)
+      self.assertLess(len(data), 1000)
+      
+      grid4 = pickle.loads(data)
+      self.assertTrue(isinstance(grid4[1], np.memmap))
+      self.assertEqual(grid4.path, filename)
+      self.assertTrue(np.array_equal(grid4[1], grid1[1]))
+      
+
+class TestGridMemCache(unittest.TestCase):
+   
+   def setUp(self):
+      models.defaults = None # clear the default grid
+      self.grid_cache = models.grid_cache
+      models.grid_cache = models.GridCache()
+      self.variables = ['log_L', 'log_Teff', 'log_g', 'M_H']
+      
+   def tearDown(self):
+      models.grid_cache = self.grid_cache
+   
+   def test_superset(self):
+      grid1 = models.prepare_grid(variables=self.variables, memcache=True,
+                                  mass_init_lim=(0.5, 1.5), phase_lim=(100, 400))
+      
+      for lim_kwargs in [dict(mass_init_lim=(0.5, 1.5), phase_lim=(100, 400)),
+                         dict(mass_init_lim=(0.71, 1.33), phase_lim=(202.5, 355)),
+                         dict(mass_init_lim=(0.8, 1.2), M_H_init_lim=(-0.6, 0.3), phase_lim=(150, 400))]:
+         grid2 = models.prepare_grid(variables=self.variables, memcache=True, **lim_kwargs)
+         grid3 = models.prepare_grid(variables=self.variables, **lim_kwargs)
+         
+         self.assertTrue(np.array_equal(grid2[1], grid3[1]))
+         for g2, g3 in zip(grid2[0], grid3[0]):
+            self.assertTrue(np.array_equal(g2, g3))
+      
+      self.assertEqual(models.grid_cache.hits, 3)
+      self.assertEqual(models.grid_cache.misses, 1)
+      self.assertEqual(len(models.grid_cache), 1)
+      
+      # -- wider limits and other variables are not in the cache
+      models.prepare_grid(variables=self.variables, memcache=True, mass_init_lim=(0.5, 1.6),
+                          phase_lim=(100, 400))
+      models.prepare_grid(variables=self.variables[:2], memcache=True, mass_init_lim=(0.8, 1.2),
+                          phase_lim=(100, 400))
+      
+      self.assertEqual(models.grid_cache.misses, 3)
+      self.assertEqual(len(models.grid_cache), 3)
+   
+   def test_eviction(self):
+      models.prepare_grid(variables=self.variables, memcache=True,
+                          mass_init_lim=(0.5, 1.0), phase_lim=(100, 400))
+      models.prepare_grid(variables=self.variables, memcache=True,
+                          mass_init_lim=(1.0, 1.5), phase_lim=(100, 400))
+      self.assertEqual(len(models.grid_cache), 2)
+      
+      models.grid_cache.maxbytes = models.grid_cache.nbytes
+      
+      models.prepare_grid(variables=self.variables, memcache=True,
+                          mass_init_lim=(1.5, 2.0), phase_lim=(100, 400))
+      self.assertLessEqual(models.grid_cache.nbytes, models.grid_cache.maxbytes)
+      
+      # -- the least recently used grid was removed, the last one is kept
+      models.prepare_grid(variables=self.variables, memcache=True,
+                          mass_init_lim=(1.6, 1.9), phase_lim=(100, 400))
+      self.assertEqual(models.grid_cache.hits, 1)
+      models.prepare_grid(variables=self.variables, memcache=True,
+                          mass_init_lim=(0.6, 0.9), phase_lim=(100, 400))
+      self.assertEqual(models.grid_cache.misses, 4)
+      
+
+class TestColumnStore(unittest.TestCase):
+   
+   def setUp(self):
+      models.defaults = None # clear the default grid
+      self.storedir = models.storedir
+      models.storedir = tempfile.mkdtemp()
+      self.variables = ['log_L', 'log_Teff', 'log_g', 'M_H']
+      self.lim_kwargs = dict(mass_init_lim=(0.5, 1.25), phase_lim=(100, 300), M_H_lim=(-1.0, 0.5))
+      
+   def tearDown(self):
+      shutil.rmtree(models.storedir)
+      models.storedir = self.storedir
+   
+   def test_ingest(self):
+      grid1 = models.prepare_grid(variables=self.variables, return_all_variables=True,
+                                  **self.lim_kwargs)
+      
+      manifest = ingest.ingest('mist')
+      files, z = models.get_files('mist')
+      
+      self.assertEqual(len(manifest['tables']), len(files))
+      self.assertTrue('log_Teff' in manifest['columns'])
+      self.assertTrue(models.get_store('mist') is not None)
+      
+      grid2 = models.prepare_grid(variables=self.variables, return_all_variables=True,
+                                  **self.lim_kwargs)
+      
+      self.assertTrue(np.array_equal(grid1[1], grid2[1]))
+      self.assertEqual(list(grid1[2]), list(grid2[2]))
+      for g1, g2 in zip(grid1[0], grid2[0]):
+         self.assertTrue(np.array_equal(g1, g2))
+   
+   def test_row_ranges(self):
+      lim_kwargs = dict(mass_init_lim=(0.9, 1.1), phase_lim=(101.5, 250))
+      grid1 = models.prepare_grid(variables=self.variables, **lim_kwargs)
+      
+      manifest = ingest.ingest('mist')
+      self.assertTrue(manifest['tables'][0]['tracks'] is not None)
+      
+      data = models.ColumnTable(os.path.join(models.storedir, 'mist', manifest['tables'][0]['name']),
+                                manifest['tables'][0]['nrows'])
+      data.ranges = models.get_row_ranges(data, manifest['tables'][0]['tracks'],
+                                          mass_lim=(0.9, 1.1), phase_lim=(101.5, 250))
+      self.assertTrue(len(data) < data.nrows / 10)
+      self.assertTrue(np.all((data['mass_init'] >= 0.9) & (data['mass_init'] <= 1.1)))
+      self.assertTrue(np.all((data['phase'] >= 101.5) & (data['phase'] <= 250)))
+      
+      grid2 = models.prepare_grid(variables=self.variables, **lim_kwargs)
+      
+      self.assertTrue(np.array_equal(grid1[1], grid2[1], equal_nan=True))
+      for g1, g2 in zip(grid1[0], grid2[0]):
+         self.assertTrue(np.array_equal(g1, g2))
+   
+   def test_no_store(self):
+      self.assertTrue(models.get_store('mist') is None)
+   
+   def test_new_files(self):
+      manifest = ingest.ingest('mist')
+      self.assertTrue(models.get_store('mist') is not None)
+      
+      #-- a fits file that is not in the store, as if it was added after the ingest
+      manifest['tables'] = manifest['tables'][1:]
+      with open(os.path.join(models.storedir, 'mist', 'manifest.json'), 'w') as ofile:
+         json.dump(manifest, ofile)
+      
+      self.assertTrue(models.get_store('mist') is None)
+
+
+class TestGridPrecision(unittest.TestCase):
+   
+   def setUp(self):
+      models.defaults = None # clear the default grid
+      self.variables = ['log_L', 'log_Teff', 'log_g', 'M_H']
+      self.lim_kwargs = dict(mass_init_lim=(0.5, 1.25), phase_lim=(100, 300))
+   
+   def test_float32_grid(self):
+      grid = models.prepare_grid(variables=self.variables, dtype=np.float32, **self.lim_kwargs)
+      
+      self.assertEqual(grid[1].dtype, np.float32)
+      self.assertEqual(grid[0][0].dtype, np.float64)
+   
+   def test_precision_report(self):
+      report = models.precision_report(npoints=1000, variables=self.variables, **self.lim_kwargs)
+      
+      self.assertEqual(sorted(report.keys()), sorted(self.variables))
+      for name in self.variables:
+         self.assertLess(report[name][0], 1e-5)
+      
+
+class TestToRecarray(unittest.TestCase):
+   
+   def test_view(self):
+      values = np.arange(12, dtype=float).reshape(4, 3)
+      
+      data = models.to_recarray(values, ['a', 'b', 'c'])
+      
+      self.assertEqual(data.dtype.names, ('a', 'b', 'c'))
+      self.assertEqual(data.shape, (4,))
+      self.assertTrue(np.array_equal(data.b, values[:, 1]))
+      self.assertTrue(np.shares_memory(data, values))
+   
+   def test_copy(self):
+      values = np.arange(12, dtype=int).reshape(3, 4).T
+      
+      data = models.to_recarray(values, ['a', 'b', 'c'])
+      
+      self.assertTrue(np.array_equal(data.c, values[:, 2]))
+      self.assertEqual(data.dtype['a'], np.float64)
+      
+
 class TestInterpolate(unittest.TestCase):
    
    def setUp(self):
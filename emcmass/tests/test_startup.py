@@ -0,0 +1,42 @@
+import sys
+import subprocess
+
+import  unittest
+
+def import_module(module):
+   """
+   Imports a module in a new interpreter, and returns the time that took in
+   seconds and the names of all modules that were imported
+   """
+   code = ("import sys, time; t = time.perf_counter(); import {}; "
+           "print(time.perf_counter() - t); print(' '.join(sys.modules))").format(module)
+   
+   output = subprocess.check_output([sys.executable, '-c', code]).decode().splitlines()
+   
+   return float(output[0]), output[1].split()
+
+class TestStartup(unittest.TestCase):
+
+   # -- importing the CLI took over 2 s when matplotlib, emcee and astropy
+   #    were imported at load time
+   budget = 1.0
+   
+   def test_deferred_imports(self):
+      duration, modules = import_module('emcmass.emcmass')
+      
+      for module in ['pylab', 'matplotlib', 'emcee', 'astropy', 'scipy', 'yaml']:
+         self.assertNotIn(module, modules)
+   
+   def test_headless_plotting(self):
+      duration, modules = import_module('emcmass.plotting')
+      
+      self.assertIn('matplotlib', modules)
+      self.assertNotIn('matplotlib.pyplot', modules)
+   
+   def test_import_time(self):
+      duration = min([import_module('emcmass.emcmass')[0] for i in range(3)])
+      
+      self.assertLess(duration, self.budget)
+
+if __name__ == '__main__':
+   unittest.main()
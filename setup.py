@@ -23,7 +23,8 @@ setuptools.setup(
     test_suite='pytest.collector',
     tests_require=['pytest'],
     entry_points = {
-        'console_scripts': ['emcmass=emcmass.emcmass:main'],
+        'console_scripts': ['emcmass=emcmass.emcmass:main',
+                            'emcmass-ingest=emcmass.ingest:main'],
     },
     classifiers=[
         "Development Status :: 3 - Alpha",